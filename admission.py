@@ -0,0 +1,340 @@
+"""Estimate what a request will cost before running it, and admit requests within CPU and memory budgets"""
+from collections import deque
+from PyPDF2 import PdfReader
+from PIL import Image
+import threading
+import logging
+import math
+import time
+import os
+
+MB = 1024 * 1024
+
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+LANES = (CHEAP, EXPENSIVE)
+
+# How each scheduled endpoint is costed: (kind, base memory, memory per unit). Units are decoded
+# pixels for image and model work, rendered pixels for 'render', pages for 'pdf' and upload bytes
+# for 'bytes'. Endpoints not listed (status, uploads, job submission) are not scheduled
+OPERATION_COSTS = {
+    'resize_image': ('image', 16 * MB, 12),
+    'crop_image': ('image', 16 * MB, 8),
+    'convert_image': ('image', 16 * MB, 12),
+    'compress_image': ('image', 16 * MB, 16),
+    'run_pipeline': ('image', 16 * MB, 16),
+    'images_to_pdf': ('image', 16 * MB, 8),
+    'resize_image_batch': ('image_batch', 16 * MB, 12),
+    'crop_image_batch': ('image_batch', 16 * MB, 8),
+    'convert_image_batch': ('image_batch', 16 * MB, 12),
+    'compress_image_batch': ('image_batch', 16 * MB, 16),
+    'remove_background': ('model', 0, 16),
+    'remove_background_batch': ('model', 0, 16),
+    'convert': ('render', 32 * MB, 6),
+    'combine_pdf': ('bytes', 32 * MB, 2),
+    'split_pdf': ('pdf', 32 * MB, 64 * 1024),
+    'rotate_pdf': ('pdf', 16 * MB, 16 * 1024),
+    'add_watermark': ('pdf', 32 * MB, 64 * 1024),
+    'compress_pdf': ('pdf', 128 * MB, 256 * 1024),
+}
+
+# Working memory of one background removal inference per model, on top of the shared weights
+MODEL_MEMORY = {
+    'u2net': 320 * MB,
+    'u2netp': 96 * MB,
+    'isnet': 900 * MB,
+    'silueta': 160 * MB,
+}
+
+# Rendered pages are costed as letter/A4 sheets: 8.5 x 11 inches at the requested dpi
+PAGE_SQUARE_INCHES = 93.5
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request cannot get its budget within the wait limit"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def memory_limit():
+    """Bytes of memory this container may use: its cgroup limit if it has one, else physical memory"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value != 'max' and int(value) < 1 << 60:
+                return int(value)
+        except (OSError, ValueError):
+            pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def _rewinding(file, read):
+    """Call read(stream) on an upload's stream and put the stream back where it was; None on failure"""
+    stream = file.stream
+    try:
+        position = stream.tell()
+    except (AttributeError, OSError):
+        return None
+    try:
+        return read(stream)
+    except Exception:
+        return None
+    finally:
+        stream.seek(position)
+
+def image_pixels(file):
+    """Pixel count from an uploaded image's header, without decoding it"""
+    def read(stream):
+        with Image.open(stream) as img:
+            return img.width * img.height
+    return _rewinding(file, read)
+
+def pdf_pages(file):
+    """Page count from an uploaded PDF's page tree, without walking it"""
+    def read(stream):
+        reader = PdfReader(stream)
+        return int(reader.trailer['/Root']['/Pages']['/Count'])
+    return _rewinding(file, read)
+
+def upload_size(file):
+    def read(stream):
+        stream.seek(0, os.SEEK_END)
+        return stream.tell()
+    return _rewinding(file, read) or 0
+
+class CostModel:
+    """Estimate the CPU cores and bytes of memory a request will hold while it runs.
+
+    Estimates come from what is cheap to read once the body is parsed: image
+    headers for pixel counts, the page tree root for page counts, the form for
+    dpi and page selections. They are meant to rank and bound work, not to be exact.
+    """
+
+    def __init__(self, model_name='u2net', model_threads=1, render_workers=1, batch_workers=1,
+                 unknown_pixels=16_000_000):
+        self.model_name = model_name
+        # Threads one inference keeps busy
+        self.model_threads = model_threads
+        self.render_workers = render_workers
+        self.batch_workers = batch_workers
+        # Assumed size of images whose header cannot be read up front, e.g. inside ZIPs
+        self.unknown_pixels = unknown_pixels
+
+    def estimate(self, operation, files, form):
+        """
+        Cost of one request
+        Args:
+            operation: Endpoint name
+            files: The request's files (a MultiDict)
+            form: The request's form fields
+        Returns:
+            (cpu cores, memory bytes), or None for endpoints that are not scheduled
+        """
+        if operation not in OPERATION_COSTS:
+            return None
+        kind, base, per_unit = OPERATION_COSTS[operation]
+        uploads = [file for _, file in files.items(multi=True) if file and file.filename]
+        if not uploads:
+            # Nothing to run; the route rejects the request
+            return None
+
+        if operation == 'convert' and not uploads[0].filename.lower().endswith('.pdf'):
+            kind, base, per_unit = OPERATION_COSTS['images_to_pdf']
+        if operation == 'run_pipeline' and 'remove-background' in form.get('operations', ''):
+            kind = 'model'
+
+        if kind == 'image':
+            pixels = max(self._pixels(file) for file in uploads)
+            return 1, base + pixels * per_unit
+        if kind == 'image_batch':
+            # The pool decodes up to batch_workers images at once, in its own processes
+            pixels = max(self._pixels(file) for file in uploads)
+            workers = self.batch_workers if self._has_archive(uploads) else min(self.batch_workers, len(uploads))
+            return workers, base + workers * pixels * per_unit
+        if kind == 'model':
+            pixels = [self._pixels(file) for file in uploads]
+            # Batches keep every decoded image; single requests one
+            pixels = sum(pixels) if operation == 'remove_background_batch' else max(pixels)
+            return self.model_threads, base + MODEL_MEMORY.get(self.model_name, MODEL_MEMORY['u2net']) + pixels * per_unit
+        if kind == 'render':
+            return self._render_cost(uploads[0], form, base, per_unit)
+        if kind == 'bytes':
+            return 1, base + sum(upload_size(file) for file in uploads) * per_unit
+        pages = sum(self._pages(file) for file in uploads)
+        return 1, base + pages * per_unit
+
+    def _pixels(self, file):
+        if file.filename.lower().endswith('.zip'):
+            return self.unknown_pixels
+        return image_pixels(file) or self.unknown_pixels
+
+    def _pages(self, file):
+        # Unreadable page trees are costed like 100KB pages, the typical size of scanned ones
+        return pdf_pages(file) or max(1, upload_size(file) // (100 * 1024))
+
+    def _has_archive(self, uploads):
+        return any(file.filename.lower().endswith('.zip') for file in uploads)
+
+    def _render_cost(self, file, form, base, per_unit):
+        from converter import parse_page_ranges
+        try:
+            dpi = int(form.get('dpi', 200))
+            pages = len(parse_page_ranges(form.get('pages', '1'), self._pages(file)))
+        except (TypeError, ValueError):
+            dpi, pages = 200, 1
+        width, height = form.get('width', type=int), form.get('height', type=int)
+        if width and height:
+            page_pixels = width * height
+        elif width or height:
+            page_pixels = int((width or height) ** 2 * 11 / 8.5)
+        else:
+            page_pixels = int(PAGE_SQUARE_INCHES * dpi * dpi)
+        # Multi-page requests render render_workers chunks at once
+        in_flight = max(1, min(self.render_workers, pages))
+        return in_flight, base + in_flight * page_pixels * per_unit
+
+class Ticket:
+    """Budget held by one admitted request, returned by release()"""
+
+    def __init__(self, controller, operation, lane, cpu, memory, waited):
+        self.controller = controller
+        self.operation = operation
+        self.lane = lane
+        self.cpu = cpu
+        self.memory = memory
+        self.waited = waited
+        self.admitted_at = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        # Safe to call more than once: streamed responses release on close, others at teardown
+        if not self._released:
+            self._released = True
+            self.controller._release(self)
+
+class AdmissionController:
+    """Admit requests within a CPU and memory budget, in a cheap and an expensive lane.
+
+    Requests estimated at ``expensive_memory`` bytes or more, or at more than
+    one core, go to the expensive lane, which may hold at most
+    ``expensive_share`` of either budget, so cheap requests always find room.
+    Each lane is first come, first served; while a cheap request waits, no
+    expensive one starts. A request that cannot start waits up to ``max_wait``
+    seconds and is then rejected; expensive requests beyond
+    ``max_waiting_expensive`` waiting are rejected at once, so they do not tie
+    up the server threads cheap work needs. Costs larger than a lane's budget
+    are cut to it: such a request runs, but alone.
+    """
+
+    def __init__(self, cpu, memory, expensive_share=0.5, expensive_memory=256 * MB, max_wait=10,
+                 max_waiting_expensive=1):
+        self.cpu = cpu
+        self.memory = memory
+        self.expensive_share = expensive_share
+        self.expensive_memory = expensive_memory
+        self.max_wait = max_wait
+        self.max_waiting_expensive = max_waiting_expensive
+        self._cond = threading.Condition()
+        self._waiting = {lane: deque() for lane in LANES}
+        self._used = {lane: [0, 0] for lane in LANES}  # cpu, memory
+        self._running = {lane: 0 for lane in LANES}
+        self._admitted = {lane: 0 for lane in LANES}
+        self._rejected = {lane: 0 for lane in LANES}
+        self._wait_total = {lane: 0.0 for lane in LANES}
+        self._hold_average = {lane: 1.0 for lane in LANES}  # seconds, moving average
+
+    def lane(self, cpu, memory):
+        return EXPENSIVE if cpu > 1 or memory >= self.expensive_memory else CHEAP
+
+    def _limits(self, lane):
+        share = 1 if lane == CHEAP else self.expensive_share
+        return self.cpu * share, self.memory * share
+
+    def _fits(self, lane, cpu, memory):
+        used_cpu = sum(used[0] for used in self._used.values())
+        used_memory = sum(used[1] for used in self._used.values())
+        if used_cpu + cpu > self.cpu or used_memory + memory > self.memory:
+            return False
+        if lane == EXPENSIVE:
+            cpu_limit, memory_limit = self._limits(EXPENSIVE)
+            lane_cpu, lane_memory = self._used[EXPENSIVE]
+            return lane_cpu + cpu <= cpu_limit and lane_memory + memory <= memory_limit and not self._waiting[CHEAP]
+        return True
+
+    def retry_after(self, lane):
+        """Seconds to suggest to a rejected client: about how long the lane's requests hold their budget"""
+        return max(1, min(60, math.ceil(self._hold_average[lane])))
+
+    def acquire(self, operation, cpu, memory):
+        """
+        Wait for budget and take it
+        Args:
+            operation: Endpoint name, for messages
+            cpu: Estimated cores
+            memory: Estimated bytes
+        Returns:
+            Ticket to release when the request is done; raises AdmissionRejectedError
+        """
+        lane = self.lane(cpu, memory)
+        cpu_limit, memory_limit = self._limits(lane)
+        cpu, memory = min(cpu, cpu_limit), min(memory, memory_limit)
+        started = time.perf_counter()
+
+        with self._cond:
+            waiting = self._waiting[lane]
+            if waiting or not self._fits(lane, cpu, memory):
+                if lane == EXPENSIVE and len(waiting) >= self.max_waiting_expensive:
+                    self._reject(lane, operation)
+                entry = object()
+                waiting.append(entry)
+                deadline = started + self.max_wait
+                try:
+                    while waiting[0] is not entry or not self._fits(lane, cpu, memory):
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            self._reject(lane, operation)
+                        self._cond.wait(remaining)
+                finally:
+                    waiting.remove(entry)
+                    # The next in line (or an expensive request held back by this one) may start now
+                    self._cond.notify_all()
+
+            waited = time.perf_counter() - started
+            self._used[lane][0] += cpu
+            self._used[lane][1] += memory
+            self._running[lane] += 1
+            self._admitted[lane] += 1
+            self._wait_total[lane] += waited
+        return Ticket(self, operation, lane, cpu, memory, waited)
+
+    def _reject(self, lane, operation):
+        self._rejected[lane] += 1
+        retry_after = self.retry_after(lane)
+        logging.warning(f"Rejected {operation}: no {lane} budget within {self.max_wait}s")
+        raise AdmissionRejectedError(f"Server is at capacity for {lane} requests, retry in {retry_after}s", retry_after)
+
+    def _release(self, ticket):
+        held = time.perf_counter() - ticket.admitted_at
+        with self._cond:
+            self._used[ticket.lane][0] -= ticket.cpu
+            self._used[ticket.lane][1] -= ticket.memory
+            self._running[ticket.lane] -= 1
+            self._hold_average[ticket.lane] += (held - self._hold_average[ticket.lane]) * 0.2
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            lanes = {
+                lane: {
+                    'running': self._running[lane],
+                    'waiting': len(self._waiting[lane]),
+                    'admitted': self._admitted[lane],
+                    'rejected': self._rejected[lane],
+                    'cpu_used': self._used[lane][0],
+                    'memory_used': self._used[lane][1],
+                    'wait_seconds_total': round(self._wait_total[lane], 3),
+                    'hold_seconds_average': round(self._hold_average[lane], 3),
+                }
+                for lane in LANES
+            }
+            return {'cpu': self.cpu, 'memory': self.memory, 'lanes': lanes}
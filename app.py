@@ -1,32 +1,533 @@
-from flask import Flask, request, render_template, send_file, jsonify
+from flask import Flask, Request, Response, request, render_template, send_file, jsonify, abort, g
+from werkzeug.datastructures import ImmutableMultiDict, MultiDict
 import os
+import tempfile
 from pathlib import Path
-from converter import FileConverter
-from bg_remover import BackgroundRemover
+from converter import FileConverter, ImageTooLargeError, PageSelectionError, parse_page_ranges, IMAGE_FORMATS, PDF_PRESETS
+from pdf_optimize import ToolBusyError, ToolTimeoutError
+from bg_remover import BackgroundRemover, OUTPUT_FORMATS as BG_OUTPUT_FORMATS
+from compositing import parse_color
+from zip_stream import stream_zip
+from pdf_stream import iter_merged_pdf
+from image_pdf import PAGE_SIZES, FITS, ORIENTATIONS, iter_images_pdf
+from result_cache import ResultCache, remember_digest
+from storage import StorageManager
+from uploads import UploadManager, UploadNotFoundError, UploadStateError
+from jobs import JobManager, QueueFullError
+from batch import ImageBatchRunner, extract_images
+from admission import AdmissionController, AdmissionRejectedError, CostModel, LANES, OPERATION_COSTS, memory_limit
+from pipeline import ImagePipeline, parse_operations, server_timing
+from watermark import FONTS as WATERMARK_FONTS
+import metrics
 from werkzeug.utils import secure_filename
 import traceback
 import logging
+import zipfile
+import threading
+import cProfile
+import random
+import itertools
+import time
 from datetime import datetime
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class SpoolingRequest(Request):
+    """Keep uploads in memory, spilling to a temporary file only past SPILL_THRESHOLD"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=app.config['SPILL_THRESHOLD'])
+
+    @property
+    def max_content_length(self):
+        """Upload limit of the matched endpoint, falling back to MAX_CONTENT_LENGTH"""
+        return app.config['UPLOAD_LIMITS'].get(self.endpoint, app.config['MAX_CONTENT_LENGTH'])
+
+def parse_upload_limits(spec):
+    """Parse 'endpoint=MB,endpoint=MB' into byte limits per endpoint"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        endpoint, _, megabytes = item.partition('=')
+        limits[endpoint.strip()] = int(float(megabytes) * 1024 * 1024)
+    return limits
+
+# Routes of each feature group, which a deployment can switch off with FEATURES
+FEATURE_ENDPOINTS = {
+    'pdf': {'convert', 'combine_pdf', 'images_to_pdf', 'split_pdf', 'rotate_pdf', 'add_watermark', 'compress_pdf'},
+    'image': {'resize_image', 'crop_image', 'convert_image', 'compress_image', 'run_pipeline',
+              'resize_image_batch', 'crop_image_batch', 'convert_image_batch', 'compress_image_batch'},
+    'bg_removal': {'remove_background', 'remove_background_batch', 'remove_background_stats'},
+}
+
+# Chunked upload routes, whose bodies are raw bytes however they are labelled and must not be parsed as forms
+UPLOAD_ENDPOINTS = {'create_upload', 'upload_chunk', 'upload_status', 'finalize_upload', 'delete_upload'}
+
+def parse_features(spec):
+    """Parse 'pdf,image,bg-removal' into a set of feature group names"""
+    features = {part.strip().lower().replace('-', '_') for part in spec.split(',') if part.strip()}
+    unknown = features - set(FEATURE_ENDPOINTS)
+    if unknown:
+        raise ValueError(f"Unknown features: {', '.join(sorted(unknown))}. Choose from {', '.join(FEATURE_ENDPOINTS)}")
+    return features
+
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'input'
-app.config['OUTPUT_FOLDER'] = 'output'
+app.request_class = SpoolingRequest
+app.config['FEATURES'] = parse_features(os.environ.get('FEATURES', 'pdf,image,bg_removal'))  # e.g. FEATURES=pdf
+app.config['STORAGE_FOLDER'] = os.environ.get('STORAGE_FOLDER', 'work')  # per-request upload/result directories
+app.config['STORAGE_MAX_AGE'] = int(os.environ.get('STORAGE_MAX_AGE', 60 * 60))  # seconds
+app.config['STORAGE_MAX_BYTES'] = int(os.environ.get('STORAGE_MAX_BYTES', 5 * 1024 * 1024 * 1024))  # 5GB
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Per-endpoint overrides of MAX_CONTENT_LENGTH, e.g. UPLOAD_LIMITS="combine_pdf=1024,split_pdf=256" (MB)
+app.config['UPLOAD_LIMITS'] = parse_upload_limits(os.environ.get(
+    'UPLOAD_LIMITS',
+    'combine_pdf=512,images_to_pdf=512,compress_pdf=512,resize_image_batch=512,crop_image_batch=512,convert_image_batch=512,compress_image_batch=512'
+))
+app.config['UPLOADS_FOLDER'] = os.environ.get('UPLOADS_FOLDER', 'uploads')  # chunked uploads
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 4 * 1024 * 1024 * 1024))  # 4GB per chunked upload
+app.config['UPLOAD_TTL'] = int(os.environ.get('UPLOAD_TTL', 24 * 60 * 60))  # seconds since last use
+app.config['COMBINE_STREAMING_MIN_FILES'] = int(os.environ.get('COMBINE_STREAMING_MIN_FILES', 10))
+app.config['IMAGE_MAX_PIXELS'] = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))  # per decoded image, 0 disables
+app.config['IMAGE_LARGE_PIXELS'] = int(os.environ.get('IMAGE_LARGE_PIXELS', 16_000_000))  # large-image mode from here on
+app.config['COMPRESS_MAX_TRIALS'] = int(os.environ.get('COMPRESS_MAX_TRIALS', 8))  # encodes per target-size compression
+app.config['PDF_OPTIMIZE_WORKERS'] = int(os.environ.get('PDF_OPTIMIZE_WORKERS', max(1, (os.cpu_count() or 1) // 2)))  # concurrent gs/qpdf runs
+app.config['PDF_OPTIMIZE_TIMEOUT'] = float(os.environ.get('PDF_OPTIMIZE_TIMEOUT', 120))  # seconds per gs/qpdf run
+app.config['PDF_OPTIMIZE_QUEUE_TIMEOUT'] = float(os.environ.get('PDF_OPTIMIZE_QUEUE_TIMEOUT', 30))  # seconds waiting for a slot
+app.config['GHOSTSCRIPT_PATH'] = os.environ.get('GHOSTSCRIPT_PATH', 'gs')
+app.config['QPDF_PATH'] = os.environ.get('QPDF_PATH', 'qpdf')
+app.config['SPILL_THRESHOLD'] = int(os.environ.get('SPILL_THRESHOLD', 8 * 1024 * 1024))  # bytes held in memory per upload/result
+app.config['REMBG_MODEL'] = os.environ.get('REMBG_MODEL', 'u2net')  # u2net, u2netp, isnet or silueta
+app.config['REMBG_POOL_SIZE'] = int(os.environ.get('REMBG_POOL_SIZE', os.cpu_count() or 1))
+app.config['REMBG_PRELOAD'] = os.environ.get('REMBG_PRELOAD', 'true').lower()  # true, background or false
+app.config['REMBG_CHECKOUT_TIMEOUT'] = float(os.environ.get('REMBG_CHECKOUT_TIMEOUT', 30))
+app.config['REMBG_INTRA_OP_THREADS'] = int(os.environ.get('REMBG_INTRA_OP_THREADS', 0)) or None  # default: cores / pool size
+app.config['REMBG_BATCH_MAX_SIZE'] = int(os.environ.get('REMBG_BATCH_MAX_SIZE', 1))  # >1 enables micro-batching, for models with a dynamic batch dimension
+app.config['REMBG_BATCH_MAX_WAIT_MS'] = float(os.environ.get('REMBG_BATCH_MAX_WAIT_MS', 10))
+app.config['REMBG_PROXY_MIN_PIXELS'] = int(os.environ.get('REMBG_PROXY_MIN_PIXELS', 4_000_000))  # 0 disables the proxy path
+app.config['REMBG_MAX_WORKING_SIZE'] = int(os.environ.get('REMBG_MAX_WORKING_SIZE', 1024))  # longest side of the proxy
+app.config['REMBG_REFINE_EDGES'] = os.environ.get('REMBG_REFINE_EDGES', 'false').lower() == 'true'
+app.config['CACHE_ENABLED'] = os.environ.get('CACHE_ENABLED', 'true').lower() == 'true'
+app.config['CACHE_FOLDER'] = os.environ.get('CACHE_FOLDER', 'cache')
+app.config['CACHE_MAX_BYTES'] = int(os.environ.get('CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 1GB
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 24 * 60 * 60))  # seconds
+app.config['JOBS_FOLDER'] = os.environ.get('JOBS_FOLDER', 'jobs')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 1))
+app.config['JOB_RESULT_TTL'] = int(os.environ.get('JOB_RESULT_TTL', 60 * 60))  # seconds
+app.config['JOB_STALE_TTL'] = int(os.environ.get('JOB_STALE_TTL', 24 * 60 * 60))  # seconds before an unfinished job is failed
+app.config['JOB_RETRY_AFTER'] = 10  # seconds suggested to clients when a job queue is full
+app.config['IMAGE_BATCH_WORKERS'] = int(os.environ.get('IMAGE_BATCH_WORKERS', os.cpu_count() or 1))
+app.config['IMAGE_BATCH_MAX_FILES'] = int(os.environ.get('IMAGE_BATCH_MAX_FILES', 500))  # images per batch request
+app.config['IMAGE_BATCH_MAX_UNZIPPED'] = int(os.environ.get('IMAGE_BATCH_MAX_UNZIPPED', 2 * 1024 * 1024 * 1024))  # 2GB per batch
+# Admission budgets are per worker process; by default the machine's cores and 70% of its memory split across workers
+web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+app.config['ADMISSION_CPU'] = float(os.environ.get('ADMISSION_CPU', max(2, (os.cpu_count() or 1) // web_workers)))  # cores
+app.config['ADMISSION_MEMORY_MB'] = int(os.environ.get('ADMISSION_MEMORY_MB', memory_limit() * 0.7 / web_workers / (1024 * 1024)))
+app.config['ADMISSION_EXPENSIVE_MB'] = int(os.environ.get('ADMISSION_EXPENSIVE_MB', 256))  # estimates from here on are expensive
+app.config['ADMISSION_EXPENSIVE_SHARE'] = float(os.environ.get('ADMISSION_EXPENSIVE_SHARE', 0.5))  # of both budgets
+app.config['ADMISSION_MAX_WAIT'] = float(os.environ.get('ADMISSION_MAX_WAIT', 10))  # seconds before a 503
+app.config['ADMISSION_MAX_WAITING_EXPENSIVE'] = int(os.environ.get('ADMISSION_MAX_WAITING_EXPENSIVE', 1))  # per worker
+
+app.config['PROFILE_SLOW_REQUESTS_MS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS_MS', 0))  # 0 disables profiling
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.05))  # fraction of requests profiled
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', 'profiles')
 
-converter = FileConverter()
-bg_remover = BackgroundRemover()
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    'http_request_duration_seconds', 'Time from the start of a request until its response was sent',
+    ('operation', 'size', 'outcome')
+)
+REQUESTS_IN_FLIGHT = metrics.REGISTRY.gauge('http_requests_in_flight', 'Requests being handled', ('operation',))
+PROFILES_SAVED = metrics.REGISTRY.counter('slow_request_profiles_total', 'cProfile dumps written for slow requests', ('operation',))
+SESSIONS = metrics.REGISTRY.gauge('rembg_sessions', 'Background removal model sessions by state', ('state',))
+SESSION_QUEUE_DEPTH = metrics.REGISTRY.gauge('rembg_session_queue_depth', 'Requests waiting for a model session')
+BATCH_PENDING = metrics.REGISTRY.gauge('rembg_batch_pending', 'Images waiting to be batched into a model run')
+JOB_WORKERS = metrics.REGISTRY.gauge('job_pool_workers', 'Processes in the job pool')
+JOBS_ACTIVE = metrics.REGISTRY.gauge('jobs_active', 'Queued and running jobs', ('operation',))
+CACHE_STATS = metrics.REGISTRY.gauge('result_cache', 'Result cache size and counters', ('stat',))
+STORAGE_STATS = metrics.REGISTRY.gauge('storage', 'Per-request working directories, as of the last sweep', ('stat',))
+PDF_TOOL_STATS = metrics.REGISTRY.gauge('pdf_tools', 'Ghostscript/qpdf process slots and counters', ('stat',))
+IMAGE_BATCH_STATS = metrics.REGISTRY.gauge('image_batch', 'Image batch pool size and counters', ('stat',))
+ADMISSION_WAIT = metrics.REGISTRY.histogram('admission_wait_seconds', 'Time admitted requests waited for budget', ('lane',))
+ADMISSION_STATS = metrics.REGISTRY.gauge('admission', 'Admission budgets, usage and counters by lane', ('lane', 'stat'))
+# cProfile can only trace one request of a process at a time
+profile_lock = threading.Lock()
+
+converter = FileConverter(
+    max_pixels=app.config['IMAGE_MAX_PIXELS'],
+    large_image_pixels=app.config['IMAGE_LARGE_PIXELS'],
+    tool_workers=app.config['PDF_OPTIMIZE_WORKERS'],
+    tool_timeout=app.config['PDF_OPTIMIZE_TIMEOUT'],
+    tool_queue_timeout=app.config['PDF_OPTIMIZE_QUEUE_TIMEOUT'],
+    ghostscript_path=app.config['GHOSTSCRIPT_PATH'],
+    qpdf_path=app.config['QPDF_PATH']
+)
+storage = StorageManager(
+    root=app.config['STORAGE_FOLDER'],
+    max_age=app.config['STORAGE_MAX_AGE'],
+    max_bytes=app.config['STORAGE_MAX_BYTES']
+)
+uploads = UploadManager(
+    uploads_dir=app.config['UPLOADS_FOLDER'],
+    max_bytes=app.config['UPLOAD_MAX_BYTES'],
+    ttl=app.config['UPLOAD_TTL']
+)
+result_cache = ResultCache(
+    cache_dir=app.config['CACHE_FOLDER'],
+    max_bytes=app.config['CACHE_MAX_BYTES'],
+    ttl=app.config['CACHE_TTL'],
+    enabled=app.config['CACHE_ENABLED']
+)
+job_manager = JobManager(
+    jobs_dir=app.config['JOBS_FOLDER'],
+    max_workers=app.config['JOB_WORKERS'],
+    result_ttl=app.config['JOB_RESULT_TTL'],
+    stale_ttl=app.config['JOB_STALE_TTL'],
+    converter_options={
+        'max_pixels': app.config['IMAGE_MAX_PIXELS'],
+        'large_image_pixels': app.config['IMAGE_LARGE_PIXELS'],
+        'tool_timeout': app.config['PDF_OPTIMIZE_TIMEOUT'],
+        'ghostscript_path': app.config['GHOSTSCRIPT_PATH'],
+        'qpdf_path': app.config['QPDF_PATH'],
+    },
+    remover_options={
+        'model_name': app.config['REMBG_MODEL'],
+        'intra_op_threads': app.config['REMBG_INTRA_OP_THREADS'],
+        'proxy_min_pixels': app.config['REMBG_PROXY_MIN_PIXELS'],
+        'max_working_size': app.config['REMBG_MAX_WORKING_SIZE'],
+        'refine_edges': app.config['REMBG_REFINE_EDGES'],
+    }
+)
+bg_remover = BackgroundRemover(
+    model_name=app.config['REMBG_MODEL'],
+    pool_size=app.config['REMBG_POOL_SIZE'],
+    checkout_timeout=app.config['REMBG_CHECKOUT_TIMEOUT'],
+    intra_op_threads=app.config['REMBG_INTRA_OP_THREADS'],
+    proxy_min_pixels=app.config['REMBG_PROXY_MIN_PIXELS'],
+    max_working_size=app.config['REMBG_MAX_WORKING_SIZE'],
+    refine_edges=app.config['REMBG_REFINE_EDGES']
+)
+image_pipeline = ImagePipeline(converter, bg_remover)
+image_batches = ImageBatchRunner(
+    max_workers=app.config['IMAGE_BATCH_WORKERS'],
+    max_pixels=app.config['IMAGE_MAX_PIXELS'],
+    large_image_pixels=app.config['IMAGE_LARGE_PIXELS']
+)
+admission = AdmissionController(
+    cpu=app.config['ADMISSION_CPU'],
+    memory=app.config['ADMISSION_MEMORY_MB'] * 1024 * 1024,
+    expensive_share=app.config['ADMISSION_EXPENSIVE_SHARE'],
+    expensive_memory=app.config['ADMISSION_EXPENSIVE_MB'] * 1024 * 1024,
+    max_wait=app.config['ADMISSION_MAX_WAIT'],
+    max_waiting_expensive=app.config['ADMISSION_MAX_WAITING_EXPENSIVE']
+)
+request_costs = CostModel(
+    model_name=app.config['REMBG_MODEL'],
+    model_threads=bg_remover.pool.intra_op_threads,
+    render_workers=converter.render_workers,
+    batch_workers=app.config['IMAGE_BATCH_WORKERS'],
+    unknown_pixels=app.config['IMAGE_LARGE_PIXELS']
+)
+
+bg_removal_enabled = 'bg_removal' in app.config['FEATURES']
+if bg_removal_enabled and app.config['REMBG_BATCH_MAX_SIZE'] > 1:
+    bg_remover.enable_batching(app.config['REMBG_BATCH_MAX_SIZE'], app.config['REMBG_BATCH_MAX_WAIT_MS'])
+
+# Spawned job workers re-import this module as __mp_main__; they load models on demand.
+# 'background' warms each serving process after it starts instead of the master, so the
+# server answers /healthz and other features at once while /readyz waits for the model
+if bg_removal_enabled and app.config['REMBG_PRELOAD'] == 'true' and __name__ != '__mp_main__':
+    logger.info(f"Loading '{app.config['REMBG_MODEL']}' model into {app.config['REMBG_POOL_SIZE']} session(s)...")
+    bg_remover.warm_up()
 
 def allowed_file(filename, formats):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in formats
 
+def output_buffer():
+    """Buffer for an encoded result, spilled to disk only past SPILL_THRESHOLD"""
+    return tempfile.SpooledTemporaryFile(max_size=app.config['SPILL_THRESHOLD'])
+
+def rewound(buffer):
+    buffer.seek(0)
+    return buffer
+
+def work_dir(*parts):
+    """This request's own directory (or a subdirectory of it), created on first use and removed after the response"""
+    if 'work_dir' not in g:
+        g.work_dir = storage.create()
+    path = os.path.join(g.work_dir, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def save_upload(file, path):
+    with metrics.span('save'):
+        file.save(path)
+
+@app.before_request
+def check_feature_enabled():
+    # Before anything reads the body of a route this deployment does not serve
+    for feature, endpoints in FEATURE_ENDPOINTS.items():
+        if request.endpoint in endpoints and feature not in app.config['FEATURES']:
+            return jsonify({'error': f"The {feature} feature is disabled on this server"}), 404
+    if bg_removal_enabled and app.config['REMBG_PRELOAD'] == 'background':
+        bg_remover.warm_up_in_background()
+
+@app.before_request
+def check_upload_limit():
+    # Reject oversized uploads before a route starts reading the body
+    limit = request.max_content_length
+    if limit is not None and request.content_length is not None and request.content_length > limit:
+        abort(413)
+
+@app.before_request
+def start_request_metrics():
+    g.started = time.perf_counter()
+    g.operation = request.endpoint or 'unknown'
+    metrics.start_trace(g.operation)
+    REQUESTS_IN_FLIGHT.inc(operation=g.operation)
+    
+    threshold = app.config['PROFILE_SLOW_REQUESTS_MS']
+    if threshold and random.random() < app.config['PROFILE_SAMPLE_RATE'] and profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    
+    # Parse multipart bodies here so that upload time is its own stage
+    if request.mimetype == 'multipart/form-data':
+        with metrics.span('upload'):
+            request.files
+
+@app.before_request
+def attach_uploads():
+    """Hand finished chunked uploads named by upload_id (the 'file' field) or upload_ids
+    (the 'files' field, comma-separated or repeated) to routes as if they were uploaded files"""
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        return None
+    if request.mimetype not in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        return None
+    single = request.form.get('upload_id')
+    multiple = [part.strip() for value in request.form.getlist('upload_ids') for part in value.split(',') if part.strip()]
+    if not (single or multiple):
+        return None
+    
+    files = MultiDict(request.files)
+    g.upload_files = []
+    try:
+        for name, ids in (('file', [single] if single else []), ('files', multiple)):
+            if ids:
+                opened = [uploads.open(upload_id, name) for upload_id in ids]
+                g.upload_files.extend(opened)
+                files.setlist(name, opened)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadStateError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    for file in g.upload_files:
+        remember_digest(file.path, file.sha256)
+    request.files = ImmutableMultiDict(files)
+
+@app.before_request
+def admit_request():
+    # After the body is parsed, so costs can be read from the uploads' headers
+    # Only scheduled routes have their body parsed here; a chunk sent as a urlencoded form would be consumed
+    if not app.config['ADMISSION_ENABLED'] or request.endpoint not in OPERATION_COSTS:
+        return None
+    cost = request_costs.estimate(request.endpoint, request.files, request.form)
+    if cost is None:
+        return None
+    try:
+        with metrics.span('queue'):
+            g.admission = admission.acquire(request.endpoint, *cost)
+    except AdmissionRejectedError as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+    ADMISSION_WAIT.observe(g.admission.waited, lane=g.admission.lane)
+
+@app.teardown_request
+def close_uploads(exc):
+    for file in g.pop('upload_files', []):
+        file.close()
+
+@app.teardown_request
+def release_admission(exc):
+    # Streamed responses keep working while they are sent and hand their ticket to the response
+    ticket = g.pop('admission', None)
+    if ticket is not None:
+        ticket.release()
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'started' not in g:
+        return response
+    
+    view_finished = time.perf_counter()
+    view_seconds = view_finished - g.started
+    spans = metrics.end_trace()
+    if spans and 'Server-Timing' not in response.headers:
+        response.headers['Server-Timing'] = server_timing(spans + [('total', view_seconds)])
+    
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+        if view_seconds * 1000 >= app.config['PROFILE_SLOW_REQUESTS_MS']:
+            save_profile(profiler, g.operation, view_seconds)
+    
+    started = g.started
+    operation = g.operation
+    size = metrics.size_bucket(request.content_length)
+    outcome = 'success' if response.status_code < 400 else 'client_error' if response.status_code < 500 else 'server_error'
+    
+    def on_close():
+        # Runs once the body has been sent, so streamed responses are fully counted
+        closed = time.perf_counter()
+        metrics.STAGE_SECONDS.observe(closed - view_finished, operation=operation, stage='send')
+        REQUEST_SECONDS.observe(closed - started, operation=operation, size=size, outcome=outcome)
+        REQUESTS_IN_FLIGHT.dec(operation=operation)
+    
+    if response.direct_passthrough:
+        # send_file bodies go straight to the server's file wrapper, which never calls
+        # close callbacks; count these when the view returns
+        REQUEST_SECONDS.observe(view_seconds, operation=operation, size=size, outcome=outcome)
+        REQUESTS_IN_FLIGHT.dec(operation=operation)
+    else:
+        response.call_on_close(on_close)
+    return response
+
+def save_profile(profiler, operation, seconds):
+    """Write a slow request's profile to PROFILE_FOLDER for inspection with pstats or snakeviz"""
+    try:
+        os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{operation}_{int(seconds * 1000)}ms.prof"
+        profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], name))
+        PROFILES_SAVED.inc(operation=operation)
+        logger.info(f"Saved profile of slow {operation} request ({seconds:.2f}s): {name}")
+    except OSError as e:
+        logger.error(f"Error saving profile: {str(e)}")
+
+def release_when_sent(body, ticket):
+    """Pass a streamed body through, releasing its admission ticket once it is sent or abandoned"""
+    try:
+        yield from body
+    finally:
+        ticket.release()
+
+@app.after_request
+def hold_admission_while_streaming(response):
+    if 'admission' in g and response.is_streamed and not response.direct_passthrough:
+        ticket = g.pop('admission')
+        # Closing releases it; the generator's finally covers bodies read to the end but never closed
+        response.call_on_close(ticket.release)
+        response.response = release_when_sent(response.response, ticket)
+    return response
+
+@app.after_request
+def release_work_dir(response):
+    path = g.pop('work_dir', None)
+    if path is None:
+        return response
+    if response.is_streamed and not response.direct_passthrough:
+        # Generators (streamed ZIPs and merges) read from the directory while sending
+        response.call_on_close(lambda: storage.release(path))
+    else:
+        # Buffered bodies are in memory and send_file has already opened its file
+        storage.release(path)
+    return response
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit = request.max_content_length
+    return jsonify({'error': f'Upload too large, the limit for this endpoint is {limit // (1024 * 1024)}MB'}), 413
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: every enabled feature can serve traffic; background removal once its model is warm"""
+    features = {feature: 'ready' for feature in sorted(app.config['FEATURES'])}
+    if bg_removal_enabled and app.config['REMBG_PRELOAD'] != 'false':
+        features['bg_removal'] = bg_remover.readiness()
+    ready = all(state == 'ready' for state in features.values())
+    return jsonify({'status': 'ready' if ready else 'starting', 'features': features}), 200 if ready else 503
+
+# Chunked Upload Routes
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    filename = secure_filename(request.form.get('filename', '') or request.args.get('filename', ''))
+    size = request.form.get('size', type=int) or request.args.get('size', type=int)
+    if not filename:
+        return jsonify({'error': 'A filename is required'}), 400
+    
+    try:
+        upload = uploads.create(filename, size)
+    except UploadStateError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    response = jsonify(uploads.status(upload))
+    response.headers['Location'] = f"/uploads/{upload['id']}"
+    response.headers['Upload-Offset'] = '0'
+    return response, 201
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'The chunk offset must be given as an Upload-Offset header or offset argument'}), 400
+    
+    try:
+        with metrics.span('upload'):
+            upload = uploads.append(upload_id, offset, request.stream)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadStateError as e:
+        # The client resumes from the offset the server has
+        response = jsonify({'error': str(e), 'offset': e.offset})
+        response.headers['Upload-Offset'] = str(e.offset)
+        return response, 409
+    
+    response = jsonify(uploads.status(upload))
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    try:
+        upload = uploads.get(upload_id)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    response = jsonify(uploads.status(upload))
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    return response
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    try:
+        with metrics.span('hash'):
+            upload = uploads.finalize(upload_id, request.form.get('sha256') or request.args.get('sha256'))
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadStateError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    return jsonify(uploads.status(upload))
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    try:
+        uploads.delete(upload_id)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    return '', 204
+
 @app.route('/convert', methods=['POST'])
 def convert():
     try:
@@ -40,20 +541,60 @@ def convert():
             logger.error("No file selected")
             return jsonify({'error': 'No file selected'}), 400
         
-        if not allowed_file(file.filename, {'pdf', 'png'}):
+        if not allowed_file(file.filename, {'pdf', 'png', 'jpg', 'jpeg', 'webp'}):
             logger.error(f"Unsupported file type: {file.filename}")
             return jsonify({'error': 'File type not supported'}), 400
         
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        filepath = os.path.join(work_dir(), filename)
         logger.info(f"Saving file to: {filepath}")
-        file.save(filepath)
+        save_upload(file, filepath)
         
-        logger.info(f"Converting file: {filepath}")
-        output_path = converter.convert_pdf_to_png(filepath) if filename.endswith('.pdf') else converter.convert_png_to_pdf(filepath)
+        if filename.endswith('.pdf'):
+            dpi = request.form.get('dpi', type=int, default=200)
+            width = request.form.get('width', type=int)
+            height = request.form.get('height', type=int)
+            size = (width, height) if (width or height) else None
+            if not 10 <= dpi <= 1200:
+                return jsonify({'error': 'DPI must be between 10 and 1200'}), 400
+            
+            try:
+                pages = parse_page_ranges(request.form.get('pages', '1'), converter.get_pdf_page_count(filepath))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            if len(pages) > 1:
+                logger.info(f"Rendering {len(pages)} pages of {filepath}")
+                name = os.path.splitext(filename)[0]
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                pages_dir = work_dir('pages')
+                
+                rendered = converter.render_pdf_pages(filepath, pages_dir, pages, dpi=dpi, size=size)
+                entries = ((f'{name}_page_{page:04d}.png', path) for page, path in rendered)
+                return Response(
+                    stream_zip(entries),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={name}_pages.zip'}
+                )
+            
+            logger.info(f"Converting page {pages[0]} of {filepath}")
+            output_filename = os.path.splitext(filename)[0] + '.png'
+            output_path = result_cache.fetch(
+                'convert_pdf_to_png', [filepath], {'page': pages[0], 'dpi': dpi, 'size': size},
+                lambda: converter.convert_pdf_to_png(filepath, page=pages[0], dpi=dpi, size=size, output_dir=work_dir('output'))
+            )
+        else:
+            logger.info(f"Converting file: {filepath}")
+            output_filename = os.path.splitext(filename)[0] + '.pdf'
+            output_path = os.path.join(work_dir('output'), output_filename)
+            output_path = result_cache.fetch(
+                'images_to_pdf', [filepath], {},
+                lambda: output_path if converter.images_to_pdf([filepath], output_path) else None
+            )
+            if not output_path:
+                return jsonify({'error': 'Failed to convert image to PDF'}), 500
         logger.info(f"Conversion complete. Output path: {output_path}")
         
-        output_filename = os.path.basename(output_path)
         logger.info(f"Sending file: {output_filename}")
         return send_file(
             output_path,
@@ -85,18 +626,29 @@ def remove_background():
             return jsonify({'error': 'File type not supported. Please upload PNG, JPG, or WEBP'}), 400
         
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        logger.info(f"Saving file to: {filepath}")
-        file.save(filepath)
+        output_filename = f'{os.path.splitext(filename)[0]}_nobg.png'
+        refine_edges = request.form.get('refine_edges', str(bg_remover.refine_edges)).lower() == 'true'
         
-        logger.info(f"Removing background from: {filepath}")
-        output_path = bg_remover.remove_background(filepath)
-        logger.info(f"Background removal complete. Output path: {output_path}")
+        try:
+            options = parse_background_options()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if options:
+            return replace_background(file, filename, refine_edges, options)
+        
+        logger.info(f"Removing background from: {filename}")
+        output = output_buffer()
+        result = result_cache.fetch(
+            'remove_background', [file.stream],
+            {'model': bg_remover.pool.model_name, 'refine_edges': refine_edges,
+             'proxy': [bg_remover.proxy_min_pixels, bg_remover.max_working_size]},
+            lambda: rewound(bg_remover.remove_background(file.stream, output, refine_edges))
+        )
+        logger.info("Background removal complete")
         
-        output_filename = os.path.basename(output_path)
         logger.info(f"Sending file: {output_filename}")
         return send_file(
-            output_path,
+            result,
             as_attachment=True,
             download_name=output_filename,
             mimetype='application/octet-stream'
@@ -107,6 +659,152 @@ def remove_background():
         logger.error(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+def parse_background_options():
+    """Read and validate the background replacement fields; empty when only the cut-out is wanted"""
+    template = request.files.get('background_image')
+    background = request.form.get('background', 'template' if template else 'transparent').strip().lower()
+    autocrop = request.form.get('autocrop', 'false').lower() == 'true'
+    shadow = request.form.get('shadow', 'false').lower() == 'true'
+    format = request.form.get('format', 'png' if background == 'transparent' else 'jpeg').lower()
+    if background == 'transparent' and not (autocrop or shadow) and format == 'png':
+        return {}
+    
+    if background == 'template':
+        if not (template and allowed_file(template.filename, {'png', 'jpg', 'jpeg', 'webp'})):
+            raise ValueError('A template background needs a PNG, JPG or WEBP background_image')
+    elif background not in ('transparent', 'blur'):
+        parse_color(background)
+    if format not in BG_OUTPUT_FORMATS:
+        raise ValueError('Format must be png, jpeg or webp')
+    
+    options = {
+        'background': background,
+        'blur_radius': request.form.get('blur_radius', type=int),
+        'autocrop': autocrop,
+        'padding': request.form.get('padding', type=float, default=0.05),
+        'shadow': shadow,
+        'shadow_opacity': request.form.get('shadow_opacity', type=float, default=0.5),
+        'format': BG_OUTPUT_FORMATS[format],
+        'quality': request.form.get('quality', type=int, default=90),
+    }
+    if options['blur_radius'] is not None and not 1 <= options['blur_radius'] <= 500:
+        raise ValueError('Blur radius must be between 1 and 500 pixels')
+    if not 0 <= options['padding'] <= 1:
+        raise ValueError('Padding must be between 0 and 1')
+    if not 0 <= options['shadow_opacity'] <= 1:
+        raise ValueError('Shadow opacity must be between 0 and 1')
+    if not 1 <= options['quality'] <= 100:
+        raise ValueError('Quality must be between 1 and 100')
+    return options
+
+def replace_background(file, filename, refine_edges, options):
+    """Cut out the subject of an upload and send it on the requested background"""
+    template = request.files.get('background_image') if options['background'] == 'template' else None
+    extension = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}[options['format']]
+    output_filename = f'{os.path.splitext(filename)[0]}_{options["background"].lstrip("#")}.{extension}'
+    
+    logger.info(f"Replacing background of {filename} with {options['background']}")
+    inputs = [file.stream] + ([template.stream] if template else [])
+    params = dict(options, model=bg_remover.pool.model_name, refine_edges=refine_edges,
+                  proxy=[bg_remover.proxy_min_pixels, bg_remover.max_working_size])
+    
+    def run():
+        output = output_buffer()
+        template_image = converter.open_image(template.stream) if template else None
+        bg_remover.replace_background(file.stream, output, template=template_image, refine_edges=refine_edges, **options)
+        return rewound(output)
+    
+    result = result_cache.fetch('replace_background', inputs, params, run)
+    return send_file(result, as_attachment=True, download_name=output_filename)
+
+@app.route('/remove-background/batch', methods=['POST'])
+def remove_background_batch():
+    try:
+        if 'files' not in request.files:
+            return jsonify({'error': 'No files uploaded'}), 400
+        
+        files = request.files.getlist('files')
+        if not files or any(file.filename == '' for file in files):
+            return jsonify({'error': 'No file selected'}), 400
+        
+        input_paths = []
+        for index, file in enumerate(files):
+            if not bg_remover.is_supported(file.filename):
+                return jsonify({'error': 'File type not supported. Please upload PNG, JPG, or WEBP'}), 400
+            # Numbered so that uploads sharing a filename do not overwrite each other
+            filepath = os.path.join(work_dir('input'), f'{index:04d}_{secure_filename(file.filename)}')
+            save_upload(file, filepath)
+            input_paths.append(filepath)
+        
+        logger.info(f"Removing background from {len(input_paths)} images")
+        output_paths = bg_remover.remove_background_batch(input_paths, work_dir('output'))
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        zip_path = os.path.join(work_dir(), f'nobg_{timestamp}.zip')
+        with zipfile.ZipFile(zip_path, 'w') as archive:
+            for output_path in output_paths:
+                # PNG data is already compressed; the number prefix keeps duplicate names apart
+                archive.write(output_path, os.path.basename(output_path), compress_type=zipfile.ZIP_STORED)
+        
+        return send_file(zip_path, as_attachment=True)
+    
+    except Exception as e:
+        logger.error(f"Error during batch background removal: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/remove-background/stats', methods=['GET'])
+def remove_background_stats():
+    return jsonify(bg_remover.stats())
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    return jsonify(storage.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics of this worker process, with pool, session and cache gauges refreshed"""
+    rembg = bg_remover.stats()
+    for state in ('in_use', 'idle'):
+        SESSIONS.set(rembg[state], state=state)
+    SESSION_QUEUE_DEPTH.set(rembg['queue_depth'])
+    if 'batching' in rembg:
+        BATCH_PENDING.set(rembg['batching']['pending'])
+    
+    jobs = job_manager.stats()
+    JOB_WORKERS.set(jobs['max_workers'])
+    for operation, active in jobs['active'].items():
+        JOBS_ACTIVE.set(active, operation=operation)
+    
+    cache = result_cache.stats()
+    for name in ('entries', 'bytes', 'hits', 'misses', 'evictions'):
+        CACHE_STATS.set(cache[name], stat=name)
+    
+    usage = storage.stats()
+    for name in ('bytes', 'max_bytes', 'directories', 'active', 'created', 'released', 'swept'):
+        STORAGE_STATS.set(usage[name], stat=name)
+    
+    tools = converter.tools.stats()
+    for name in ('size', 'running', 'waiting', 'runs', 'timeouts', 'failures', 'busy_rejections'):
+        PDF_TOOL_STATS.set(tools[name], stat=name)
+    
+    batches = image_batches.stats()
+    for name in ('max_workers', 'running_batches', 'items', 'failed_items'):
+        IMAGE_BATCH_STATS.set(batches[name], stat=name)
+    
+    budget = admission.stats()
+    ADMISSION_STATS.set(budget['cpu'], lane='all', stat='cpu_budget')
+    ADMISSION_STATS.set(budget['memory'], lane='all', stat='memory_budget')
+    for lane in LANES:
+        for name, value in budget['lanes'][lane].items():
+            ADMISSION_STATS.set(value, lane=lane, stat=name)
+    
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/combine-pdf', methods=['POST'])
 def combine_pdf():
     try:
@@ -120,23 +818,47 @@ def combine_pdf():
         if len(files) < 2:
             return jsonify({'error': 'At least 2 PDF files are required'}), 400
         
-        pdf_paths = []
-        for file in files:
-            if file and allowed_file(file.filename, {'pdf'}):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                pdf_paths.append(filepath)
-            else:
-                return jsonify({'error': 'Invalid file type. Only PDF files are allowed'}), 400
+        if not all(file and allowed_file(file.filename, {'pdf'}) for file in files):
+            return jsonify({'error': 'Invalid file type. Only PDF files are allowed'}), 400
         
         # Generate output filename with timestamp
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], f'combined_{timestamp}.pdf')
+        
+        streaming = request.form.get('streaming')
+        if streaming is None:
+            streaming = len(files) >= app.config['COMBINE_STREAMING_MIN_FILES']
+        else:
+            streaming = streaming.lower() == 'true'
+        
+        # Numbered so that uploads sharing a filename do not overwrite each other
+        pdf_paths = []
+        for index, file in enumerate(files):
+            filepath = os.path.join(work_dir('input'), f'{index:04d}.pdf')
+            save_upload(file, filepath)
+            pdf_paths.append(filepath)
+        
+        if streaming:
+            # Merge page by page straight into the response
+            def generate():
+                try:
+                    yield from iter_merged_pdf(pdf_paths)
+                except Exception as e:
+                    logger.error(f"Error streaming combined PDF: {str(e)}")
+                    raise
+            
+            return Response(generate(), mimetype='application/pdf', headers={
+                'Content-Disposition': f'attachment; filename=combined_{timestamp}.pdf'
+            })
+        
+        output_path = os.path.join(work_dir(), f'combined_{timestamp}.pdf')
         
         # Combine PDFs
-        if converter.combine_pdfs(pdf_paths, output_path):
-            return send_file(output_path, as_attachment=True)
+        result_path = result_cache.fetch(
+            'combine_pdfs', pdf_paths, {},
+            lambda: output_path if converter.combine_pdfs(pdf_paths, output_path) else None
+        )
+        if result_path:
+            return send_file(result_path, as_attachment=True, download_name=os.path.basename(output_path))
         else:
             return jsonify({'error': 'Failed to combine PDFs'}), 500
             
@@ -144,6 +866,66 @@ def combine_pdf():
         logger.error(f"Error in combine_pdf: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/images-to-pdf', methods=['POST'])
+def images_to_pdf():
+    try:
+        page_size = request.form.get('page_size', 'image').lower()
+        orientation = request.form.get('orientation', 'auto').lower()
+        fit = request.form.get('fit', 'contain').lower()
+        margin = request.form.get('margin', type=float, default=0)  # points
+        
+        if page_size != 'image' and page_size not in PAGE_SIZES:
+            return jsonify({'error': f"Invalid page size. Must be image or one of {', '.join(PAGE_SIZES)}"}), 400
+        if orientation not in ORIENTATIONS:
+            return jsonify({'error': f"Invalid orientation. Must be one of {', '.join(ORIENTATIONS)}"}), 400
+        if fit not in FITS:
+            return jsonify({'error': f"Invalid fit. Must be one of {', '.join(FITS)}"}), 400
+        if not 0 <= margin <= 144:
+            return jsonify({'error': 'Margin must be between 0 and 144 points'}), 400
+        
+        # Images in upload order, ZIPs unpacked in place
+        try:
+            items = save_batch_uploads()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Headers only, so a bad image is reported before the first page is sent
+        for name, path in items:
+            try:
+                img = converter.open_image(path)
+            except OSError:
+                return jsonify({'error': f'{name} is not a valid image'}), 400
+            with img:
+                if img.format not in ('JPEG', 'PNG', 'WEBP'):
+                    return jsonify({'error': f'{name} is not a PNG, JPEG or WebP image'}), 400
+                if img.format != 'JPEG':
+                    converter.check_pixels(img.size)
+        
+        image_paths = [path for _, path in items]
+        options = {'page_size': page_size, 'orientation': orientation, 'fit': fit, 'margin': margin,
+                   'check_pixels': converter.check_pixels}
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        logger.info(f"Assembling {len(image_paths)} images into a PDF")
+        
+        # Pages are written to the response as each image is embedded
+        def generate():
+            try:
+                yield from iter_images_pdf(image_paths, **options)
+            except Exception as e:
+                logger.error(f"Error streaming images PDF: {str(e)}")
+                raise
+        
+        return Response(generate(), mimetype='application/pdf', headers={
+            'Content-Disposition': f'attachment; filename=images_{timestamp}.pdf',
+            'X-Batch-Items': str(len(image_paths))
+        })
+    
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        logger.error(f"Error in images_to_pdf: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/split-pdf', methods=['POST'])
 def split_pdf():
     try:
@@ -153,15 +935,34 @@ def split_pdf():
         file = request.files['file']
         start_page = int(request.form.get('start_page', 1))
         end_page = int(request.form.get('end_page', 1))
+        ranges = request.form.get('ranges')  # e.g. '1-3,4-6,9-', one PDF per range
+        every = request.form.get('every', type=int)  # burst into parts of N pages
         
         if file and allowed_file(file.filename, {'pdf'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
+            input_path = os.path.join(work_dir(), filename)
+            save_upload(file, input_path)
             
-            output_path = converter.split_pdf(input_path, app.config['OUTPUT_FOLDER'], start_page, end_page)
+            if ranges or every is not None:
+                parts = converter.split_pdf_parts(input_path, work_dir('parts'), ranges, every)
+                try:
+                    first = next(parts)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                
+                name = os.path.splitext(filename)[0]
+                return Response(
+                    stream_zip(itertools.chain([first], parts)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={name}_split.zip'}
+                )
+            
+            output_path = result_cache.fetch(
+                'split_pdf', [input_path], {'start_page': start_page, 'end_page': end_page},
+                lambda: converter.split_pdf(input_path, work_dir('output'), start_page, end_page)
+            )
             if output_path:
-                return send_file(output_path, as_attachment=True)
+                return send_file(output_path, as_attachment=True, download_name=f'split_{start_page}-{end_page}.pdf')
             else:
                 return jsonify({'error': 'Failed to split PDF'}), 500
         else:
@@ -179,6 +980,8 @@ def rotate_pdf():
         
         file = request.files['file']
         rotation = int(request.form.get('rotation', 90))  # Default to 90 degrees
+        pages = request.form.get('pages') or None  # e.g. '1-3,7'; all pages if omitted
+        rotations = request.form.get('rotations') or None  # per-page angles, e.g. '2:90,5-6:180'
         
         # Validate rotation
         if rotation not in [90, 180, 270]:
@@ -186,15 +989,22 @@ def rotate_pdf():
         
         if file and allowed_file(file.filename, {'pdf'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
+            input_path = os.path.join(work_dir(), filename)
+            save_upload(file, input_path)
             
             # Generate output filename with timestamp
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], f'rotated_{timestamp}.pdf')
+            output_path = os.path.join(work_dir('output'), f'rotated_{timestamp}.pdf')
             
-            if converter.rotate_pdf(input_path, output_path, rotation):
-                return send_file(output_path, as_attachment=True)
+            try:
+                result_path = result_cache.fetch(
+                    'rotate_pdf', [input_path], {'rotation': rotation, 'pages': pages, 'rotations': rotations},
+                    lambda: output_path if converter.rotate_pdf(input_path, output_path, rotation, pages, rotations) else None
+                )
+            except PageSelectionError as e:
+                return jsonify({'error': str(e)}), 400
+            if result_path:
+                return send_file(result_path, as_attachment=True, download_name=os.path.basename(output_path))
             else:
                 return jsonify({'error': 'Failed to rotate PDF'}), 500
         else:
@@ -204,6 +1014,80 @@ def rotate_pdf():
         logger.error(f"Error in rotate_pdf: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/compress-pdf', methods=['POST'])
+def compress_pdf():
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+        
+        file = request.files['file']
+        preset = request.form.get('preset', 'ebook').lower()
+        dpi = request.form.get('dpi', type=int)  # overrides the preset's image resolution
+        quality = request.form.get('quality', type=int)  # overrides the preset's JPEG quality
+        subset_fonts = request.form.get('subset_fonts', 'true').lower() == 'true'
+        object_streams = request.form.get('object_streams', 'true').lower() == 'true'
+        
+        if preset not in PDF_PRESETS:
+            return jsonify({'error': f"Invalid preset. Must be one of {', '.join(PDF_PRESETS)}"}), 400
+        if dpi is not None and not 36 <= dpi <= 1200:
+            return jsonify({'error': 'DPI must be between 36 and 1200'}), 400
+        if quality is not None and not 1 <= quality <= 100:
+            return jsonify({'error': 'Quality must be between 1 and 100'}), 400
+        
+        if file and allowed_file(file.filename, {'pdf'}):
+            filename = secure_filename(file.filename)
+            input_path = os.path.join(work_dir(), filename)
+            save_upload(file, input_path)
+            output_path = os.path.join(work_dir('output'), f'compressed_{filename}')
+            
+            started = time.perf_counter()
+            result_path = result_cache.fetch(
+                'compress_pdf', [input_path],
+                {'preset': preset, 'dpi': dpi, 'quality': quality, 'subset_fonts': subset_fonts, 'object_streams': object_streams},
+                lambda: output_path if converter.optimize_pdf(input_path, output_path, preset, dpi, quality,
+                                                              subset_fonts, object_streams) else None
+            )
+            if not result_path:
+                return jsonify({'error': 'Failed to compress PDF'}), 500
+            
+            # A cache hit is an open file rather than a path
+            output_bytes = os.path.getsize(result_path) if isinstance(result_path, str) else os.fstat(result_path.fileno()).st_size
+            input_bytes = os.path.getsize(input_path)
+            logger.info(f"Compressed {filename} from {input_bytes} to {output_bytes} bytes")
+            response = send_file(result_path, as_attachment=True, download_name=os.path.basename(output_path))
+            response.headers['X-Compression-Original-Bytes'] = str(input_bytes)
+            response.headers['X-Compression-Output-Bytes'] = str(output_bytes)
+            response.headers['X-Compression-Seconds'] = f'{time.perf_counter() - started:.3f}'
+            return response
+        else:
+            return jsonify({'error': 'Invalid file type. Only PDF files are allowed'}), 400
+    
+    except ToolBusyError as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(app.config['JOB_RETRY_AFTER'])
+        return response, 503
+    except ToolTimeoutError as e:
+        return jsonify({'error': str(e)}), 504
+    except Exception as e:
+        logger.error(f"Error in compress_pdf: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def parse_watermark_options():
+    """Read and validate the optional watermark style fields"""
+    options = {
+        'font': request.form.get('font', 'Helvetica'),
+        'size': request.form.get('font_size', type=float, default=60),
+        'opacity': request.form.get('opacity', type=float, default=0.3),
+        'angle': request.form.get('angle', type=float, default=45),
+    }
+    if options['font'] not in WATERMARK_FONTS:
+        raise ValueError(f"Font must be one of {', '.join(WATERMARK_FONTS)}")
+    if not 1 <= options['size'] <= 500:
+        raise ValueError('Font size must be between 1 and 500')
+    if not 0 <= options['opacity'] <= 1:
+        raise ValueError('Opacity must be between 0 and 1')
+    return options
+
 @app.route('/add-watermark', methods=['POST'])
 def add_watermark():
     try:
@@ -216,16 +1100,25 @@ def add_watermark():
         if not watermark_text:
             return jsonify({'error': 'No watermark text provided'}), 400
         
+        try:
+            options = parse_watermark_options()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         if file and allowed_file(file.filename, {'pdf'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
+            input_path = os.path.join(work_dir(), filename)
+            save_upload(file, input_path)
             
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], f'watermarked_{timestamp}.pdf')
+            output_path = os.path.join(work_dir('output'), f'watermarked_{timestamp}.pdf')
             
-            if converter.add_watermark(input_path, output_path, watermark_text):
-                return send_file(output_path, as_attachment=True)
+            result_path = result_cache.fetch(
+                'add_watermark', [input_path], dict(options, watermark_text=watermark_text),
+                lambda: output_path if converter.add_watermark(input_path, output_path, watermark_text, **options) else None
+            )
+            if result_path:
+                return send_file(result_path, as_attachment=True, download_name=os.path.basename(output_path))
             else:
                 return jsonify({'error': 'Failed to add watermark'}), 500
         else:
@@ -252,19 +1145,24 @@ def resize_image():
         
         if file and allowed_file(file.filename, {'png', 'jpg', 'jpeg', 'webp'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
-            
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], f'resized_{timestamp}_{filename}')
+            output_filename = f'resized_{timestamp}_{filename}'
+            output_format = IMAGE_FORMATS[os.path.splitext(file.filename)[1].lower()]
             
-            if converter.resize_image(input_path, output_path, width, height, maintain_aspect):
-                return send_file(output_path, as_attachment=True)
+            output = output_buffer()
+            result = result_cache.fetch(
+                'resize_image', [file.stream], {'width': width, 'height': height, 'maintain_aspect': maintain_aspect, 'format': output_format},
+                lambda: rewound(output) if converter.resize_image(file.stream, output, width, height, maintain_aspect, format=output_format) else None
+            )
+            if result:
+                return send_file(result, as_attachment=True, download_name=output_filename)
             else:
                 return jsonify({'error': 'Failed to resize image'}), 500
         else:
             return jsonify({'error': 'Invalid file type. Only PNG, JPG, JPEG, and WEBP files are allowed'}), 400
             
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         logger.error(f"Error in resize_image: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -286,19 +1184,24 @@ def crop_image():
         
         if file and allowed_file(file.filename, {'png', 'jpg', 'jpeg', 'webp'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
-            
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], f'cropped_{timestamp}_{filename}')
+            output_filename = f'cropped_{timestamp}_{filename}'
+            output_format = IMAGE_FORMATS[os.path.splitext(file.filename)[1].lower()]
             
-            if converter.crop_image(input_path, output_path, left, top, right, bottom):
-                return send_file(output_path, as_attachment=True)
+            output = output_buffer()
+            result = result_cache.fetch(
+                'crop_image', [file.stream], {'box': [left, top, right, bottom], 'format': output_format},
+                lambda: rewound(output) if converter.crop_image(file.stream, output, left, top, right, bottom, format=output_format) else None
+            )
+            if result:
+                return send_file(result, as_attachment=True, download_name=output_filename)
             else:
                 return jsonify({'error': 'Failed to crop image'}), 500
         else:
             return jsonify({'error': 'Invalid file type. Only PNG, JPG, JPEG, and WEBP files are allowed'}), 400
             
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         logger.error(f"Error in crop_image: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -320,20 +1223,23 @@ def convert_image():
         
         if file and allowed_file(file.filename, {'png', 'jpg', 'jpeg', 'webp'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
-            
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             output_filename = f'{os.path.splitext(filename)[0]}_{timestamp}.{target_format}'
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
             
-            if converter.convert_image_format(input_path, output_path):
-                return send_file(output_path, as_attachment=True)
+            output = output_buffer()
+            result = result_cache.fetch(
+                'convert_image_format', [file.stream], {'format': target_format},
+                lambda: rewound(output) if converter.convert_image_format(file.stream, output, format=target_format) else None
+            )
+            if result:
+                return send_file(result, as_attachment=True, download_name=output_filename)
             else:
                 return jsonify({'error': 'Failed to convert image'}), 500
         else:
             return jsonify({'error': 'Invalid file type. Only PNG, JPG, JPEG, and WEBP files are allowed'}), 400
             
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         logger.error(f"Error in convert_image: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -346,35 +1252,345 @@ def compress_image():
         
         file = request.files['file']
         quality = request.form.get('quality', type=int, default=80)
+        target_kb = request.form.get('target_kb', type=float)  # compress to at most this size instead
         
         if not 1 <= quality <= 100:
             return jsonify({'error': 'Quality must be between 1 and 100'}), 400
+        if target_kb is not None and target_kb <= 0:
+            return jsonify({'error': 'target_kb must be positive'}), 400
         
         if file and allowed_file(file.filename, {'png', 'jpg', 'jpeg', 'webp'}):
             filename = secure_filename(file.filename)
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(input_path)
-            
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], f'compressed_{timestamp}_{filename}')
+            output_filename = f'compressed_{timestamp}_{filename}'
+            output_format = IMAGE_FORMATS[os.path.splitext(file.filename)[1].lower()]
             
-            if converter.compress_image(input_path, output_path, quality):
-                return send_file(output_path, as_attachment=True)
+            if target_kb is not None:
+                # 'auto' tries both JPEG and WebP; PNGs are re-encoded as JPEG unless a format is given
+                requested = request.form.get('format', '').lower()
+                if requested == 'auto':
+                    formats = ('JPEG', 'WEBP')
+                elif requested:
+                    if '.' + requested not in IMAGE_FORMATS or requested == 'png':
+                        return jsonify({'error': 'Format must be JPG, JPEG, WEBP or auto'}), 400
+                    formats = (IMAGE_FORMATS['.' + requested],)
+                else:
+                    formats = ('WEBP',) if output_format == 'WEBP' else ('JPEG',)
+                max_trials = min(request.form.get('max_trials', type=int, default=app.config['COMPRESS_MAX_TRIALS']),
+                                 app.config['COMPRESS_MAX_TRIALS'])
+                
+                output = output_buffer()
+                info = converter.compress_to_size(file.stream, output, int(target_kb * 1024), formats, max(1, max_trials))
+                if info is None:
+                    return jsonify({'error': 'Failed to compress image'}), 500
+                
+                extension = {'JPEG': 'jpg', 'WEBP': 'webp'}[info['format']]
+                response = send_file(rewound(output), as_attachment=True,
+                                     download_name=f'{os.path.splitext(output_filename)[0]}.{extension}')
+                response.headers['X-Compression-Format'] = info['format']
+                response.headers['X-Compression-Quality'] = str(info['quality'])
+                response.headers['X-Compression-Trials'] = str(info['trials'])
+                response.headers['X-Compression-Target-Met'] = 'true' if info['fits'] else 'false'
+                return response
+            
+            output = output_buffer()
+            result = result_cache.fetch(
+                'compress_image', [file.stream], {'quality': quality, 'format': output_format},
+                lambda: rewound(output) if converter.compress_image(file.stream, output, quality, format=output_format) else None
+            )
+            if result:
+                return send_file(result, as_attachment=True, download_name=output_filename)
             else:
                 return jsonify({'error': 'Failed to compress image'}), 500
         else:
             return jsonify({'error': 'Invalid file type. Only PNG, JPG, JPEG, and WEBP files are allowed'}), 400
             
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         logger.error(f"Error in compress_image: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-if __name__ == '__main__':
-    # Create required directories
-    logger.info("Creating required directories...")
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+@app.route('/pipeline', methods=['POST'])
+def run_pipeline():
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+        
+        file = request.files['file']
+        if not (file and allowed_file(file.filename, {'png', 'jpg', 'jpeg', 'webp'})):
+            return jsonify({'error': 'Invalid file type. Only PNG, JPG, JPEG, and WEBP files are allowed'}), 400
+        
+        try:
+            operations = parse_operations(request.form.get('operations', ''))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not bg_removal_enabled and any(stage['op'] == 'remove-background' for stage in operations):
+            return jsonify({'error': 'The bg_removal feature is disabled on this server'}), 404
+        
+        output = output_buffer()
+        input_format = IMAGE_FORMATS[os.path.splitext(file.filename)[1].lower()]
+        output_format, timings = image_pipeline.run(file.stream, output, operations, format=input_format)
+        logger.info(f"Pipeline {[stage['op'] for stage in operations]} finished in {sum(t for _, t in timings):.3f}s")
+        
+        extension = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}[output_format]
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        response = send_file(
+            rewound(output),
+            as_attachment=True,
+            download_name=f'{os.path.splitext(secure_filename(file.filename))[0]}_{timestamp}.{extension}'
+        )
+        response.headers['Server-Timing'] = server_timing(timings)
+        return response
+    
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in pipeline: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+# Batch Image Routes
+def save_batch_uploads():
+    """Save the uploaded images, unpacking any ZIP among them, into this request's input directory"""
+    files = request.files.getlist('files')
+    if not files or any(file.filename == '' for file in files):
+        raise ValueError('No files uploaded')
+    
+    items = []
+    for file in files:
+        extension = os.path.splitext(file.filename)[1].lower()
+        if extension == '.zip':
+            with metrics.span('unzip'):
+                items.extend(extract_images(
+                    file.stream, work_dir('input'), {'png', 'jpg', 'jpeg', 'webp'}, start=len(items),
+                    max_files=app.config['IMAGE_BATCH_MAX_FILES'] - len(items),
+                    max_bytes=app.config['IMAGE_BATCH_MAX_UNZIPPED']
+                ))
+        elif allowed_file(file.filename, {'png', 'jpg', 'jpeg', 'webp'}):
+            # Numbered, since the names of a batch need not be unique or ASCII
+            filepath = os.path.join(work_dir('input'), f'{len(items):04d}{extension}')
+            save_upload(file, filepath)
+            items.append((file.filename, filepath))
+        else:
+            raise ValueError(f'Invalid file type: {file.filename}. Only PNG, JPG, JPEG, WEBP and ZIP files are allowed')
+        if len(items) > app.config['IMAGE_BATCH_MAX_FILES']:
+            raise ValueError(f"Too many images, the limit is {app.config['IMAGE_BATCH_MAX_FILES']}")
+    
+    if not items:
+        raise ValueError('No images found in the upload')
+    return items
+
+def image_batch(operation, params):
+    """Run an image operation over every uploaded file and stream back a ZIP with a manifest of per-file errors"""
+    try:
+        items = save_batch_uploads()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    logger.info(f"Running batch {operation} over {len(items)} images")
+    results = image_batches.run(operation, items, params, work_dir('output'))
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # Results are already compressed images, so they are stored as-is
+    return Response(
+        stream_zip(results),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={operation}_{timestamp}.zip',
+                 'X-Batch-Items': str(len(items))}
+    )
+
+@app.route('/resize-image/batch', methods=['POST'])
+def resize_image_batch():
+    try:
+        width = request.form.get('width', type=int)
+        height = request.form.get('height', type=int)
+        maintain_aspect = request.form.get('maintain_aspect', 'true').lower() == 'true'
+        
+        if not (width or height):
+            return jsonify({'error': 'Width or height must be specified'}), 400
+        
+        return image_batch('resize_image', {'width': width, 'height': height, 'maintain_aspect': maintain_aspect})
+    
+    except Exception as e:
+        logger.error(f"Error in resize_image_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/crop-image/batch', methods=['POST'])
+def crop_image_batch():
+    try:
+        box = [request.form.get(name, type=int) for name in ('left', 'top', 'right', 'bottom')]
+        
+        if None in box:
+            return jsonify({'error': 'All crop coordinates must be specified'}), 400
+        
+        return image_batch('crop_image', {'box': box})
+    
+    except Exception as e:
+        logger.error(f"Error in crop_image_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/convert-image/batch', methods=['POST'])
+def convert_image_batch():
+    try:
+        target_format = request.form.get('format', '').lower()
+        
+        if not target_format:
+            return jsonify({'error': 'Target format must be specified'}), 400
+        
+        if target_format not in ['png', 'jpg', 'jpeg', 'webp']:
+            return jsonify({'error': 'Invalid target format. Must be PNG, JPG, JPEG, or WEBP'}), 400
+        
+        return image_batch('convert_image_format', {'format': target_format})
+    
+    except Exception as e:
+        logger.error(f"Error in convert_image_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/compress-image/batch', methods=['POST'])
+def compress_image_batch():
+    try:
+        quality = request.form.get('quality', type=int, default=80)
+        target_kb = request.form.get('target_kb', type=float)
+        
+        if not 1 <= quality <= 100:
+            return jsonify({'error': 'Quality must be between 1 and 100'}), 400
+        if target_kb is not None and target_kb <= 0:
+            return jsonify({'error': 'target_kb must be positive'}), 400
+        
+        params = {'quality': quality}
+        if target_kb is not None:
+            # Without a format, each image keeps WebP or becomes JPEG, as for /compress-image
+            requested = request.form.get('format', '').lower()
+            if requested == 'auto':
+                formats = ('JPEG', 'WEBP')
+            elif requested:
+                if '.' + requested not in IMAGE_FORMATS or requested == 'png':
+                    return jsonify({'error': 'Format must be JPG, JPEG, WEBP or auto'}), 400
+                formats = (IMAGE_FORMATS['.' + requested],)
+            else:
+                formats = None
+            max_trials = min(request.form.get('max_trials', type=int, default=app.config['COMPRESS_MAX_TRIALS']),
+                             app.config['COMPRESS_MAX_TRIALS'])
+            params.update(target_bytes=int(target_kb * 1024), formats=formats, max_trials=max(1, max_trials))
+        
+        return image_batch('compress_image', params)
+    
+    except Exception as e:
+        logger.error(f"Error in compress_image_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Asynchronous Job Routes
+def parse_job_params(operation):
+    """Read and validate the form parameters of a job operation"""
+    if operation == 'remove_background':
+        return {'model': bg_remover.pool.model_name}
+    if operation == 'convert_pdf_to_png':
+        return {'page': request.form.get('page', type=int, default=1), 'dpi': request.form.get('dpi', type=int, default=200)}
+    if operation == 'split_pdf':
+        return {'start_page': int(request.form.get('start_page', 1)), 'end_page': int(request.form.get('end_page', 1)),
+                'ranges': request.form.get('ranges') or None, 'every': request.form.get('every', type=int)}
+    if operation == 'rotate_pdf':
+        rotation = int(request.form.get('rotation', 90))
+        if rotation not in [90, 180, 270]:
+            raise ValueError('Invalid rotation. Must be 90, 180, or 270 degrees')
+        return {'rotation': rotation, 'pages': request.form.get('pages') or None,
+                'rotations': request.form.get('rotations') or None}
+    if operation == 'add_watermark':
+        watermark_text = request.form.get('watermark_text', '')
+        if not watermark_text:
+            raise ValueError('No watermark text provided')
+        return dict(parse_watermark_options(), watermark_text=watermark_text)
+    return {}
+
+@app.route('/jobs/<operation>', methods=['POST'])
+def submit_job(operation):
+    try:
+        if operation not in job_manager.queue_limits:
+            return jsonify({'error': f'Unknown operation: {operation}'}), 404
+        feature = 'bg_removal' if operation == 'remove_background' else 'pdf'
+        if feature not in app.config['FEATURES']:
+            return jsonify({'error': f"The {feature} feature is disabled on this server"}), 404
+        
+        files = request.files.getlist('files') if operation == 'combine_pdfs' else request.files.getlist('file')[:1]
+        if not files or any(file.filename == '' for file in files):
+            return jsonify({'error': 'No file uploaded'}), 400
+        if operation == 'combine_pdfs' and len(files) < 2:
+            return jsonify({'error': 'At least 2 PDF files are required'}), 400
+        
+        formats = {'png', 'jpg', 'jpeg', 'webp'} if operation == 'remove_background' else {'pdf'}
+        if not all(allowed_file(file.filename, formats) for file in files):
+            return jsonify({'error': f'Invalid file type. Allowed: {", ".join(sorted(formats))}'}), 400
+        
+        try:
+            params = parse_job_params(operation)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            job = job_manager.create(operation, params)
+        except QueueFullError as e:
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = str(app.config['JOB_RETRY_AFTER'])
+            return response, 429
+        
+        try:
+            input_paths = []
+            for index, file in enumerate(files):
+                filepath = os.path.join(job_manager.input_dir(job['id']), f'{index:04d}_{secure_filename(file.filename)}')
+                save_upload(file, filepath)
+                input_paths.append(filepath)
+            
+            name = os.path.splitext(secure_filename(files[0].filename))[0] or 'result'
+            result_name = {
+                'remove_background': f'{name}_nobg.png',
+                'convert_pdf_to_png': f'{name}.png',
+                'combine_pdfs': 'combined.pdf',
+                'split_pdf': f'{name}_split.zip' if params.get('ranges') or params.get('every') is not None
+                             else f'split_{params.get("start_page")}-{params.get("end_page")}.pdf',
+                'rotate_pdf': f'rotated_{name}.pdf',
+                'add_watermark': f'watermarked_{name}.pdf',
+            }[operation]
+            job_manager.submit(job, input_paths, result_name)
+        except Exception:
+            job_manager.release(job)
+            raise
+        
+        logger.info(f"Queued {operation} job {job['id']}")
+        response = jsonify(job_manager.status(job))
+        response.headers['Location'] = f"/jobs/{job['id']}"
+        return response, 202
     
+    except Exception as e:
+        logger.error(f"Error submitting {operation} job: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job_manager.status(job))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': f"Job is {job['status']}", 'status': job['status']}), 409
+    return send_file(os.path.abspath(job_manager.result_path(job)), as_attachment=True, download_name=job['result_name'])
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job_manager.status(job))
+
+if __name__ == '__main__':
     # Start server
     logger.info("Starting Flask server...")
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,221 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.utils import secure_filename
+import multiprocessing
+import threading
+import logging
+import zipfile
+import shutil
+import json
+import time
+import os
+
+# Image operations that can run as a batch, with the file name prefix of their results
+OPERATIONS = {
+    'resize_image': 'resized',
+    'crop_image': 'cropped',
+    'convert_image_format': 'converted',
+    'compress_image': 'compressed',
+}
+
+# Per-process converter used inside pool workers, created by the pool initializer
+_worker_converter = None
+
+def _init_worker(max_pixels, large_image_pixels):
+    global _worker_converter
+    from converter import FileConverter
+    _worker_converter = FileConverter(max_pixels=max_pixels, large_image_pixels=large_image_pixels)
+
+def _process_image(operation, input_path, params, output_stem):
+    """
+    Run one image operation inside a pool worker
+    Args:
+        operation: One of OPERATIONS
+        input_path: Saved upload
+        params: Operation parameters, the same for every item of a batch
+        output_stem: Result path without extension; the extension follows the output format
+    Returns:
+        Path of the result
+    """
+    from converter import IMAGE_FORMATS
+    converter = _worker_converter
+    input_format = IMAGE_FORMATS[os.path.splitext(input_path)[1].lower()]
+    extensions = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+    if operation == 'compress_image' and params.get('target_bytes'):
+        formats = params.get('formats') or (('WEBP',) if input_format == 'WEBP' else ('JPEG',))
+        staging = f'{output_stem}.tmp'
+        info = converter.compress_to_size(input_path, staging, params['target_bytes'], formats, params['max_trials'])
+        if info is None:
+            raise Exception("compress_image failed")
+        output_path = f"{output_stem}.{extensions[info['format']]}"
+        os.replace(staging, output_path)
+        return output_path
+
+    output_format = IMAGE_FORMATS['.' + params['format']] if operation == 'convert_image_format' else input_format
+    output_path = f'{output_stem}.{extensions[output_format]}'
+    if operation == 'resize_image':
+        ok = converter.resize_image(input_path, output_path, params['width'], params['height'],
+                                    params['maintain_aspect'], format=output_format)
+    elif operation == 'crop_image':
+        ok = converter.crop_image(input_path, output_path, *params['box'], format=output_format)
+    elif operation == 'convert_image_format':
+        ok = converter.convert_image_format(input_path, output_path, format=output_format)
+    elif operation == 'compress_image':
+        ok = converter.compress_image(input_path, output_path, params['quality'], format=output_format)
+    else:
+        raise ValueError(f"Unknown operation: {operation}")
+
+    if not ok:
+        raise Exception(f"{operation} failed")
+    return output_path
+
+def extract_images(archive_file, output_dir, extensions, start=0, max_files=None, max_bytes=None):
+    """
+    Unpack the images of an uploaded ZIP, skipping directories and other files
+    Args:
+        archive_file: Path or binary file object of the ZIP
+        output_dir: Where the images are written, numbered from start
+        extensions: Accepted lowercase extensions without the dot
+        max_files: Most images accepted
+        max_bytes: Most uncompressed bytes accepted, checked before anything is written
+    Returns:
+        List of (original name, saved path)
+    """
+    try:
+        archive = zipfile.ZipFile(archive_file)
+    except zipfile.BadZipFile:
+        raise ValueError('Uploaded archive is not a valid ZIP file')
+
+    with archive:
+        members = [info for info in archive.infolist() if not info.is_dir()
+                   and os.path.splitext(info.filename)[1].lower().lstrip('.') in extensions
+                   and not os.path.basename(info.filename).startswith('.')]
+        if max_files is not None and len(members) > max_files:
+            raise ValueError(f'Archive holds {len(members)} images, the limit is {max_files}')
+        # Declared sizes are enforced while reading, so they can be trusted here
+        total = sum(info.file_size for info in members)
+        if max_bytes is not None and total > max_bytes:
+            raise ValueError(f'Archive unpacks to {total} bytes, the limit is {max_bytes}')
+
+        saved = []
+        for index, info in enumerate(members, start):
+            name = os.path.basename(info.filename)
+            path = os.path.join(output_dir, f'{index:04d}{os.path.splitext(name)[1].lower()}')
+            with archive.open(info) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            saved.append((name, path))
+        return saved
+
+class ImageBatchRunner:
+    """Run one image operation over many files on a process pool.
+
+    Decoding, resampling and encoding of separate images run in parallel worker
+    processes, so they do not contend for the web worker's GIL. Only paths and
+    parameters cross the process boundary; inputs and results stay on disk.
+    """
+
+    def __init__(self, max_workers=None, max_pixels=50_000_000, large_image_pixels=16_000_000):
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.max_pixels = max_pixels
+        self.large_image_pixels = large_image_pixels
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._running = 0
+        self._items = 0
+        self._failed = 0
+
+    def _get_pool(self):
+        with self._lock:
+            # A pool inherited from a preloading gunicorn master has no live workers in this process
+            if self._pool is None or self._pool_pid != os.getpid():
+                # Spawned rather than forked: the web process holds native thread pools
+                # (onnxruntime, numba via rembg) that are not safe to fork
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker, initargs=(self.max_pixels, self.large_image_pixels)
+                )
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _discard_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, operation, items, params, output_dir, manifest_name='manifest.json'):
+        """
+        Process a batch and yield its results as they finish
+        Args:
+            operation: One of OPERATIONS
+            items: List of (original name, saved input path)
+            params: Operation parameters for every item
+            output_dir: Where results and the manifest are written
+            manifest_name: Name of the manifest, yielded last
+        Yields:
+            (arcname, path) of every successful result in completion order, then of a JSON
+            manifest listing each item's status and error, for stream_zip
+        """
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {operation}")
+        pool = self._get_pool()
+        prefix = OPERATIONS[operation]
+        started = time.perf_counter()
+
+        futures = {}
+        for index, (name, input_path) in enumerate(items):
+            stem = os.path.join(output_dir, f'{index:04d}_{prefix}_{os.path.splitext(secure_filename(name) or "image")[0]}')
+            futures[pool.submit(_process_image, operation, input_path, params, stem)] = index
+        with self._lock:
+            self._running += 1
+
+        results = [None] * len(items)
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                entry = {'file': items[index][0], 'status': 'ok', 'output': None, 'error': None}
+                try:
+                    output_path = future.result()
+                    entry['output'] = os.path.basename(output_path)
+                except BrokenProcessPool as e:
+                    # A worker died (e.g. killed for memory); later batches get a fresh pool
+                    self._discard_pool(pool)
+                    entry['status'] = 'error'
+                    entry['error'] = str(e)
+                    logging.error(f"Error in batch {operation} of {items[index][0]}: {str(e)}")
+                except Exception as e:
+                    # One bad image fails its own entry, not the batch
+                    entry['status'] = 'error'
+                    entry['error'] = str(e)
+                    logging.error(f"Error in batch {operation} of {items[index][0]}: {str(e)}")
+                results[index] = entry
+                if entry['output']:
+                    yield entry['output'], output_path
+
+            failed = sum(1 for entry in results if entry['status'] == 'error')
+            manifest_path = os.path.join(output_dir, manifest_name)
+            with open(manifest_path, 'w') as f:
+                json.dump({'operation': operation, 'total': len(items), 'succeeded': len(items) - failed,
+                           'failed': failed, 'seconds': round(time.perf_counter() - started, 3),
+                           'items': results}, f, indent=2)
+            with self._lock:
+                self._items += len(items)
+                self._failed += failed
+            yield manifest_name, manifest_path
+        finally:
+            # A client that disconnects mid-stream closes the generator; drop the queued rest
+            for future in futures:
+                future.cancel()
+            with self._lock:
+                self._running -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'running_batches': self._running,
+                'items': self._items,
+                'failed_items': self._failed,
+            }
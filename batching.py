@@ -0,0 +1,91 @@
+from concurrent.futures import Future
+import threading
+import logging
+import queue
+import time
+
+class BatchScheduler:
+    """Merge concurrent inference requests into batched model calls.
+
+    Items are queued by ``submit`` and handed to ``handler`` as a list once
+    either ``max_batch_size`` items are waiting or the oldest item has waited
+    ``max_wait_ms`` milliseconds. ``handler`` must return one result per item.
+    Up to ``workers`` batches run at once, e.g. one per pooled model session.
+    """
+
+    def __init__(self, handler, max_batch_size=8, max_wait_ms=20, name='batch-scheduler', workers=1):
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000.0
+        self.workers = max(1, workers)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._full_flushes = 0
+        self._timeout_flushes = 0
+        self._threads = [threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True) for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item):
+        """Queue one item and return a Future resolved with its result"""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self):
+        """Block for the first item, then gather more until the batch is full or the wait expires"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            with self._lock:
+                self._batches += 1
+                self._items += len(batch)
+                if len(batch) >= self.max_batch_size:
+                    self._full_flushes += 1
+                else:
+                    self._timeout_flushes += 1
+
+            try:
+                results = list(self.handler([item for item, _ in batch]))
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+                # A short result list must not leave callers waiting forever
+                for _, future in batch[len(results):]:
+                    future.set_exception(Exception(f"Batch handler returned {len(results)} results for {len(batch)} items"))
+            except Exception as e:
+                logging.error(f"Batched inference failed: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'workers': self.workers,
+                'pending': self._queue.qsize(),
+                'batches': self._batches,
+                'items': self._items,
+                'avg_batch_size': round(self._items / self._batches, 3) if self._batches else 0.0,
+                'full_flushes': self._full_flushes,
+                'timeout_flushes': self._timeout_flushes,
+            }
@@ -0,0 +1,53 @@
+"""
+Compare two benchmark reports from benchmarks.run, case by case.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+
+Exits with status 1 when any case's p50 latency regressed by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report['meta'], {(r['operation'], r['mode'], r['fixture']): r for r in report['results']}
+
+def change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed p50 slowdown in percent')
+    args = parser.parse_args(argv)
+
+    old_meta, old = load(args.baseline)
+    new_meta, new = load(args.candidate)
+    print(f"baseline  {old_meta.get('commit')}  {old_meta.get('timestamp')}")
+    print(f"candidate {new_meta.get('commit')}  {new_meta.get('timestamp')}\n")
+    print(f"{'case':62} {'p50 before':>11} {'p50 after':>11} {'change':>8} {'peak RSS':>15}")
+
+    regressions = 0
+    for key in sorted(set(old) | set(new)):
+        name = ' '.join(key)
+        before, after = old.get(key), new.get(key)
+        if not before or not after or 'error' in before or 'error' in after:
+            status = 'missing' if not before or not after else 'error'
+            print(f"{name:62} {status:>11}")
+            continue
+        delta = change(before['p50_ms'], after['p50_ms'])
+        flag = ''
+        if delta > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{name:62} {before['p50_ms']:>9.1f}ms {after['p50_ms']:>9.1f}ms {delta:>+7.1f}% "
+              f"{before['peak_rss_mb']:>6.0f}->{after['peak_rss_mb']:<6.0f}MB{flag}")
+
+    print(f"\n{regressions} regression(s) above {args.threshold:g}%")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""Synthetic benchmark inputs, generated offline and reused between runs"""
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+from PIL import Image
+import io
+import os
+
+# (name, width, height) from thumbnail up to 24MP
+IMAGE_SIZES = [
+    ('thumb', 160, 120),
+    ('1mp', 1280, 800),
+    ('12mp', 4000, 3000),
+    ('24mp', 6000, 4000),
+]
+IMAGE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+
+# (name, page count) of the generated PDFs
+PDF_SIZES = [
+    ('1p', 1),
+    ('20p', 20),
+    ('200p', 200),
+]
+
+def synthetic_image(width, height):
+    """Photo-like RGB image: smooth gradients with some noise, so it neither compresses to nothing nor is pure noise"""
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 24)
+    radial = Image.radial_gradient('L').resize((width, height))
+    return Image.merge('RGB', (gradient, radial, Image.blend(gradient, noise, 0.5)))
+
+def make_image(path, width, height, format):
+    synthetic_image(width, height).save(path, format=format, quality=90)
+
+def make_pdf(path, pages):
+    """Text plus one embedded photo per page, like a scanned/illustrated document"""
+    photo = io.BytesIO()
+    synthetic_image(800, 600).save(photo, format='JPEG', quality=85)
+    can = canvas.Canvas(path, pagesize=A4)
+    for page in range(1, pages + 1):
+        can.setFont('Helvetica-Bold', 24)
+        can.drawString(72, 770, f'Benchmark document, page {page} of {pages}')
+        can.setFont('Helvetica', 10)
+        for line in range(30):
+            can.drawString(72, 740 - line * 12, f'Line {line + 1}: the quick brown fox jumps over the lazy dog ' * 2)
+        photo.seek(0)
+        can.drawImage(ImageReader(photo), 72, 72, width=400, height=300)
+        can.showPage()
+    can.save()
+
+def generate(fixtures_dir, quick=False):
+    """
+    Create any missing fixtures
+    Args:
+        fixtures_dir: Directory for the generated files
+        quick: Skip the 12MP and 24MP images and the 200-page PDF
+    Returns:
+        {'images': {(size, ext): path}, 'pdfs': {size: path}}
+    """
+    os.makedirs(fixtures_dir, exist_ok=True)
+    fixtures = {'images': {}, 'pdfs': {}}
+
+    for name, width, height in IMAGE_SIZES:
+        if quick and width * height > 2_000_000:
+            continue
+        for ext, format in IMAGE_FORMATS.items():
+            path = os.path.join(fixtures_dir, f'{name}.{ext}')
+            if not os.path.exists(path):
+                make_image(path, width, height, format)
+            fixtures['images'][(name, ext)] = path
+
+    for name, pages in PDF_SIZES:
+        if quick and pages > 50:
+            continue
+        path = os.path.join(fixtures_dir, f'{name}.pdf')
+        if not os.path.exists(path):
+            make_pdf(path, pages)
+        fixtures['pdfs'][name] = path
+
+    return fixtures
@@ -0,0 +1,320 @@
+"""
+Benchmark every FileConverter and BackgroundRemover operation, called directly
+and through the Flask test client, and report the results as JSON.
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --quick --only resize_image,compress_image --mode direct
+"""
+from datetime import datetime, timezone
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import shutil
+import logging
+import json
+import time
+import sys
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import fixtures  # noqa: E402
+
+OPERATIONS = [
+    'convert_pdf_to_png', 'combine_pdfs', 'split_pdf', 'rotate_pdf', 'add_watermark',
+    'resize_image', 'crop_image', 'convert_image_format', 'compress_image', 'remove_background',
+]
+
+# Target extension of convert_image_format for each source extension
+CONVERT_TO = {'png': 'jpg', 'jpg': 'webp', 'webp': 'png'}
+
+# Copies of one PDF merged by the combine_pdfs cases
+COMBINE_COPIES = 10
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter for this process (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak RSS since the last reset, or since process start where it cannot be reset"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def measure(run, repeat, warmup):
+    """Time repeat calls of run after warmup calls; run raises on failure"""
+    for _ in range(warmup):
+        run()
+
+    reset_peak_rss()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        call_started = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'runs': repeat,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+        'min_ms': round(min(latencies) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2),
+        'throughput_per_s': round(repeat / elapsed, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def succeeded(result, operation):
+    """Converter methods report failure by returning False or None"""
+    if result is False or result is None:
+        raise Exception(f"{operation} failed, see the log")
+    return result
+
+class DirectCases:
+    """Operations called on FileConverter and BackgroundRemover instances"""
+
+    def __init__(self, output_dir, model):
+        from converter import FileConverter
+        self.converter = FileConverter(output_dir=output_dir)
+        self.output_dir = output_dir
+        self.model = model
+        self._bg_remover = None
+
+    @property
+    def bg_remover(self):
+        if self._bg_remover is None:
+            from bg_remover import BackgroundRemover
+            self._bg_remover = BackgroundRemover(model_name=self.model, pool_size=1, output_dir=self.output_dir)
+        return self._bg_remover
+
+    def output(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def convert_pdf_to_png(self, pdf):
+        return lambda: succeeded(self.converter.convert_pdf_to_png(pdf, page=1), 'convert_pdf_to_png')
+
+    def combine_pdfs(self, pdf, streaming):
+        paths = [pdf] * COMBINE_COPIES
+        return lambda: succeeded(self.converter.combine_pdfs(paths, self.output('combined.pdf'), streaming=streaming), 'combine_pdfs')
+
+    def split_pdf(self, pdf, pages):
+        return lambda: succeeded(self.converter.split_pdf(pdf, self.output_dir, 1, max(1, pages // 2)), 'split_pdf')
+
+    def rotate_pdf(self, pdf):
+        return lambda: succeeded(self.converter.rotate_pdf(pdf, self.output('rotated.pdf'), 90), 'rotate_pdf')
+
+    def add_watermark(self, pdf):
+        return lambda: succeeded(self.converter.add_watermark(pdf, self.output('watermarked.pdf'), 'BENCHMARK'), 'add_watermark')
+
+    def resize_image(self, image, ext, width, height):
+        return lambda: succeeded(self.converter.resize_image(image, self.output(f'resized.{ext}'), width // 2, height // 2), 'resize_image')
+
+    def crop_image(self, image, ext, width, height):
+        box = (width // 4, height // 4, width * 3 // 4, height * 3 // 4)
+        return lambda: succeeded(self.converter.crop_image(image, self.output(f'cropped.{ext}'), *box), 'crop_image')
+
+    def convert_image_format(self, image, ext):
+        output = self.output(f'converted.{CONVERT_TO[ext]}')
+        return lambda: succeeded(self.converter.convert_image_format(image, output), 'convert_image_format')
+
+    def compress_image(self, image, ext):
+        return lambda: succeeded(self.converter.compress_image(image, self.output(f'compressed.{ext}'), 70), 'compress_image')
+
+    def remove_background(self, image):
+        return lambda: succeeded(self.bg_remover.remove_background(image, self.output('nobg.png')), 'remove_background')
+
+class HttpCases:
+    """The same operations as POST requests through the Flask test client"""
+
+    def __init__(self):
+        # Measure the operations themselves rather than cache hits or upload limits
+        os.environ['CACHE_ENABLED'] = 'false'
+        os.environ.setdefault('REMBG_PRELOAD', 'false')
+        import app as app_module
+        app_module.app.config['MAX_CONTENT_LENGTH'] = None
+        app_module.app.config['UPLOAD_LIMITS'] = {}
+        self.client = app_module.app.test_client()
+
+    def post(self, route, files, **form):
+        def run():
+            handles = {field: [(open(path, 'rb'), os.path.basename(path)) for path in paths] for field, paths in files.items()}
+            try:
+                data = dict(form, **handles)
+                response = self.client.post(route, data=data, content_type='multipart/form-data')
+                try:
+                    response.get_data()
+                    if response.status_code != 200:
+                        raise Exception(f"{route} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+                finally:
+                    # Streamed responses hold their admission budget and work directory until closed
+                    response.close()
+            finally:
+                for handle_list in handles.values():
+                    for handle, _ in handle_list:
+                        handle.close()
+        return run
+
+    def convert_pdf_to_png(self, pdf):
+        return self.post('/convert', {'file': [pdf]}, pages='1')
+
+    def combine_pdfs(self, pdf, streaming):
+        return self.post('/combine-pdf', {'files': [pdf] * COMBINE_COPIES}, streaming=str(streaming).lower())
+
+    def split_pdf(self, pdf, pages):
+        return self.post('/split-pdf', {'file': [pdf]}, start_page='1', end_page=str(max(1, pages // 2)))
+
+    def rotate_pdf(self, pdf):
+        return self.post('/rotate-pdf', {'file': [pdf]}, rotation='90')
+
+    def add_watermark(self, pdf):
+        return self.post('/add-watermark', {'file': [pdf]}, watermark_text='BENCHMARK')
+
+    def resize_image(self, image, ext, width, height):
+        return self.post('/resize-image', {'file': [image]}, width=str(width // 2), height=str(height // 2))
+
+    def crop_image(self, image, ext, width, height):
+        return self.post('/crop-image', {'file': [image]}, left=str(width // 4), top=str(height // 4),
+                         right=str(width * 3 // 4), bottom=str(height * 3 // 4))
+
+    def convert_image_format(self, image, ext):
+        return self.post('/convert-image', {'file': [image]}, format=CONVERT_TO[ext])
+
+    def compress_image(self, image, ext):
+        return self.post('/compress-image', {'file': [image]}, quality='70')
+
+    def remove_background(self, image):
+        return self.post('/remove-background', {'file': [image]})
+
+def cases(runner, inputs, operations):
+    """Yield (operation, fixture, run) for every selected operation and fixture"""
+    pages = dict(fixtures.PDF_SIZES)
+    sizes = {name: (width, height) for name, width, height in fixtures.IMAGE_SIZES}
+
+    for name, pdf in inputs['pdfs'].items():
+        if 'convert_pdf_to_png' in operations:
+            yield 'convert_pdf_to_png', name, runner.convert_pdf_to_png(pdf)
+        if 'combine_pdfs' in operations:
+            yield 'combine_pdfs', f'{COMBINE_COPIES}x{name}', runner.combine_pdfs(pdf, False)
+            yield 'combine_pdfs', f'{COMBINE_COPIES}x{name}-streaming', runner.combine_pdfs(pdf, True)
+        if 'split_pdf' in operations:
+            yield 'split_pdf', name, runner.split_pdf(pdf, pages[name])
+        if 'rotate_pdf' in operations:
+            yield 'rotate_pdf', name, runner.rotate_pdf(pdf)
+        if 'add_watermark' in operations:
+            yield 'add_watermark', name, runner.add_watermark(pdf)
+
+    for (name, ext), image in inputs['images'].items():
+        width, height = sizes[name]
+        fixture = f'{name}.{ext}'
+        if 'resize_image' in operations:
+            yield 'resize_image', fixture, runner.resize_image(image, ext, width, height)
+        if 'crop_image' in operations:
+            yield 'crop_image', fixture, runner.crop_image(image, ext, width, height)
+        if 'convert_image_format' in operations:
+            yield 'convert_image_format', f'{fixture}->{CONVERT_TO[ext]}', runner.convert_image_format(image, ext)
+        if 'compress_image' in operations:
+            yield 'compress_image', fixture, runner.compress_image(image, ext)
+        if 'remove_background' in operations:
+            yield 'remove_background', fixture, runner.remove_background(image)
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--fixtures', default=os.path.join(REPO_ROOT, 'benchmarks', 'fixtures'),
+                        help='Where generated inputs are kept between runs')
+    parser.add_argument('--mode', choices=['direct', 'http', 'both'], default='both')
+    parser.add_argument('--only', help='Comma-separated operations to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed calls per case')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed calls per case')
+    parser.add_argument('--quick', action='store_true', help='Skip the largest images and PDFs')
+    parser.add_argument('--model', default='u2net', help='Background removal model for direct calls')
+    args = parser.parse_args(argv)
+
+    operations = args.only.split(',') if args.only else OPERATIONS
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"Unknown operations: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    output_path = os.path.abspath(args.output) if args.output else None
+    inputs = fixtures.generate(os.path.abspath(args.fixtures), quick=args.quick)
+
+    # Keep the app's working, cache and job folders out of the checkout
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    os.chdir(work_dir)
+    os.makedirs('output', exist_ok=True)
+
+    results = []
+    modes = ['direct', 'http'] if args.mode == 'both' else [args.mode]
+    try:
+        for mode in modes:
+            runner = DirectCases(os.path.join(work_dir, 'output'), args.model) if mode == 'direct' else HttpCases()
+            for operation, fixture, run in cases(runner, inputs, operations):
+                entry = {'operation': operation, 'mode': mode, 'fixture': fixture}
+                try:
+                    entry.update(measure(run, args.repeat, args.warmup))
+                except Exception as e:
+                    entry['error'] = str(e)
+                print(f"{mode:6} {operation:22} {fixture:24} "
+                      f"{entry.get('p50_ms', '-'):>10} ms p50  {entry.get('error', '')}", file=sys.stderr)
+                results.append(entry)
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': dict(git_revision(), **{
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'quick': args.quick,
+        }),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,514 @@
-from rembg import remove
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from batching import BatchScheduler
+from metrics import span
+import compositing
+import mask_ops
+import threading
+import logging
+import queue
+import time
 import io
 import os
 
+# rembg (and with it onnxruntime, scipy, scikit-image and pymatting) is imported where it is
+# first needed: it takes over a second and ~200MB, which servers without background removal skip
+
+# Short model names accepted in config, mapped to rembg session names
+MODEL_NAMES = {
+    'u2net': 'u2net',
+    'u2netp': 'u2netp',
+    'isnet': 'isnet-general-use',
+    'silueta': 'silueta',
+}
+
+# Output formats of replace_background and their PIL names
+OUTPUT_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+# Per-model input normalization (mean, std) and network input size, as used by rembg
+MODEL_INPUTS = {
+    'u2net': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'u2netp': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'isnet': ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+    'silueta': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+}
+
+class SessionPool:
+    """Fixed-size pool of pre-created rembg sessions checked out per request"""
+
+    def __init__(self, model_name='u2net', size=None, intra_op_threads=None):
+        if model_name not in MODEL_NAMES:
+            raise ValueError(f"Unsupported model: {model_name}. Choose one of {', '.join(MODEL_NAMES)}")
+        self.model_name = model_name
+        self.size = max(1, size or os.cpu_count() or 1)
+        # Split the CPU cores between pool members unless set explicitly
+        self.intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 1) // self.size)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._waiting = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._warm = False
+        self._warm_error = None
+        self._warming_pid = None
+
+    def _new_session(self):
+        """Create one rembg session for the configured model"""
+        from rembg.sessions import sessions_class
+        from rembg.sessions.u2net import U2netSession
+        import onnxruntime as ort
+
+        rembg_name = MODEL_NAMES[self.model_name]
+        session_class = U2netSession
+        for sc in sessions_class:
+            if sc.name() == rembg_name:
+                session_class = sc
+                break
+
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = 1
+        return session_class(rembg_name, sess_opts)
+
+    def warm_up(self):
+        """Create every session up front and run one inference so the first request is not slow"""
+        started = time.monotonic()
+        dummy = Image.new('RGB', (32, 32))
+        warmed = 0
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            try:
+                session = self._new_session()
+                session.predict(dummy)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            self._idle.put(session)
+            warmed += 1
+
+        self._warm = True
+        logging.info(f"Warmed {warmed} '{self.model_name}' session(s) in {time.monotonic() - started:.2f}s")
+
+    def warm_up_in_background(self):
+        """Run warm_up on a thread of this process, once per process"""
+        # Checked per pid: threads started in a preloading gunicorn master do not survive the fork
+        with self._lock:
+            if self._warming_pid == os.getpid():
+                return
+            self._warming_pid = os.getpid()
+        threading.Thread(target=self._warm_up_logged, name='rembg-warm-up', daemon=True).start()
+
+    def _warm_up_logged(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            self._warm_error = str(e)
+            logging.error(f"Error warming up '{self.model_name}' sessions: {str(e)}")
+
+    def readiness(self):
+        """'ready' once every session is warm, 'warming' before, or the error that stopped warm-up"""
+        if self._warm:
+            return 'ready'
+        if self._warm_error:
+            return f'error: {self._warm_error}'
+        return 'warming'
+
+    @contextmanager
+    def session(self, timeout=None):
+        """Check a session out of the pool for the duration of the block"""
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                create = False
+                with self._lock:
+                    if self._created < self.size:
+                        self._created += 1
+                        create = True
+                if create:
+                    try:
+                        session = self._new_session()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                else:
+                    try:
+                        session = self._idle.get(timeout=timeout)
+                    except queue.Empty:
+                        raise TimeoutError(f"No '{self.model_name}' session available after {timeout}s")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+        waited = time.monotonic() - started
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(session)
+
+    def stats(self):
+        """Snapshot of pool occupancy and checkout wait times"""
+        with self._lock:
+            return {
+                'model': self.model_name,
+                'size': self.size,
+                'warm': self._warm,
+                'intra_op_threads': self.intra_op_threads,
+                'created': self._created,
+                'idle': self._idle.qsize(),
+                'in_use': self._in_use,
+                'queue_depth': self._waiting,
+                'checkouts': self._checkouts,
+                'checkout_wait_seconds_total': round(self._wait_total, 6),
+                'checkout_wait_seconds_max': round(self._wait_max, 6),
+                'checkout_wait_seconds_avg': round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+            }
+
 class BackgroundRemover:
-    def __init__(self):
+    def __init__(self, model_name='u2net', pool_size=None, checkout_timeout=None, intra_op_threads=None, output_dir='output',
+                 proxy_min_pixels=4_000_000, max_working_size=1024, refine_edges=False):
         self.supported_formats = {'.png', '.jpg', '.jpeg', '.webp'}
+        self.output_dir = output_dir
+        # Images from this many pixels on are segmented on a proxy no larger than max_working_size; 0 disables
+        self.proxy_min_pixels = proxy_min_pixels
+        self.max_working_size = max_working_size
+        self.refine_edges = refine_edges
+        self.checkout_timeout = checkout_timeout
+        self.pool = SessionPool(model_name, pool_size, intra_op_threads)
+        self.batcher = None
+
+    def enable_batching(self, max_batch_size=8, max_wait_ms=20):
+        """Merge concurrent remove_background calls into batched model runs, one batch per pooled session at a time"""
+        self.batcher = BatchScheduler(self.predict_batch, max_batch_size, max_wait_ms, name='rembg-batcher',
+                                      workers=self.pool.size)
+
+    def batched_mask(self, future):
+        """Wait for a mask from the batcher, for as long as a session checkout plus a model run may take"""
+        timeout = 2 * self.checkout_timeout if self.checkout_timeout else None
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # Drop it from the queue if no batch has picked it up yet
+            future.cancel()
+            raise TimeoutError(f"No mask from the batcher after {timeout}s")
 
     def is_supported(self, filename):
         return any(filename.lower().endswith(fmt) for fmt in self.supported_formats)
 
-    def remove_background(self, input_path, output_path=None):
+    def warm_up(self):
+        """Load the model into every pooled session before serving traffic"""
+        self.pool.warm_up()
+
+    def warm_up_in_background(self):
+        """Load the model on a background thread, so the process can serve other traffic meanwhile"""
+        self.pool.warm_up_in_background()
+
+    def readiness(self):
+        return self.pool.readiness()
+
+    def stats(self):
+        stats = self.pool.stats()
+        if self.batcher:
+            stats['batching'] = self.batcher.stats()
+        return stats
+
+    def preprocess(self, image):
+        """Resize and normalize an image into a (3, H, W) float32 model input tensor"""
+        mean, std, size = MODEL_INPUTS[self.pool.model_name]
+        im_ary = np.asarray(image.convert('RGB').resize(size, Image.LANCZOS), dtype=np.float32)
+        im_ary = im_ary / max(float(im_ary.max()), 1.0)
+        im_ary = (im_ary - np.array(mean, dtype=np.float32)) / np.array(std, dtype=np.float32)
+        return im_ary.transpose((2, 0, 1))
+
+    def predict_batch(self, images):
+        """
+        Compute foreground masks for several images with batched model runs
+        Args:
+            images: List of PIL images
+        Returns:
+            List of 'L' mode masks, one per image and at its original size
+        """
+        batch = np.stack([self.preprocess(image) for image in images])
+
+        with self.pool.session(timeout=self.checkout_timeout) as session:
+            model_input = session.inner_session.get_inputs()[0]
+            # Models exported with a fixed batch dimension are run one slice at a time
+            step = model_input.shape[0] if isinstance(model_input.shape[0], int) else len(images)
+            preds = [
+                session.inner_session.run(None, {model_input.name: batch[i:i + step]})[0][:, 0, :, :]
+                for i in range(0, len(images), max(1, step))
+            ]
+        preds = np.concatenate(preds)
+
+        masks = []
+        for image, pred in zip(images, preds):
+            mi, ma = pred.min(), pred.max()
+            pred = (pred - mi) / (ma - mi) if ma > mi else np.zeros_like(pred)
+            mask = Image.fromarray((pred * 255).astype('uint8'), mode='L')
+            masks.append(mask.resize(image.size, Image.LANCZOS))
+        return masks
+
+    def _load_image(self, input_path):
+        """Open an image with EXIF orientation applied, keeping alpha when present"""
+        with Image.open(input_path) as input_image:
+            input_image = ImageOps.exif_transpose(input_image)
+            if input_image.mode in ('RGBA', 'LA'):
+                return input_image.convert('RGBA')
+            return input_image.convert('RGB')
+
+    def remove_background_batch(self, input_paths, output_dir=None):
+        """
+        Remove background from many images using batched inference
+        Args:
+            input_paths: Paths to input images
+            output_dir: Directory to save output images (default: the remover's output_dir)
+        Returns:
+            List of output paths, in input order
+        """
+        from rembg.bg import naive_cutout
+
+        try:
+            images = [self._load_image(path) for path in input_paths]
+            # Large images are segmented on their proxies
+            proxies = [self.make_proxy(image) if self.use_proxy(image) else image for image in images]
+            if self.batcher:
+                masks = [self.batched_mask(future) for future in [self.batcher.submit(proxy) for proxy in proxies]]
+            else:
+                masks = self.predict_batch(proxies)
+
+            output_paths = []
+            for input_path, image, proxy, mask in zip(input_paths, images, proxies, masks):
+                name, _ = os.path.splitext(os.path.basename(input_path))
+                output_path = os.path.join(output_dir or self.output_dir, f'{name}_nobg.png')
+                if proxy is image:
+                    naive_cutout(image, mask).save(output_path, 'PNG')
+                else:
+                    self.apply_proxy_mask(image, proxy, mask).save(output_path, 'PNG')
+                output_paths.append(output_path)
+            return output_paths
+
+        except Exception as e:
+            raise Exception(f"Error removing background: {str(e)}")
+
+    def use_proxy(self, image):
+        """Whether an image is large enough to be segmented on a proxy"""
+        return bool(self.proxy_min_pixels) and image.width * image.height >= self.proxy_min_pixels
+
+    def predict_mask(self, image):
+        """Foreground mask of one image at its own size, through the batcher when enabled"""
+        # Merged with concurrent requests when batching is enabled
+        if self.batcher:
+            return self.batched_mask(self.batcher.submit(image))
+        with self.pool.session(timeout=self.checkout_timeout) as session:
+            return session.predict(image)[0]
+
+    def make_proxy(self, image):
+        """RGB copy of an image no larger than max_working_size; the model only sees 320-1024px anyway"""
+        with span('proxy'):
+            proxy = image.convert('RGB')
+            proxy.thumbnail((self.max_working_size, self.max_working_size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+            return proxy
+
+    def upsample_proxy_mask(self, image, proxy, mask, refine_edges=None):
+        """
+        Bring the mask computed on a proxy up to the full-resolution image
+        Args:
+            image: Decoded RGB/RGBA image at full resolution
+            proxy: The image's proxy from make_proxy
+            mask: 'L' mask at the proxy's size
+            refine_edges: Snap the upsampled mask's soft boundary to edges of the full-resolution
+                image (default: the remover's setting)
+        Returns:
+            2-D uint8 alpha array at the image's size
+        """
+        refine_edges = self.refine_edges if refine_edges is None else refine_edges
+        with span('upsample'):
+            alpha = mask_ops.upsample_mask(np.asarray(mask), image.size)
+        if refine_edges:
+            with span('refine'):
+                radius = max(2, round(image.width / proxy.width))
+                mask_ops.refine_edges(alpha, np.asarray(image.convert('L')), radius)
+        return alpha
+
+    def apply_proxy_mask(self, image, proxy, mask, refine_edges=None):
+        """Cut out a full-resolution image with the mask computed on its proxy, as an RGBA image"""
+        from rembg.bg import naive_cutout
+
+        alpha = self.upsample_proxy_mask(image, proxy, mask, refine_edges)
+        with span('apply'):
+            return naive_cutout(image, Image.fromarray(alpha, mode='L'))
+
+    def subject_alpha(self, image, refine_edges=None):
+        """
+        Segment a decoded image once
+        Args:
+            image: Decoded RGB/RGBA image, already turned upright at decode (see _load_image)
+            refine_edges: Refine the mask boundary of large images (default: the remover's setting)
+        Returns:
+            2-D uint8 alpha array of the subject
+        """
+        if self.use_proxy(image):
+            proxy = self.make_proxy(image)
+            with span('inference'):
+                mask = self.predict_mask(proxy)
+            return self.upsample_proxy_mask(image, proxy, mask, refine_edges)
+
+        with span('inference'):
+            mask = self.predict_mask(image)
+        return np.asarray(mask)
+
+    def cut_out(self, image, refine_edges=None):
+        """Return an RGBA copy of a decoded RGB/RGBA image with its background made transparent"""
+        from rembg.bg import naive_cutout
+
+        alpha = self.subject_alpha(image, refine_edges)
+        with span('apply'):
+            return naive_cutout(image, Image.fromarray(alpha, mode='L'))
+
+    def replace_subject_background(self, image, background='transparent', template=None, blur_radius=None,
+                                   autocrop=False, padding=0.05, shadow=False, shadow_opacity=0.5, refine_edges=None):
+        """
+        Put the subject of a decoded image on a new background
+        Args:
+            image: Decoded RGB/RGBA image
+            background: 'transparent', 'blur' (the image itself, blurred), 'template' or a color
+            template: PIL image covering the canvas when background is 'template'
+            blur_radius: Blur of the 'blur' background in pixels (default: 2% of the longer side)
+            autocrop: Crop to the subject's bounding box
+            padding: Border kept around the subject when cropping, as a fraction of its longer side
+            shadow: Cast a soft drop shadow below and to the right of the subject
+            shadow_opacity: Opacity of the shadow, 0-1
+            refine_edges: Refine the mask boundary of large images (default: the remover's setting)
+        Returns:
+            RGB image, or RGBA when the background is transparent
+        """
+        alpha = self.subject_alpha(image, refine_edges)
+        with span('composite'):
+            rgb = np.asarray(image.convert('RGB'))
+            if image.mode == 'RGBA':
+                # Pixels the input already made transparent stay transparent
+                alpha = np.minimum(alpha, np.asarray(image.getchannel('A')))
+
+            longer = max(image.size)
+            shadow_offset = round(longer * 0.02)
+            if autocrop:
+                box = compositing.subject_box(alpha, padding)
+                if box is not None:
+                    left, top, right, bottom = box
+                    if shadow:
+                        # Room for the shadow below and to the right
+                        right = min(image.width, right + 2 * shadow_offset)
+                        bottom = min(image.height, bottom + 2 * shadow_offset)
+                    rgb, alpha = rgb[top:bottom, left:right], alpha[top:bottom, left:right]
+                    image = image.crop((left, top, right, bottom)) if background == 'blur' else image
+            height, width = alpha.shape
+
+            shadow_alpha = None
+            if shadow:
+                shadow_alpha = compositing.drop_shadow(alpha, (shadow_offset, shadow_offset),
+                                                       max(1, round(longer * 0.03)), shadow_opacity)
+
+            if background == 'transparent':
+                if shadow_alpha is not None:
+                    return Image.fromarray(compositing.composite_transparent(rgb, alpha, shadow_alpha, (0, 0, 0)), 'RGBA')
+                return Image.fromarray(np.dstack((rgb, alpha)), 'RGBA')
+
+            if background == 'blur':
+                canvas = np.array(self.blurred(image.convert('RGB'), blur_radius or max(1, round(longer * 0.02))))
+            elif background == 'template':
+                canvas = np.array(ImageOps.fit(template.convert('RGB'), (width, height), Image.Resampling.BILINEAR))
+            else:
+                canvas = np.empty((height, width, 3), dtype=np.uint8)
+                canvas[:] = compositing.parse_color(background)
+
+            if shadow_alpha is not None:
+                compositing.composite((0, 0, 0), shadow_alpha, canvas)
+            return Image.fromarray(compositing.composite(rgb, alpha, canvas), 'RGB')
+
+    def blurred(self, image, radius):
+        """Gaussian blur of an image, computed on a reduced copy: a wide blur keeps nothing the reduction drops"""
+        factor = max(1, radius // 8)
+        small = image.reduce(factor) if factor > 1 else image
+        small = small.filter(ImageFilter.GaussianBlur(radius / factor))
+        return small.resize(image.size, Image.Resampling.BILINEAR) if factor > 1 else small
+
+    def remove_background(self, input_path, output_path=None, refine_edges=None):
         """
         Remove background from an image
         Args:
-            input_path: Path to input image
-            output_path: Path to save output image (optional)
+            input_path: Path to input image, or a binary file object
+            output_path: Path or binary file object to save the PNG output to (optional for path inputs)
+            refine_edges: Refine the mask boundary of large images (default: the remover's setting)
         Returns:
-            Path to output image
+            Path (or file object) of the output image
         """
         try:
             # If no output path specified, create one
             if output_path is None:
                 filename = os.path.basename(input_path)
                 name, _ = os.path.splitext(filename)
-                output_path = os.path.join('output', f'{name}_nobg.png')  # Always save as PNG
-
-            # Read input image
-            with Image.open(input_path) as input_image:
-                # Convert to RGB if necessary
-                if input_image.mode in ('RGBA', 'LA'):
-                    # Keep alpha channel
-                    input_image = input_image.convert('RGBA')
-                else:
-                    # Convert to RGB for non-alpha images
-                    input_image = input_image.convert('RGB')
-                
-                # Remove background
-                output_image = remove(input_image)
+                output_path = os.path.join(self.output_dir, f'{name}_nobg.png')  # Always save as PNG
+
+            # Read input image, upright and as RGB or RGBA
+            with span('decode'):
+                input_image = self._load_image(input_path)
                 
-                # Save output image
+            # Remove background
+            output_image = self.cut_out(input_image, refine_edges)
+            
+            # Save output image
+            with span('encode'):
                 output_image.save(output_path, 'PNG')
-                
-                return output_path
+            
+            return output_path
             
         except Exception as e:
             raise Exception(f"Error removing background: {str(e)}")
+
+    def replace_background(self, input_path, output_path, format='PNG', quality=90, **options):
+        """
+        Remove the background of an image and put its subject on a new one
+        Args:
+            input_path: Path to input image, or a binary file object
+            output_path: Path or binary file object to save the output to
+            format: PNG, JPEG or WEBP; JPEG output of a transparent background is put on white
+            quality: JPEG and WebP quality
+            options: Options of replace_subject_background (background, template, autocrop, shadow, ...)
+        Returns:
+            output_path
+        """
+        try:
+            with span('decode'):
+                input_image = self._load_image(input_path)
+            if format == 'JPEG' and options.get('background', 'transparent') == 'transparent':
+                options['background'] = 'white'
+
+            output_image = self.replace_subject_background(input_image, **options)
+
+            with span('encode'):
+                output_image.save(output_path, format, quality=quality)
+            return output_path
+
+        except Exception as e:
+            raise Exception(f"Error replacing background: {str(e)}")
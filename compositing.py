@@ -0,0 +1,143 @@
+"""NumPy compositing of a cut-out subject onto new backgrounds, driven by its alpha mask"""
+from mask_ops import upsample_mask
+from PIL import ImageColor
+import numpy as np
+import re
+
+# Output rows blended at a time, bounding the uint16 temporaries to a few MB
+STRIP_ROWS = 256
+
+# Alpha values below this count as background when looking for the subject's bounds
+SUBJECT_THRESHOLD = 8
+
+def parse_color(value):
+    """(r, g, b) of 'rrggbb', '#rrggbb', '#rgb' or a CSS color name"""
+    value = str(value).strip()
+    if re.fullmatch(r'[0-9a-fA-F]{6}', value):
+        value = '#' + value
+    try:
+        return ImageColor.getrgb(value)[:3]
+    except ValueError:
+        raise ValueError(f"Invalid color: {value}")
+
+def subject_box(alpha, padding=0.0, threshold=SUBJECT_THRESHOLD):
+    """
+    Bounding box of the subject in an alpha mask
+    Args:
+        alpha: 2-D uint8 array
+        padding: Border added on every side, as a fraction of the box's longer side
+        threshold: Lowest alpha that counts as subject
+    Returns:
+        (left, top, right, bottom) within the mask, or None if the mask is empty
+    """
+    # Reduce each axis first, so no full-size boolean array is built
+    rows = np.flatnonzero(alpha.max(axis=1) >= threshold)
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(alpha.max(axis=0) >= threshold)
+    top, bottom, left, right = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+    pad = round(max(right - left, bottom - top) * padding)
+    height, width = alpha.shape
+    return max(0, left - pad), max(0, top - pad), min(width, right + pad), min(height, bottom + pad)
+
+def _div255(values):
+    """Exact round(values / 255) for uint16 products of two 8-bit values, in place"""
+    values += 128
+    values += values >> 8
+    values >>= 8
+    return values
+
+def composite(foreground, alpha, background):
+    """
+    Blend a foreground over a background, a strip of rows at a time
+    Args:
+        foreground: (H, W, 3) uint8 array, or an (r, g, b) color
+        alpha: (H, W) uint8 array of foreground coverage
+        background: (H, W, 3) uint8 array, blended into in place
+    Returns:
+        background
+    """
+    # Outside the box around every nonzero alpha the background shows through unchanged
+    box = subject_box(alpha, threshold=1)
+    if box is None:
+        return background
+    left, top, right, bottom = box
+    solid = None if isinstance(foreground, np.ndarray) else np.array(foreground, dtype=np.uint16)
+    for start in range(top, bottom, STRIP_ROWS):
+        rows = slice(start, min(start + STRIP_ROWS, bottom))
+        weight = alpha[rows, left:right, None].astype(np.uint16)
+        blended = (foreground[rows, left:right] if solid is None else solid) * weight
+        weight ^= 255  # 255 - alpha
+        blended += background[rows, left:right] * weight
+        background[rows, left:right] = _div255(blended)
+    return background
+
+def composite_transparent(foreground, alpha, shadow, shadow_color):
+    """
+    A subject over its shadow on a transparent canvas
+    Args:
+        foreground: (H, W, 3) uint8 array
+        alpha: (H, W) uint8 array of the subject
+        shadow: (H, W) uint8 array of the shadow's opacity
+        shadow_color: (r, g, b)
+    Returns:
+        (H, W, 4) uint8 RGBA array, not premultiplied
+    """
+    height, width = alpha.shape
+    result = np.empty((height, width, 4), dtype=np.uint8)
+    color = np.array(shadow_color, dtype=np.float32)
+    for top in range(0, height, STRIP_ROWS):
+        bottom = top + STRIP_ROWS
+        subject = alpha[top:bottom, :, None].astype(np.float32) / 255
+        under = shadow[top:bottom, :, None].astype(np.float32) / 255 * (1 - subject)
+        coverage = subject + under
+        rgb = foreground[top:bottom] * subject + color * under
+        np.divide(rgb, coverage, out=rgb, where=coverage > 0)
+        result[top:bottom, :, :3] = np.rint(rgb)
+        result[top:bottom, :, 3] = np.rint(coverage[..., 0] * 255)
+    return result
+
+def box_blur(values, radius, passes=3):
+    """
+    Blur a 2-D array with repeated box filters along each axis, computed from running sums;
+    three passes come close to a Gaussian with a standard deviation of about radius
+    """
+    values = values.astype(np.float32)
+    size = 2 * radius + 1
+    for _ in range(passes):
+        for axis in (0, 1):
+            padding = [(0, 0), (0, 0)]
+            padding[axis] = (radius + 1, radius)
+            sums = np.pad(values, padding).cumsum(axis=axis)
+            if axis == 0:
+                values = (sums[size:] - sums[:-size]) / size
+            else:
+                values = (sums[:, size:] - sums[:, :-size]) / size
+    return values
+
+def shift(values, dx, dy):
+    """Move a 2-D array right by dx and down by dy, filling with zeros"""
+    result = np.zeros_like(values)
+    height, width = values.shape
+    if abs(dx) < width and abs(dy) < height:
+        result[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+            values[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)]
+    return result
+
+def drop_shadow(alpha, offset, radius, opacity=0.5):
+    """
+    Soft shadow of a subject: its mask moved by offset and blurred
+    Args:
+        alpha: (H, W) uint8 array of the subject
+        offset: (dx, dy) in pixels
+        radius: Blur radius in pixels
+        opacity: Opacity of the shadow under an opaque subject, 0-1
+    Returns:
+        (H, W) uint8 array of the shadow's opacity
+    """
+    # A blurred shadow has no detail to lose, so it is computed on every nth pixel and upsampled
+    factor = max(1, radius // 4)
+    small = shift(alpha[::factor, ::factor], round(offset[0] / factor), round(offset[1] / factor))
+    small = box_blur(small, max(1, round(radius / factor / 2)))
+    small *= opacity
+    return upsample_mask(np.rint(small).astype(np.uint8), (alpha.shape[1], alpha.shape[0]))
@@ -1,57 +1,269 @@
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import os
 import logging
 from PyPDF2 import PdfMerger, PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+from pdf_stream import (
+    StreamingPdfMerger, iter_merged_pdf, iter_page_refs, open_mapped_pdf, page_count, page_rotation,
+    write_incremental_update
+)
+from image_pdf import iter_images_pdf
+from watermark import WatermarkTemplates, page_geometry, placement
+from pdf_optimize import (
+    PRESETS as PDF_PRESETS, QPDF_OK_CODES, ExternalToolPool, ToolBusyError, ToolTimeoutError, ghostscript_args, qpdf_args
+)
+from metrics import span
+from contextlib import contextmanager
 import io
-import subprocess
+import shutil
+import time
+
+# PIL format names for the supported image extensions
+IMAGE_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}
+
+# Luminance quantization table of the JPEG standard (Annex K) that encoders scale by quality
+STANDARD_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+def estimate_jpeg_quality(img):
+    """Estimate the IJG quality (1-100) a JPEG was saved with from its luminance table, or None"""
+    tables = getattr(img, 'quantization', None)
+    if not tables or 0 not in tables or len(tables[0]) != 64:
+        return None
+    # Inverse of the IJG scaling: tables are the standard one times 5000/q (q < 50) or 200 - 2q percent
+    scale = sum(tables[0]) * 100 / sum(STANDARD_LUMINANCE_TABLE)
+    quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+    return max(1, min(100, round(quality)))
+
+def image_format(output, format=None):
+    """PIL format for an output path or buffer, from an explicit format name or the path's extension"""
+    if format:
+        return IMAGE_FORMATS.get('.' + format.lower().lstrip('.'), format.upper())
+    if isinstance(output, (str, os.PathLike)):
+        return IMAGE_FORMATS.get(os.path.splitext(output)[1].lower())
+    return None
+
+class PageSelectionError(ValueError):
+    """Raised for page ranges or rotations that are malformed or outside the document"""
+
+def parse_page_ranges(spec, page_count):
+    """Parse a selection like '1-3,7,10-' into a sorted list of 1-based page numbers"""
+    if not spec:
+        return list(range(1, page_count + 1))
+
+    pages = set()
+    for part in str(spec).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                start, end = part.split('-', 1)
+                start = int(start) if start.strip() else 1
+                end = int(end) if end.strip() else page_count
+            else:
+                start = end = int(part)
+        except ValueError:
+            raise PageSelectionError(f"Invalid page range: {part}")
+        if start < 1 or end > page_count or start > end:
+            raise PageSelectionError(f"Invalid page range: {part}")
+        pages.update(range(start, end + 1))
+    return sorted(pages)
+
+def parse_split_ranges(spec, every, page_count):
+    """Parse output ranges like '1-3,4-6,9-' (one PDF each), or cut every `every` pages when given"""
+    if every is not None:
+        every = int(every)
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        return [(start, min(start + every - 1, page_count)) for start in range(1, page_count + 1, every)]
+
+    ranges = []
+    for part in filter(None, (part.strip() for part in str(spec or '').split(','))):
+        pages = parse_page_ranges(part, page_count)
+        ranges.append((pages[0], pages[-1]))
+    if not ranges:
+        raise ValueError("No page ranges given")
+    # Repeated ranges would produce the same file twice
+    return list(dict.fromkeys(ranges))
+
+def parse_page_rotations(spec, page_count):
+    """Parse per-page angles like '1-3:90,7:180' into {1-based page number: degrees clockwise}"""
+    rotations = {}
+    for part in filter(None, (part.strip() for part in str(spec or '').split(','))):
+        pages, _, angle = part.rpartition(':')
+        try:
+            angle = int(angle)
+        except ValueError:
+            raise PageSelectionError(f"Invalid page rotation: {part}")
+        if not pages or angle % 90:
+            raise PageSelectionError(f"Invalid page rotation: {part}")
+        for page in parse_page_ranges(pages, page_count):
+            rotations[page] = angle % 360
+    return rotations
+
+def _page_chunks(pages, chunk_size):
+    """Group sorted page numbers into contiguous (first, last) runs of at most chunk_size pages"""
+    chunks = []
+    for page in pages:
+        if chunks and page == chunks[-1][1] + 1 and page - chunks[-1][0] < chunk_size:
+            chunks[-1][1] = page
+        else:
+            chunks.append([page, page])
+    return [tuple(chunk) for chunk in chunks]
+
+class ImageTooLargeError(Exception):
+    """Raised when an image would take more pixels than a request may decode"""
 
 class FileConverter:
-    def __init__(self):
-        self.poppler_path = os.path.join(os.path.dirname(__file__), 'poppler', 'poppler-23.08.0', 'Library', 'bin')
+    # Downscales by more than this are first box-reduced by an integer factor, then resampled
+    REDUCING_GAP = 3.0
+    # Output rows resampled at a time for large images
+    STRIP_HEIGHT = 256
+
+    def __init__(self, render_workers=None, render_chunk_size=8, output_dir='output',
+                 max_pixels=50_000_000, large_image_pixels=16_000_000,
+                 tool_workers=None, tool_timeout=120, tool_queue_timeout=30, ghostscript_path='gs', qpdf_path='qpdf'):
+        poppler_path = os.path.join(os.path.dirname(__file__), 'poppler', 'poppler-23.08.0', 'Library', 'bin')
+        # Bundled poppler only exists on Windows checkouts; elsewhere use the one on PATH
+        self.poppler_path = poppler_path if os.path.isdir(poppler_path) else None
+        self.render_workers = max(1, render_workers or os.cpu_count() or 1)
+        self.render_chunk_size = max(1, render_chunk_size)
+        self._render_pool = None
+        self.output_dir = output_dir
+        self.watermark_templates = WatermarkTemplates()
+        # Pixel budget of one decoded image (or result); 0 disables the check
+        self.max_pixels = max_pixels
+        # Images from this size on are decoded and resized in large-image mode
+        self.large_image_pixels = large_image_pixels
+        # Ghostscript and qpdf runs share a bounded set of process slots
+        self.tools = ExternalToolPool(tool_workers, tool_queue_timeout, tool_timeout)
+        self.ghostscript_path = ghostscript_path
+        self.qpdf_path = qpdf_path
 
-    def convert_pdf_to_png(self, pdf_path):
-        """Convert PDF to PNG"""
+    def get_pdf_page_count(self, pdf_path):
+        """Read the page count without rendering anything"""
+        return int(pdfinfo_from_path(pdf_path, poppler_path=self.poppler_path)['Pages'])
+
+    def _render_chunk(self, pdf_path, output_dir, first_page, last_page, dpi, size):
+        """Render one contiguous page run with a single pdftoppm process"""
+        return convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            size=size,
+            first_page=first_page,
+            last_page=last_page,
+            output_folder=output_dir,
+            output_file=f'p{first_page:06d}',
+            fmt='png',
+            paths_only=True,
+            thread_count=1,
+            poppler_path=self.poppler_path
+        )
+
+    def render_pdf_pages(self, pdf_path, output_dir, pages=None, dpi=200, size=None):
+        """
+        Render selected PDF pages to PNG files, spread across parallel poppler processes
+        Args:
+            pdf_path: Path to input PDF
+            output_dir: Directory to write the page images to
+            pages: Sorted list of 1-based page numbers (all pages if None)
+            dpi: Render resolution
+            size: Optional (width, height) target size, either may be None
+        Yields:
+            (page_number, png_path) tuples in page order, as soon as each chunk is rendered
+        """
+        if pages is None:
+            pages = list(range(1, self.get_pdf_page_count(pdf_path) + 1))
+        if not pages:
+            return
+
+        if self._render_pool is None:
+            # Rendering happens in pdftoppm child processes; threads only dispatch and wait on them
+            self._render_pool = ThreadPoolExecutor(max_workers=self.render_workers, thread_name_prefix='pdf-render')
+
+        futures = [
+            (first, last, self._render_pool.submit(self._render_chunk, pdf_path, output_dir, first, last, dpi, size))
+            for first, last in _page_chunks(pages, self.render_chunk_size)
+        ]
+        try:
+            for first, last, future in futures:
+                paths = future.result()
+                if len(paths) != last - first + 1:
+                    raise RuntimeError(f"Expected {last - first + 1} pages from {first}-{last}, got {len(paths)}")
+                for page, path in zip(range(first, last + 1), paths):
+                    yield page, path
+        finally:
+            for _, _, future in futures:
+                future.cancel()
+
+    def convert_pdf_to_png(self, pdf_path, page=1, dpi=200, size=None, output_dir=None):
+        """Convert a single PDF page (the first by default) to PNG in output_dir (default: the converter's output_dir)"""
         try:
-            # Convert PDF to images
-            images = convert_from_path(pdf_path, poppler_path=self.poppler_path)
-            
             # Save path
-            output_path = os.path.join('output', os.path.splitext(os.path.basename(pdf_path))[0] + '.png')
+            output_path = os.path.join(output_dir or self.output_dir, os.path.splitext(os.path.basename(pdf_path))[0] + '.png')
             
-            # Save the first page as PNG
-            images[0].save(output_path, 'PNG')
+            # Render only the requested page
+            with span('render'):
+                images = convert_from_path(pdf_path, dpi=dpi, size=size, first_page=page, last_page=page,
+                                           poppler_path=self.poppler_path)
+            with span('encode'):
+                images[0].save(output_path, 'PNG')
             
             return output_path
             
         except Exception as e:
             raise Exception(f"Error converting PDF to PNG: {str(e)}")
 
-    def png_to_pdf(self, png_path, output_path):
-        """Convert PNG to PDF"""
+    def images_to_pdf(self, image_paths, output_path, page_size='image', orientation='auto', fit='contain', margin=0):
+        """
+        Assemble images into a PDF, one page per image, embedding JPEGs and plain PNGs without re-encoding
+        Args:
+            image_paths: Paths of PNG, JPEG or WebP images, in page order
+            output_path: Where the PDF is written
+            page_size: 'image' for pages the size of each image, or a4, a3, a5, letter or legal
+            orientation: auto, portrait or landscape
+            fit: contain, cover or stretch, on fixed page sizes
+            margin: Blank border in points
+        """
         try:
-            image = Image.open(png_path)
-            rgb_image = image.convert('RGB')
-            rgb_image.save(output_path, 'PDF')
+            with span('write'), open(output_path, 'wb') as f:
+                for chunk in iter_images_pdf(image_paths, page_size=page_size, orientation=orientation, fit=fit,
+                                             margin=margin, check_pixels=self.check_pixels):
+                    f.write(chunk)
             return True
+        except ImageTooLargeError:
+            raise
         except Exception as e:
-            logging.error(f"Error converting PNG to PDF: {str(e)}")
+            logging.error(f"Error converting images to PDF: {str(e)}")
             return False
 
-    def combine_pdfs(self, pdf_paths, output_path):
-        """Combine multiple PDFs into one"""
+    def combine_pdfs(self, pdf_paths, output_path, streaming=False):
+        """Combine multiple PDFs into one; streaming merges page by page with bounded memory"""
         try:
+            if streaming:
+                with span('merge'), open(output_path, 'wb') as f:
+                    for chunk in iter_merged_pdf(pdf_paths):
+                        f.write(chunk)
+                return True
+
             from PyPDF2 import PdfMerger
             merger = PdfMerger()
             
             # Add each PDF to the merger
-            for pdf_path in pdf_paths:
-                merger.append(pdf_path)
+            with span('parse'):
+                for pdf_path in pdf_paths:
+                    merger.append(pdf_path)
             
             # Write the combined PDF to output path
-            merger.write(output_path)
+            with span('write'):
+                merger.write(output_path)
             merger.close()
             return True
         except Exception as e:
@@ -59,86 +271,216 @@ class FileConverter:
             return False
 
     def split_pdf(self, input_path, output_dir, start_page, end_page):
-        """Split PDF file into range of pages"""
+        """Split PDF file into range of pages, parsing only the pages in the range"""
         try:
-            reader = PdfReader(input_path)
-            writer = PdfWriter()
+            with open_mapped_pdf(input_path) as (reader, _):
+                # Validate page range
+                if start_page < 1 or end_page > page_count(reader) or start_page > end_page:
+                    raise ValueError("Invalid page range")
 
-            # Validate page range
-            if start_page < 1 or end_page > len(reader.pages) or start_page > end_page:
-                raise ValueError("Invalid page range")
+                # Generate output filename with page range
+                output_path = os.path.join(output_dir, f'split_{start_page}-{end_page}.pdf')
 
-            # Add specified pages to writer
-            for page_num in range(start_page - 1, end_page):
-                writer.add_page(reader.pages[page_num])
+                # Copy the range with only the objects its pages reference
+                merger = StreamingPdfMerger()
+                with span('copy'), open(output_path, 'wb') as output_file:
+                    self._write_pages(merger, merger.append_pages(reader, range(start_page - 1, end_page)), output_file)
 
-            # Generate output filename with page range
-            output_path = os.path.join(output_dir, f'split_{start_page}-{end_page}.pdf')
-            
-            # Write the output file
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
-            
             return output_path
         except Exception as e:
             logging.error(f"Error splitting PDF: {str(e)}")
             return None
 
-    def rotate_pdf(self, input_path, output_path, rotation):
-        """Rotate PDF pages"""
+    def split_pdf_parts(self, input_path, output_dir, ranges=None, every=None):
+        """
+        Split a PDF into several PDFs in one pass over the source
+        Args:
+            input_path: Path of the PDF
+            output_dir: Directory for the parts
+            ranges: Page ranges like '1-3,4-6,9-', one output each
+            every: Instead of ranges, cut the document every N pages
+        Yields:
+            (filename, path) of each part as soon as it is written. Invalid ranges
+            raise ValueError on the first iteration, before anything is written
+        """
+        with open_mapped_pdf(input_path) as (reader, _):
+            parts = parse_split_ranges(ranges, every, page_count(reader))
+
+            # Find every page once instead of descending the page tree for each part
+            wanted = {index for first, last in parts for index in range(first - 1, last)}
+            located = {page[0]: page for page in iter_page_refs(reader, wanted)}
+
+            # Resources used by several parts are parsed and fingerprinted only once
+            fingerprints = {}
+            for first, last in parts:
+                output_path = os.path.join(output_dir, f'split_{first}-{last}.pdf')
+                merger = StreamingPdfMerger(fingerprints=fingerprints)
+                with span('copy'), open(output_path, 'wb') as output_file:
+                    pages = [located[index] for index in range(first - 1, last)]
+                    self._write_pages(merger, merger.append_located(pages), output_file)
+                yield os.path.basename(output_path), output_path
+
+    def _write_pages(self, merger, pages, output_file):
+        """Drain a StreamingPdfMerger into a file while it copies pages, then finish the document"""
+        for _ in pages:
+            output_file.write(merger.writer.drain())
+        merger.close()
+        output_file.write(merger.writer.drain())
+
+    def rotate_pdf(self, input_path, output_path, rotation=90, pages=None, rotations=None):
+        """
+        Rotate PDF pages, appending only the changed page objects to the original file
+        Args:
+            input_path: Path of the PDF
+            output_path: Path for the rotated PDF
+            rotation: Degrees clockwise, a multiple of 90
+            pages: Pages to rotate by `rotation`, like '1-3,7'; every page when neither
+                this nor `rotations` is given
+            rotations: Per-page angles like '2:90,5-6:180', overriding `rotation` for those pages
+        Returns:
+            True on success, False otherwise
+        """
         try:
-            reader = PdfReader(input_path)
-            writer = PdfWriter()
+            with open_mapped_pdf(input_path) as (reader, data):
+                count = page_count(reader)
+                angles = {}
+                if pages or not rotations:
+                    angles = {page - 1: rotation % 360 for page in parse_page_ranges(pages, count)}
+                angles.update({page - 1: angle for page, angle in parse_page_rotations(rotations, count).items()})
+                angles = {index: angle for index, angle in angles.items() if angle}
 
-            # Process each page
-            for page in reader.pages:
-                page.rotate(rotation)
-                writer.add_page(page)
+                # Look up just the selected pages and replace them with rotated copies
+                updated = {}
+                with span('rotate'):
+                    for index, ref, inherited in iter_page_refs(reader, angles):
+                        page = ref.get_object()
+                        copy = DictionaryObject(page)
+                        copy[NameObject('/Rotate')] = NumberObject((page_rotation(page, inherited) + angles[index]) % 360)
+                        updated[(ref.idnum, ref.generation)] = copy
+
+                with span('write'), open(output_path, 'wb') as output_file:
+                    try:
+                        write_incremental_update(data, reader, updated, output_file)
+                    except ValueError as e:
+                        # Encrypted or damaged files are rewritten instead
+                        logging.info(f"Rewriting {input_path} instead of updating it: {str(e)}")
+                        merger = StreamingPdfMerger()
+                        self._write_pages(merger, merger.append_pages(reader, None, angles), output_file)
 
-            # Write the rotated PDF
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
-            
             return True
+        except PageSelectionError:
+            raise
         except Exception as e:
             logging.error(f"Error rotating PDF: {str(e)}")
             return False
 
-    def add_watermark(self, input_path, output_path, watermark_text):
-        """Add text watermark to PDF"""
+    def optimize_pdf(self, input_path, output_path, preset='ebook', dpi=None, quality=None,
+                     subset_fonts=True, object_streams=True):
+        """
+        Shrink a PDF by rewriting it with Ghostscript, then packing its objects with qpdf
+        Args:
+            input_path: Path of the PDF
+            output_path: Path for the optimized PDF
+            preset: One of PDF_PRESETS, supplying the image settings not given explicitly
+            dpi: Resolution color and gray images are downsampled to
+            quality: JPEG quality images are re-encoded at
+            subset_fonts: Embed only the glyphs that are used
+            object_streams: Pack objects into compressed object streams (needs qpdf on PATH)
+        Returns:
+            {'input_bytes', 'output_bytes', 'seconds', 'rewritten', 'object_streams'}, or None on error.
+            When the rewrite is not smaller, the original is written and 'rewritten' is False
+        """
+        staging = [f'{output_path}.gs.pdf', f'{output_path}.qpdf.pdf']
+        try:
+            started = time.perf_counter()
+            settings = dict(PDF_PRESETS[preset])
+            if dpi is not None:
+                settings['dpi'] = dpi
+            if quality is not None:
+                settings['quality'] = quality
+            if not shutil.which(self.ghostscript_path):
+                raise Exception(f"Ghostscript ({self.ghostscript_path}) is not installed")
+
+            with span('ghostscript'):
+                self.tools.run(ghostscript_args(self.ghostscript_path, input_path, staging[0], settings['dpi'],
+                                                settings['quality'], subset_fonts))
+            result = staging[0]
+            packed = bool(object_streams and shutil.which(self.qpdf_path))
+            if packed:
+                with span('qpdf'):
+                    self.tools.run(qpdf_args(self.qpdf_path, staging[0], staging[1]), ok_codes=QPDF_OK_CODES)
+                result = staging[1]
+
+            input_bytes = os.path.getsize(input_path)
+            rewritten = os.path.getsize(result) < input_bytes
+            if rewritten:
+                os.replace(result, output_path)
+            else:
+                # Already optimized files can grow when rewritten
+                shutil.copyfile(input_path, output_path)
+            return {
+                'input_bytes': input_bytes,
+                'output_bytes': os.path.getsize(output_path),
+                'seconds': round(time.perf_counter() - started, 3),
+                'rewritten': rewritten,
+                'object_streams': packed and rewritten,
+            }
+        except (ToolBusyError, ToolTimeoutError):
+            raise
+        except Exception as e:
+            logging.error(f"Error optimizing PDF: {str(e)}")
+            return None
+        finally:
+            for path in staging:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def add_watermark(self, input_path, output_path, watermark_text, font='Helvetica', size=60,
+                      opacity=0.3, angle=45, fast=True):
+        """
+        Add text watermark to PDF, centered on the visible box of every page
+        Args:
+            input_path: Path to the PDF
+            output_path: Path to save the watermarked PDF
+            watermark_text: Text to stamp
+            font: One of the standard PDF fonts
+            size: Font size in points
+            opacity: 0 (invisible) to 1 (opaque)
+            angle: Counter-clockwise text angle in degrees
+            fast: Draw one shared Form XObject per page geometry instead of
+                merging the stamp into every page's content
+        Returns:
+            True on success, False otherwise
+        """
         try:
-            # Create watermark
-            packet = io.BytesIO()
-            can = canvas.Canvas(packet, pagesize=letter)
-            
-            # Configure watermark text
-            can.setFont("Helvetica", 60)
-            can.setFillColorRGB(0.5, 0.5, 0.5, alpha=0.3)  # Gray, 30% opacity
-            can.saveState()
-            can.translate(300, 400)
-            can.rotate(45)
-            can.drawString(0, 0, watermark_text)
-            can.restoreState()
-            can.save()
-            
-            # Move to the beginning of the BytesIO buffer
-            packet.seek(0)
-            watermark = PdfReader(packet)
-            
-            # Get the first page of the watermark
-            watermark_page = watermark.pages[0]
-            
-            # Read the input PDF
             reader = PdfReader(input_path)
             writer = PdfWriter()
+            stamps = {}  # page geometry -> parsed template for this document
             
-            # Add watermark to each page
-            for page in reader.pages:
-                page.merge_page(watermark_page)
-                writer.add_page(page)
+            with span('stamp'):
+                for page in reader.pages:
+                    geometry = page_geometry(page)
+                    if geometry not in stamps:
+                        _, _, width, height, rotate = geometry
+                        if rotate in (90, 270):
+                            width, height = height, width
+                        template = self.watermark_templates.get(watermark_text, width, height, font, size, opacity, angle)
+                        template_page = PdfReader(io.BytesIO(template)).pages[0]
+                        if fast:
+                            stamps[geometry] = self._watermark_xobject(writer, template_page, geometry, len(stamps))
+                        else:
+                            template_page.add_transformation(placement(geometry))
+                            stamps[geometry] = template_page
+                
+                    if fast:
+                        page = writer.add_page(page)
+                        self._stamp_page(writer, page, *stamps[geometry])
+                    else:
+                        page.merge_page(stamps[geometry])
+                        writer.add_page(page)
             
             # Write the watermarked PDF
-            with open(output_path, 'wb') as output_file:
+            with span('write'), open(output_path, 'wb') as output_file:
                 writer.write(output_file)
             
             return True
@@ -146,60 +488,335 @@ class FileConverter:
             logging.error(f"Error adding watermark: {str(e)}")
             return False
 
+    def _watermark_xobject(self, writer, template_page, geometry, index):
+        """Add a template page to writer as a Form XObject, with the content streams that draw it"""
+        form = DecodedStreamObject()
+        form.set_data(template_page.get_contents().get_data())
+        form.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([NumberObject(0), NumberObject(0),
+                                              template_page.mediabox[2], template_page.mediabox[3]]),
+            NameObject('/Resources'): template_page['/Resources'].clone(writer),
+        })
+        name = NameObject(f'/Watermark{index}')
+        matrix = ' '.join(f'{value:g}' for value in placement(geometry))
+        # The page's own content is wrapped in q/Q so its graphics state cannot leak into the stamp
+        save = DecodedStreamObject()
+        save.set_data(b'q\n')
+        draw = DecodedStreamObject()
+        draw.set_data(f'\nQ q {matrix} cm {name} Do Q\n'.encode())
+        return name, writer._add_object(form), writer._add_object(save), writer._add_object(draw)
+
+    def _stamp_page(self, writer, page, name, form, save, draw):
+        """Reference a watermark XObject from a page without touching its existing content"""
+        if '/Resources' not in page:
+            page[NameObject('/Resources')] = DictionaryObject()
+        resources = page['/Resources']
+        if '/XObject' not in resources:
+            resources[NameObject('/XObject')] = DictionaryObject()
+        resources['/XObject'][name] = form
+        
+        contents = page.raw_get('/Contents') if '/Contents' in page else ArrayObject()
+        if isinstance(contents.get_object(), ArrayObject):
+            contents = list(contents.get_object())
+        else:
+            contents = [contents]
+        page[NameObject('/Contents')] = ArrayObject([save] + contents + [draw])
+
+    # In-memory image operations, shared by the single-step routes and the pipeline
+    def resize_dimensions(self, size, width, height, maintain_aspect=True):
+        """Target size for a resize of an image of the given size"""
+        if maintain_aspect:
+            # Calculate new dimensions maintaining aspect ratio
+            img_width, img_height = size
+            aspect = img_width / img_height
+            if width:
+                height = int(width / aspect)
+            else:
+                width = int(height * aspect)
+        else:
+            # A side left out keeps its current length
+            width, height = width or size[0], height or size[1]
+        return max(1, width), max(1, height)
+
+    def resize(self, img, width, height, maintain_aspect=True):
+        """Return img resized to the given width and/or height"""
+        size = self.resize_dimensions(img.size, width, height, maintain_aspect)
+        if img.width * img.height >= self.large_image_pixels:
+            return self._resize_large(img, size)
+        return img.resize(size, Image.Resampling.LANCZOS)
+
+    def _resize_large(self, img, size):
+        """Resize without a full-height intermediate: box-reduce big downscales, then resample strip by strip"""
+        if img.mode not in ('1', 'P'):
+            factor = int(min(img.width / size[0], img.height / size[1]) / self.REDUCING_GAP)
+            if factor > 1:
+                img = img.reduce(factor)
+
+        output = Image.new(img.mode, size)
+        if img.mode == 'P':
+            output.putpalette(img.getpalette())
+        scale = img.height / size[1]
+        for top in range(0, size[1], self.STRIP_HEIGHT):
+            bottom = min(top + self.STRIP_HEIGHT, size[1])
+            # The filter still reads source rows just outside the box, so strips join seamlessly
+            strip = img.resize((size[0], bottom - top), Image.Resampling.LANCZOS,
+                               box=(0, top * scale, img.width, bottom * scale))
+            output.paste(strip, (0, top))
+        return output
+
+    def open_image(self, input_path):
+        """Open an image without decoding it; PIL's decompression bomb limit counts as over budget"""
+        try:
+            return Image.open(input_path)
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(str(e))
+
+    def load_image(self, img, target_size=None):
+        """
+        Decode an opened image within the pixel budget
+        Args:
+            img: Image from open_image, not loaded yet
+            target_size: (width, height) it will be reduced to, if known. Large JPEGs
+                are then decoded at the smallest DCT scale (1/2 to 1/8) that still covers it
+        """
+        if target_size and img.format == 'JPEG' and img.width * img.height >= self.large_image_pixels:
+            img.draft(img.mode, target_size)
+        self.check_pixels(img.size)
+        img.load()
+        return img
+
+    def check_pixels(self, size):
+        """Raise ImageTooLargeError if an image of this size is over the pixel budget"""
+        if self.max_pixels and size[0] * size[1] > self.max_pixels:
+            raise ImageTooLargeError(
+                f"Image of {size[0]}x{size[1]} pixels is over the limit of {self.max_pixels} pixels"
+            )
+
+    def rotate(self, img, angle):
+        """Return img rotated clockwise by angle degrees, growing the canvas to fit"""
+        if angle % 90 == 0:
+            return img.transpose({90: Image.Transpose.ROTATE_270, 180: Image.Transpose.ROTATE_180,
+                                  270: Image.Transpose.ROTATE_90}[angle % 360]) if angle % 360 else img
+        return img.rotate(-angle, resample=Image.Resampling.BICUBIC, expand=True)
+
+    def encode(self, img, output, format, quality=95):
+        """Encode img once into a path or buffer"""
+        # Convert to RGB if saving as JPEG
+        if format == 'JPEG' and img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGB')
+        img.save(output, format=format, quality=quality, optimize=self.optimize_encoding(img, format))
+
+    def optimize_encoding(self, img, format):
+        """Whether to optimize the encoder's tables; for JPEG that buffers every DCT coefficient, so not for large images"""
+        return format != 'JPEG' or img.width * img.height < self.large_image_pixels
+
     # Image Processing Functions
-    def resize_image(self, input_path, output_path, width, height, maintain_aspect=True):
+    # Inputs and outputs may be paths or binary file objects; pass format when writing to a buffer
+    def resize_image(self, input_path, output_path, width, height, maintain_aspect=True, format=None):
         """Resize image to specified dimensions"""
         try:
-            with Image.open(input_path) as img:
-                if maintain_aspect:
-                    # Calculate new dimensions maintaining aspect ratio
-                    img_width, img_height = img.size
-                    aspect = img_width / img_height
-                    if width:
-                        height = int(width / aspect)
-                    else:
-                        width = int(height * aspect)
-                
-                resized_img = img.resize((width, height), Image.Resampling.LANCZOS)
-                resized_img.save(output_path, quality=95, optimize=True)
+            with self.open_image(input_path) as img:
+                size = self.resize_dimensions(img.size, width, height, maintain_aspect)
+                self.check_pixels(size)
+                with span('decode'):
+                    self.load_image(img, size)
+                with span('resize'):
+                    resized_img = self.resize(img, *size, maintain_aspect=False)
+                output_format = image_format(output_path, format)
+                with span('encode'):
+                    resized_img.save(output_path, format=output_format, quality=95,
+                                     optimize=self.optimize_encoding(resized_img, output_format))
             return True
+        except ImageTooLargeError:
+            raise
         except Exception as e:
             logging.error(f"Error resizing image: {str(e)}")
             return False
 
-    def crop_image(self, input_path, output_path, left, top, right, bottom):
+    def crop_image(self, input_path, output_path, left, top, right, bottom, format=None):
         """Crop image to specified coordinates"""
         try:
-            with Image.open(input_path) as img:
-                cropped_img = img.crop((left, top, right, bottom))
-                cropped_img.save(output_path, quality=95, optimize=True)
+            with self.open_image(input_path) as img:
+                with span('decode'):
+                    self.load_image(img)
+                # Boxes reaching past the image are padded, so the box itself is held to the budget
+                self.check_pixels((max(0, right - left), max(0, bottom - top)))
+                with span('crop'):
+                    cropped_img = img.crop((left, top, right, bottom))
+                output_format = image_format(output_path, format)
+                with span('encode'):
+                    cropped_img.save(output_path, format=output_format, quality=95,
+                                     optimize=self.optimize_encoding(cropped_img, output_format))
             return True
+        except ImageTooLargeError:
+            raise
         except Exception as e:
             logging.error(f"Error cropping image: {str(e)}")
             return False
 
-    def convert_image_format(self, input_path, output_path):
-        """Convert image to different format based on output extension"""
+    def convert_image_format(self, input_path, output_path, format=None):
+        """Convert image to different format based on output extension (or format for buffers)"""
         try:
-            with Image.open(input_path) as img:
+            with self.open_image(input_path) as img:
+                with span('decode'):
+                    self.load_image(img)
+                output_format = image_format(output_path, format)
                 # Convert to RGB if saving as JPEG
-                if output_path.lower().endswith(('.jpg', '.jpeg')) and img.mode in ('RGBA', 'P'):
+                if output_format == 'JPEG' and img.mode in ('RGBA', 'P'):
                     img = img.convert('RGB')
-                img.save(output_path, quality=95, optimize=True)
+                with span('encode'):
+                    img.save(output_path, format=output_format, quality=95,
+                             optimize=self.optimize_encoding(img, output_format))
             return True
+        except ImageTooLargeError:
+            raise
         except Exception as e:
             logging.error(f"Error converting image: {str(e)}")
             return False
 
-    def compress_image(self, input_path, output_path, quality):
+    def compress_to_size(self, input_path, output_path, target_bytes, formats=('JPEG',), max_trials=8, min_quality=10):
+        """
+        Encode an image as close as possible below a size, searching the quality in memory
+        Args:
+            input_path: Path or binary file object of the image
+            output_path: Path or binary file object for the result
+            target_bytes: Size the result should not exceed
+            formats: Output formats to try, JPEG and/or WEBP; JPEG is skipped for images with transparency
+            max_trials: Most trial encodes, over all formats
+            min_quality: Lowest quality tried
+        Returns:
+            {'format', 'quality', 'subsampling', 'bytes', 'trials', 'fits'} of the result, or None on error.
+            When nothing fits, the smallest encode is written and 'fits' is False
+        """
+        try:
+            with self.open_image(input_path) as img:
+                input_bytes = self._input_size(input_path)
+                if img.format in formats and input_bytes <= target_bytes:
+                    # Already small enough in an accepted format; re-encoding could only lose quality
+                    with self._open_input(input_path) as source:
+                        self._write_output(output_path, source.read())
+                    return {'format': img.format, 'quality': estimate_jpeg_quality(img), 'subsampling': None,
+                            'bytes': input_bytes, 'trials': 0, 'fits': True}
+
+                with span('decode'):
+                    self.load_image(img)
+                # Searching above the quality the source was saved with only adds bytes
+                start = min(estimate_jpeg_quality(img) or 90, 95)
+                alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+                formats = [f for f in formats if not (f == 'JPEG' and alpha)] or ['WEBP']
+                source = img if img.mode in ('RGB', 'RGBA', 'L') else img.convert('RGBA' if alpha else 'RGB')
+
+                # The image is decoded once; every trial encodes it into memory
+                max_trials = max(1, max_trials)
+                trials = []
+                best = None
+                with span('encode'):
+                    for output_format in formats:
+                        # Split what is left of the trial cap between the remaining formats
+                        budget = (max_trials - len(trials)) // (len(formats) - formats.index(output_format))
+                        if budget < 1:
+                            continue
+                        result = self._search_quality(source, output_format, target_bytes, start, min_quality, budget, trials)
+                        if best is None or self._better_fit(result, best, target_bytes):
+                            best = result
+
+            data, info = best
+            self._write_output(output_path, data)
+            return dict(info, bytes=len(data), trials=len(trials), fits=len(data) <= target_bytes)
+        except ImageTooLargeError:
+            raise
+        except Exception as e:
+            logging.error(f"Error compressing image to {target_bytes} bytes: {str(e)}")
+            return None
+
+    def _input_size(self, input_path):
+        if isinstance(input_path, (str, os.PathLike)):
+            return os.path.getsize(input_path)
+        position = input_path.tell()
+        size = input_path.seek(0, os.SEEK_END)
+        input_path.seek(position)
+        return size
+
+    @contextmanager
+    def _open_input(self, input_path):
+        """The input as a binary file object read from the start"""
+        if isinstance(input_path, (str, os.PathLike)):
+            with open(input_path, 'rb') as f:
+                yield f
+        else:
+            input_path.seek(0)
+            yield input_path
+
+    def _write_output(self, output_path, data):
+        if isinstance(output_path, (str, os.PathLike)):
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        else:
+            output_path.write(data)
+
+    def _encode_trial(self, img, output_format, quality, subsampling, trials):
+        buffer = io.BytesIO()
+        options = {'quality': quality, 'optimize': self.optimize_encoding(img, output_format)}
+        if output_format == 'JPEG':
+            options['subsampling'] = subsampling
+        img.save(buffer, format=output_format, **options)
+        trials.append((output_format, quality, buffer.tell()))
+        return buffer.getvalue(), {'format': output_format, 'quality': quality,
+                                   'subsampling': '4:2:0' if subsampling == 2 else '4:4:4' if output_format == 'JPEG' else None}
+
+    def _search_quality(self, img, output_format, target_bytes, start, min_quality, budget, trials):
+        """Binary search the highest quality that fits, starting at `start`; returns (data, info) of the best encode"""
+        used = len(trials)
+        if budget < 1:
+            return None
+        # 4:2:0 chroma subsampling while searching; full chroma is tried last if there is room for it
+        result = smallest = self._encode_trial(img, output_format, start, 2, trials)
+        best = result if len(result[0]) <= target_bytes else None
+        # If the starting quality fits there is nothing higher worth trying
+        low, high = (start + 1, start) if best else (min_quality, start - 1)
+        while low <= high and len(trials) - used < budget:
+            quality = (low + high) // 2
+            result = self._encode_trial(img, output_format, quality, 2, trials)
+            if len(result[0]) <= target_bytes:
+                best, low = result, quality + 1
+            else:
+                high = quality - 1
+                smallest = result
+
+        if best is not None and output_format == 'JPEG' and len(trials) - used < budget:
+            result = self._encode_trial(img, output_format, best[1]['quality'], 0, trials)
+            if len(result[0]) <= target_bytes:
+                best = result
+        return best or smallest
+
+    def _better_fit(self, result, best, target_bytes):
+        """Prefer results that fit, then the one using more of the target, or the smaller file when neither fits.
+        Sizes rather than quality numbers, since JPEG and WebP qualities are not on the same scale"""
+        fits, best_fits = len(result[0]) <= target_bytes, len(best[0]) <= target_bytes
+        if fits != best_fits:
+            return fits
+        if not fits:
+            return len(result[0]) < len(best[0])
+        return len(result[0]) > len(best[0])
+
+    def compress_image(self, input_path, output_path, quality, format=None):
         """Compress image with specified quality (1-100)"""
         try:
-            with Image.open(input_path) as img:
+            with self.open_image(input_path) as img:
+                with span('decode'):
+                    self.load_image(img)
+                output_format = image_format(output_path, format)
                 # Convert to RGB if saving as JPEG
-                if output_path.lower().endswith(('.jpg', '.jpeg')) and img.mode in ('RGBA', 'P'):
+                if output_format == 'JPEG' and img.mode in ('RGBA', 'P'):
                     img = img.convert('RGB')
-                img.save(output_path, quality=quality, optimize=True)
+                with span('encode'):
+                    img.save(output_path, format=output_format, quality=quality,
+                             optimize=self.optimize_encoding(img, output_format))
             return True
+        except ImageTooLargeError:
+            raise
         except Exception as e:
             logging.error(f"Error compressing image: {str(e)}")
             return False
@@ -0,0 +1,65 @@
+"""Production server settings: gunicorn -c gunicorn.conf.py app:app"""
+import logging
+import os
+import sys
+
+# Every worker thread gets its own model session; single-threaded sessions keep
+# onnxruntime from starting thread pools in the master that forked workers would lose
+os.environ.setdefault('REMBG_POOL_SIZE', os.environ.get('GUNICORN_THREADS', '4'))
+os.environ.setdefault('REMBG_INTRA_OP_THREADS', '1')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+# Also read by app.py, which splits its admission budgets across workers
+workers = int(os.environ.setdefault('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Load app.py (and with it FileConverter and the warmed BackgroundRemover) once in the
+# master, so the model weights are shared copy-on-write by all forked workers
+preload_app = True
+
+# Large PDFs and background removal can run for minutes
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 120))
+keepalive = 5
+
+accesslog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+def memory_usage():
+    """RSS and PSS of the current process in MB; PSS splits shared pages between the processes using them"""
+    usage = {}
+    for path, fields in (('/proc/self/status', {'VmRSS:': 'rss_mb'}), ('/proc/self/smaps_rollup', {'Pss:': 'pss_mb'})):
+        try:
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    if parts and parts[0] in fields:
+                        usage[fields[parts[0]]] = round(int(parts[1]) / 1024, 1)
+        except OSError:
+            pass
+    return usage
+
+def when_ready(server):
+    server.log.info(f"Master ready after preload: {memory_usage()}")
+
+def post_worker_init(worker):
+    worker.log.info(f"Worker {worker.pid} started: {memory_usage()}")
+
+def _exit_now(default_code):
+    """Exit without interpreter finalization.
+
+    rembg imports numba, whose thread pool makes shutdown hang in any process that
+    has forked after the import; requests are drained by the time this runs.
+    """
+    exc = sys.exc_info()[1]
+    code = exc.code if isinstance(exc, SystemExit) and isinstance(exc.code, int) else default_code
+    logging.shutdown()
+    os._exit(code)
+
+def worker_exit(server, worker):
+    server.log.info(f"Worker {worker.pid} exiting: {memory_usage()}")
+    _exit_now(0)
+
+def on_exit(server):
+    _exit_now(0)
@@ -0,0 +1,351 @@
+"""Assemble images into a PDF one page at a time, embedding their compressed data where PDF can take it as-is"""
+from PyPDF2.generic import (
+    ArrayObject, ByteStringObject, DictionaryObject, FloatObject, IndirectObject, NameObject, NumberObject, StreamObject
+)
+from pdf_stream import IncrementalPdfWriter, finish_document
+from PIL import Image
+import hashlib
+import struct
+import zlib
+import io
+
+# Page sizes in points (1/72 inch), portrait
+PAGE_SIZES = {
+    'a3': (841.89, 1190.55),
+    'a4': (595.28, 841.89),
+    'a5': (419.53, 595.28),
+    'letter': (612, 792),
+    'legal': (612, 1008),
+}
+
+FITS = ('contain', 'cover', 'stretch')
+ORIENTATIONS = ('auto', 'portrait', 'landscape')
+
+# Resolution of images that do not state one, when the page takes the image's size
+DEFAULT_DPI = 72
+
+# Map the unit square of the stored image onto its upright position for each EXIF orientation,
+# as (a, b, c, d, e, f) of a PDF matrix
+ORIENTATION_MATRICES = {
+    1: (1, 0, 0, 1, 0, 0),
+    2: (-1, 0, 0, 1, 1, 0),
+    3: (-1, 0, 0, -1, 1, 1),
+    4: (1, 0, 0, -1, 0, 1),
+    5: (0, -1, -1, 0, 1, 1),
+    6: (0, -1, 1, 0, 0, 1),
+    7: (0, 1, 1, 0, 0, 0),
+    8: (0, 1, -1, 0, 1, 0),
+}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color types whose zlib data PDF decodes itself (with the PNG predictors), and the bit depths it accepts
+PNG_PASSTHROUGH = {0: (1, 2, 4, 8, 16), 2: (8, 16), 3: (1, 2, 4, 8)}
+
+def _number(value):
+    if float(value).is_integer():
+        return NumberObject(int(value))
+    return FloatObject(f'{value:.4f}'.rstrip('0'))
+
+def _format(value):
+    return b'%d' % value if float(value).is_integer() else f'{value:.4f}'.rstrip('0').encode()
+
+def read_png(data):
+    """
+    Split a PNG into what an image XObject needs
+    Args:
+        data: Bytes of the PNG
+    Returns:
+        Dict with width, height, depth, color_type, interlaced, palette, transparency,
+        icc (decompressed profile or None) and idat (the concatenated zlib stream)
+    """
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    png = {'palette': None, 'transparency': False, 'icc': None}
+    idat = []
+    position = 8
+    while position + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        position += 12 + length
+        if kind == b'IHDR':
+            (png['width'], png['height'], png['depth'], png['color_type'],
+             _, _, interlace) = struct.unpack('>IIBBBBB', body[:13])
+            png['interlaced'] = bool(interlace)
+        elif kind == b'PLTE':
+            png['palette'] = body
+        elif kind == b'tRNS':
+            png['transparency'] = True
+        elif kind == b'iCCP':
+            # Profile name, a null byte, the compression method, then the zlib data
+            png['icc'] = zlib.decompress(body[body.index(b'\0') + 2:])
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+    if 'width' not in png or not idat:
+        raise ValueError("PNG has no image data")
+    png['idat'] = b''.join(idat)
+    return png
+
+def webp_is_lossless(data):
+    """Whether a WebP holds a lossless (VP8L) bitstream rather than a lossy (VP8) one"""
+    position = 12
+    while position + 8 <= len(data):
+        kind = data[position:position + 4]
+        if kind in (b'VP8L', b'VP8 '):
+            return kind == b'VP8L'
+        length = struct.unpack('<I', data[position + 4:position + 8])[0]
+        position += 8 + length + (length & 1)
+    return False
+
+def page_layout(image_size, page_size='image', orientation='auto', fit='contain', margin=0):
+    """
+    Where an image goes on its page
+    Args:
+        image_size: Upright (width, height) of the image in points
+        page_size: 'image' for a page the size of the image, or one of PAGE_SIZES
+        orientation: 'auto' turns the page to match the image, or 'portrait'/'landscape'
+        fit: 'contain' (whole image, centered), 'cover' (fill the page, cropping the overflow) or 'stretch'
+        margin: Points left blank on every side
+    Returns:
+        ((page width, page height), (x, y, width, height) of the image, clip box or None)
+    """
+    width, height = image_size
+    if page_size == 'image':
+        return (width + 2 * margin, height + 2 * margin), (margin, margin, width, height), None
+
+    short, long = sorted(PAGE_SIZES[page_size])
+    landscape = orientation == 'landscape' or (orientation == 'auto' and width > height)
+    page = (long, short) if landscape else (short, long)
+    box_width, box_height = page[0] - 2 * margin, page[1] - 2 * margin
+    if box_width <= 0 or box_height <= 0:
+        raise ValueError(f"Margin of {margin}pt leaves no room on a {page_size} page")
+    if fit == 'stretch':
+        return page, (margin, margin, box_width, box_height), None
+
+    scale = (min if fit == 'contain' else max)(box_width / width, box_height / height)
+    placed = (margin + (box_width - width * scale) / 2, margin + (box_height - height * scale) / 2,
+              width * scale, height * scale)
+    return page, placed, (margin, margin, box_width, box_height) if fit == 'cover' else None
+
+class ImagePdfWriter:
+    """Write images as the pages of a PDF, one page at a time.
+
+    JPEGs are embedded as DCT streams and non-interlaced PNGs without
+    transparency as Flate streams with PNG predictors, both copied byte for
+    byte without decoding. Other PNGs, and lossless WebPs, are decoded and
+    deflated once, with any alpha as a soft mask; lossy WebPs are re-encoded
+    as JPEG. Only the image being written is held in memory, and EXIF
+    orientation is applied by the page's transform, not by turning pixels.
+    """
+
+    def __init__(self, writer=None, page_size='image', orientation='auto', fit='contain', margin=0,
+                 quality=90, check_pixels=None):
+        if page_size != 'image' and page_size not in PAGE_SIZES:
+            raise ValueError(f"Unknown page size: {page_size}. Choose from image, {', '.join(PAGE_SIZES)}")
+        if fit not in FITS:
+            raise ValueError(f"Unknown fit: {fit}. Choose from {', '.join(FITS)}")
+        if orientation not in ORIENTATIONS:
+            raise ValueError(f"Unknown orientation: {orientation}. Choose from {', '.join(ORIENTATIONS)}")
+        if margin < 0:
+            raise ValueError("Margin must not be negative")
+        self.writer = writer or IncrementalPdfWriter()
+        self.pages_number = self.writer.reserve()
+        self.page_size = page_size
+        self.orientation = orientation
+        self.fit = fit
+        self.margin = margin
+        # JPEG quality of re-encoded lossy WebPs
+        self.quality = quality
+        # Called with (width, height) before an image is decoded, to enforce a pixel budget
+        self.check_pixels = check_pixels
+        self.passthrough_images = 0
+        self.decoded_images = 0
+        self._kids = []
+        self._profiles = {}  # ICC profile digest -> object number, shared by all pages
+
+    def append(self, image_path):
+        """
+        Add one image as a page
+        Args:
+            image_path: Path of a JPEG, PNG or WebP
+        Returns:
+            Object number of the page; drain the writer afterwards
+        """
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format not in ('JPEG', 'PNG', 'WEBP'):
+                raise ValueError(f"Unsupported image format: {img.format}")
+            orientation = img.getexif().get(0x0112, 1)
+            dpi = img.info.get('dpi') or (DEFAULT_DPI, DEFAULT_DPI)
+            size = img.size
+            image_number = self._write_image(img, data)
+
+        # Upright size in points; orientations 5-8 swap the sides
+        if orientation not in ORIENTATION_MATRICES:
+            orientation = 1
+        dpi_x, dpi_y = (value if value and value >= 1 else DEFAULT_DPI for value in dpi)
+        width, height = size[0] * 72 / dpi_x, size[1] * 72 / dpi_y
+        if orientation >= 5:
+            width, height = height, width
+        page_size, (x, y, w, h), clip = page_layout((width, height), self.page_size, self.orientation,
+                                                   self.fit, self.margin)
+
+        a, b, c, d, e, f = ORIENTATION_MATRICES[orientation]
+        matrix = (a * w, b * h, c * w, d * h, e * w + x, f * h + y)
+        content = [b'q']
+        if clip:
+            content.append(b' '.join(map(_format, clip)) + b' re W n')
+        content.append(b' '.join(map(_format, matrix)) + b' cm /Im0 Do Q')
+        return self._write_page(page_size, image_number, b'\n'.join(content))
+
+    def _write_page(self, page_size, image_number, content):
+        content_number = self.writer.reserve()
+        stream = StreamObject()
+        stream._data = content
+        self.writer.write_object(content_number, stream)
+
+        number = self.writer.reserve()
+        self.writer.write_object(number, DictionaryObject({
+            NameObject('/Type'): NameObject('/Page'),
+            NameObject('/Parent'): IndirectObject(self.pages_number, 0, None),
+            NameObject('/MediaBox'): ArrayObject([NumberObject(0), NumberObject(0)] + [_number(v) for v in page_size]),
+            NameObject('/Resources'): DictionaryObject({
+                NameObject('/XObject'): DictionaryObject({
+                    NameObject('/Im0'): IndirectObject(image_number, 0, None),
+                }),
+            }),
+            NameObject('/Contents'): IndirectObject(content_number, 0, None),
+        }))
+        self._kids.append(number)
+        return number
+
+    def _write_image(self, img, data):
+        """Write the image XObject of an opened image and return its object number"""
+        if img.format == 'JPEG' and img.mode in ('L', 'RGB', 'CMYK'):
+            self.passthrough_images += 1
+            return self._write_jpeg(img, data)
+        if img.format == 'PNG':
+            png = read_png(data)
+            if (not png['interlaced'] and not png['transparency']
+                    and png['depth'] in PNG_PASSTHROUGH.get(png['color_type'], ())):
+                self.passthrough_images += 1
+                return self._write_png(png)
+
+        if self.check_pixels:
+            self.check_pixels(img.size)
+        self.decoded_images += 1
+        img.load()
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        if img.format == 'WEBP' and not has_alpha and not webp_is_lossless(data):
+            # Deflating decoded photos would multiply their size; JPEG keeps them close to the original
+            buffer = io.BytesIO()
+            img.convert('RGB').save(buffer, 'JPEG', quality=self.quality)
+            with Image.open(buffer) as jpeg:
+                return self._write_jpeg(jpeg, buffer.getvalue(), img.info.get('icc_profile'))
+
+        base = 'L' if img.mode in ('1', 'L', 'LA', 'I', 'I;16', 'F') else 'RGB'
+        mask_number = None
+        if has_alpha:
+            img = img.convert(base + 'A')
+            alpha = img.getchannel('A')
+            if alpha.getextrema() != (255, 255):
+                mask_number = self._write_png(read_png(self._deflate(alpha)))
+        icc = img.info.get('icc_profile')
+        return self._write_png(read_png(self._deflate(img.convert(base))), mask_number, icc)
+
+    def _deflate(self, img):
+        """Compress decoded pixels once, with PNG's per-row filters, which PDF's predictors undo"""
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG', compress_level=6)
+        return buffer.getvalue()
+
+    def _write_jpeg(self, img, data, icc=None):
+        components = {'L': 1, 'RGB': 3, 'CMYK': 4}[img.mode]
+        stream = StreamObject()
+        stream._data = data
+        stream.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Image'),
+            NameObject('/Width'): NumberObject(img.width),
+            NameObject('/Height'): NumberObject(img.height),
+            NameObject('/BitsPerComponent'): NumberObject(8),
+            NameObject('/ColorSpace'): self._color_space(components, icc or img.info.get('icc_profile')),
+            NameObject('/Filter'): NameObject('/DCTDecode'),
+        })
+        if img.mode == 'CMYK' and 'adobe' in img.info:
+            # Adobe CMYK JPEGs store inverted ink values
+            stream[NameObject('/Decode')] = ArrayObject(NumberObject(v) for v in (1, 0) * 4)
+        number = self.writer.reserve()
+        self.writer.write_object(number, stream)
+        return number
+
+    def _write_png(self, png, mask_number=None, icc=None):
+        colors = 3 if png['color_type'] == 2 else 1
+        if png['color_type'] == 3:
+            color_space = ArrayObject([NameObject('/Indexed'), NameObject('/DeviceRGB'),
+                                       NumberObject(len(png['palette']) // 3 - 1), ByteStringObject(png['palette'])])
+        else:
+            color_space = self._color_space(colors, icc or png['icc'])
+        stream = StreamObject()
+        stream._data = png['idat']
+        stream.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Image'),
+            NameObject('/Width'): NumberObject(png['width']),
+            NameObject('/Height'): NumberObject(png['height']),
+            NameObject('/BitsPerComponent'): NumberObject(png['depth']),
+            NameObject('/ColorSpace'): color_space,
+            NameObject('/Filter'): NameObject('/FlateDecode'),
+            NameObject('/DecodeParms'): DictionaryObject({
+                NameObject('/Predictor'): NumberObject(15),
+                NameObject('/Colors'): NumberObject(colors),
+                NameObject('/BitsPerComponent'): NumberObject(png['depth']),
+                NameObject('/Columns'): NumberObject(png['width']),
+            }),
+        })
+        if mask_number is not None:
+            stream[NameObject('/SMask')] = IndirectObject(mask_number, 0, None)
+        number = self.writer.reserve()
+        self.writer.write_object(number, stream)
+        return number
+
+    def _color_space(self, components, icc=None):
+        """Device color space for a component count, or an ICC-based one written once per distinct profile"""
+        device = NameObject({1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}[components])
+        if not icc:
+            return device
+        digest = hashlib.sha256(icc).digest()
+        if digest not in self._profiles:
+            stream = StreamObject()
+            stream._data = zlib.compress(icc)
+            stream.update({
+                NameObject('/N'): NumberObject(components),
+                NameObject('/Alternate'): device,
+                NameObject('/Filter'): NameObject('/FlateDecode'),
+            })
+            self._profiles[digest] = self.writer.reserve()
+            self.writer.write_object(self._profiles[digest], stream)
+        return ArrayObject([NameObject('/ICCBased'), IndirectObject(self._profiles[digest], 0, None)])
+
+    def close(self):
+        """Write the page tree, catalog and trailer"""
+        finish_document(self.writer, self.pages_number, self._kids)
+
+def iter_images_pdf(image_paths, **options):
+    """
+    Write images as a PDF with ImagePdfWriter and yield the output as it is produced
+    Args:
+        image_paths: Paths of the images, in page order
+        options: ImagePdfWriter options (page_size, orientation, fit, margin, quality, check_pixels)
+    Yields:
+        Bytes of the PDF, one page with its image at a time
+    """
+    pages = ImagePdfWriter(**options)
+    for image_path in image_paths:
+        pages.append(image_path)
+        yield pages.writer.drain()
+    pages.close()
+    yield pages.writer.drain()
@@ -0,0 +1,311 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import logging
+import shutil
+import json
+import time
+import uuid
+import os
+
+# Operations that can be submitted as jobs, with their default limit on queued + running jobs
+OPERATIONS = {
+    'remove_background': 4,
+    'convert_pdf_to_png': 8,
+    'combine_pdfs': 8,
+    'split_pdf': 16,
+    'rotate_pdf': 16,
+    'add_watermark': 8,
+}
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+class QueueFullError(Exception):
+    """Raised when an operation already has as many jobs queued as it allows"""
+
+# Per-process instances used inside pool workers, created on first use from the settings
+# the pool initializer received, so jobs behave like the synchronous routes
+_worker_converter = None
+_worker_bg_remover = None
+_worker_converter_options = {}
+_worker_remover_options = {}
+
+def _init_worker(converter_options, remover_options):
+    global _worker_converter_options, _worker_remover_options
+    _worker_converter_options = converter_options
+    _worker_remover_options = remover_options
+
+def _run_operation(operation, input_paths, params, output_path):
+    """Run one operation inside a pool worker and return the result path"""
+    global _worker_converter, _worker_bg_remover
+
+    if operation == 'remove_background':
+        if _worker_bg_remover is None:
+            from bg_remover import BackgroundRemover
+            # One job at a time per worker process, so one session
+            _worker_bg_remover = BackgroundRemover(**dict(_worker_remover_options, pool_size=1))
+        return _worker_bg_remover.remove_background(input_paths[0], output_path)
+
+    if _worker_converter is None:
+        from converter import FileConverter
+        _worker_converter = FileConverter(**_worker_converter_options)
+    converter = _worker_converter
+
+    if operation == 'convert_pdf_to_png':
+        result = converter.convert_pdf_to_png(input_paths[0], page=params.get('page', 1), dpi=params.get('dpi', 200),
+                                              output_dir=os.path.dirname(output_path))
+        os.replace(result, output_path)
+        return output_path
+    if operation == 'combine_pdfs':
+        ok = converter.combine_pdfs(input_paths, output_path, streaming=True)
+    elif operation == 'split_pdf' and (params.get('ranges') or params.get('every') is not None):
+        from zip_stream import stream_zip
+        parts_dir = os.path.join(os.path.dirname(output_path), 'parts')
+        os.makedirs(parts_dir, exist_ok=True)
+        try:
+            parts = converter.split_pdf_parts(input_paths[0], parts_dir, params.get('ranges'), params.get('every'))
+            with open(output_path, 'wb') as f:
+                for chunk in stream_zip(parts):
+                    f.write(chunk)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        ok = True
+    elif operation == 'split_pdf':
+        result = converter.split_pdf(input_paths[0], os.path.dirname(output_path), params['start_page'], params['end_page'])
+        ok = result is not None
+        if ok:
+            os.replace(result, output_path)
+    elif operation == 'rotate_pdf':
+        ok = converter.rotate_pdf(input_paths[0], output_path, params['rotation'], params.get('pages'), params.get('rotations'))
+    elif operation == 'add_watermark':
+        ok = converter.add_watermark(input_paths[0], output_path, **params)
+    else:
+        raise ValueError(f"Unknown operation: {operation}")
+
+    if not ok:
+        raise Exception(f"{operation} failed")
+    return output_path
+
+class JobManager:
+    """Run long operations on a bounded process pool, tracking each job on disk.
+
+    Every job lives in ``jobs_dir/<job_id>/`` with its inputs, its result and a
+    ``job.json`` status record, so any web worker can answer status and
+    download requests. Finished jobs are removed after ``result_ttl`` seconds.
+    Jobs still unfinished after ``stale_ttl`` seconds, e.g. because the web
+    worker that ran them restarted, are marked failed and expire in turn.
+    Pool workers build their FileConverter and BackgroundRemover from
+    ``converter_options`` and ``remover_options``, the keyword arguments the
+    web process uses, so a job behaves like the synchronous route.
+
+    The pool and the queue limits belong to each web worker process, so under
+    gunicorn up to ``WEB_CONCURRENCY`` times the limit can be queued overall.
+    """
+
+    def __init__(self, jobs_dir='jobs', max_workers=None, queue_limits=None, result_ttl=60 * 60, stale_ttl=24 * 60 * 60,
+                 converter_options=None, remover_options=None):
+        self.jobs_dir = jobs_dir
+        self.converter_options = dict(converter_options or {})
+        self.remover_options = dict(remover_options or {})
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.queue_limits = dict(OPERATIONS, **(queue_limits or {}))
+        self.result_ttl = result_ttl
+        self.stale_ttl = stale_ttl
+        self._pool = None
+        self._lock = threading.Lock()
+        self._active = {operation: 0 for operation in self.queue_limits}
+        self._futures = {}
+        self._sweeper_pid = None
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _start_sweeper(self):
+        # Threads started in a preloading gunicorn master do not survive the fork into workers
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name='job-sweeper', daemon=True).start()
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def _write(self, job):
+        job['updated_at'] = time.time()
+        path = os.path.join(self._job_dir(job['id']), 'job.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(f'{path}.tmp', path)
+
+    def get(self, job_id):
+        """Return the job record, or None if it does not exist or has expired"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._job_dir(job_id), 'job.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def create(self, operation, params=None):
+        """Reserve a queue slot and a directory for a new job"""
+        if operation not in self.queue_limits:
+            raise ValueError(f"Unknown operation: {operation}")
+        if self._sweeper_pid != os.getpid():
+            self._start_sweeper()
+        with self._lock:
+            if self._active[operation] >= self.queue_limits[operation]:
+                raise QueueFullError(f"Too many {operation} jobs queued, retry later")
+            self._active[operation] += 1
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'operation': operation,
+            'params': params or {},
+            'status': PENDING,
+            'created_at': time.time(),
+            'error': None,
+            'result_name': None,
+        }
+        os.makedirs(os.path.join(self._job_dir(job['id']), 'input'))
+        self._write(job)
+        return job
+
+    def input_dir(self, job_id):
+        return os.path.join(self._job_dir(job_id), 'input')
+
+    def submit(self, job, input_paths, result_name):
+        """Queue a created job whose inputs have been saved to its input directory"""
+        if self._pool is None:
+            # Spawned rather than forked: the web process holds native thread pools
+            # (onnxruntime, numba via rembg) that are not safe to fork
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(self.converter_options, self.remover_options))
+
+        output_path = os.path.join(self._job_dir(job['id']), result_name)
+        job['result_name'] = result_name
+        self._write(job)
+
+        future = self._pool.submit(_run_operation, job['operation'], input_paths, job['params'], output_path)
+        with self._lock:
+            self._futures[job['id']] = future
+        future.add_done_callback(lambda f: self._finish(job, f))
+        return job
+
+    def release(self, job):
+        """Give back the queue slot of a job that could not be submitted"""
+        with self._lock:
+            self._active[job['operation']] -= 1
+        shutil.rmtree(self._job_dir(job['id']), ignore_errors=True)
+
+    def _finish(self, job, future):
+        with self._lock:
+            self._active[job['operation']] -= 1
+            self._futures.pop(job['id'], None)
+
+        current = self.get(job['id'])
+        if current is None:
+            return
+        if future.cancelled() or current['status'] == CANCELLED:
+            current['status'] = CANCELLED
+        elif future.exception() is not None:
+            current['status'] = FAILED
+            current['error'] = str(future.exception())
+            logging.error(f"Job {job['id']} ({job['operation']}) failed: {current['error']}")
+        else:
+            current['status'] = DONE
+        current['finished_at'] = time.time()
+        self._write(current)
+
+        # Inputs are no longer needed, and results of cancelled or failed jobs are discarded
+        shutil.rmtree(self.input_dir(job['id']), ignore_errors=True)
+        if current['status'] != DONE and current['result_name']:
+            try:
+                os.remove(self.result_path(current))
+            except OSError:
+                pass
+
+    def result_path(self, job):
+        return os.path.join(self._job_dir(job['id']), job['result_name'])
+
+    def cancel(self, job_id):
+        """Cancel a job; a running job finishes in its worker but its result is discarded"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job['status'] in (DONE, FAILED, CANCELLED):
+            return job
+
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None:
+            future.cancel()
+        job['status'] = CANCELLED
+        job['finished_at'] = time.time()
+        self._write(job)
+        return job
+
+    def status(self, job):
+        """Public view of a job record"""
+        view = {key: job.get(key) for key in ('id', 'operation', 'status', 'error', 'created_at', 'finished_at')}
+        if job['status'] == PENDING:
+            with self._lock:
+                future = self._futures.get(job['id'])
+            if future is not None and future.running():
+                view['status'] = RUNNING
+        if job['status'] == DONE:
+            view['expires_at'] = job['finished_at'] + self.result_ttl
+        return view
+
+    def sweep(self):
+        """Delete finished jobs older than the result TTL, and fail jobs left unfinished for the stale TTL"""
+        now = time.time()
+        for job_id in os.listdir(self.jobs_dir):
+            job = self.get(job_id)
+            if job is None:
+                # Directories without a record are leftovers from a crash
+                path = self._job_dir(job_id)
+                if os.path.isdir(path) and now - os.path.getmtime(path) > self.result_ttl:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            finished_at = job.get('finished_at')
+            if finished_at and now - finished_at > self.result_ttl:
+                shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+            elif not finished_at and now - job['created_at'] > self.stale_ttl:
+                with self._lock:
+                    if job_id in self._futures:
+                        continue
+                self._expire(job)
+
+    def _expire(self, job):
+        """Fail a job whose worker went away before finishing it, freeing its inputs"""
+        job['status'] = FAILED
+        job['error'] = f"Job did not finish within {self.stale_ttl}s; the worker running it may have restarted"
+        job['finished_at'] = time.time()
+        self._write(job)
+        logging.error(f"Job {job['id']} ({job['operation']}) expired unfinished")
+        shutil.rmtree(self.input_dir(job['id']), ignore_errors=True)
+        if job['result_name']:
+            try:
+                os.remove(self.result_path(job))
+            except OSError:
+                pass
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(min(60, self.result_ttl))
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping jobs: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'active': dict(self._active),
+                'limits': dict(self.queue_limits),
+            }
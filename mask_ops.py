@@ -0,0 +1,109 @@
+"""NumPy helpers for bringing masks computed at a lower resolution up to the full-resolution image"""
+import numpy as np
+
+# Output rows processed at a time, bounding the temporaries to a few MB
+STRIP_ROWS = 256
+
+# Side of the tiles examined for edge refinement
+TILE_SIZE = 256
+
+# Mask values strictly between these are the soft boundary that edge refinement works on
+BAND_LOW = 4
+BAND_HIGH = 251
+
+def _sample_positions(source_size, target_size):
+    """Lower neighbour index, upper neighbour index and weight of the upper one, per target pixel (pixel centres aligned)"""
+    positions = (np.arange(target_size, dtype=np.float32) + 0.5) * (source_size / target_size) - 0.5
+    positions = np.clip(positions, 0, source_size - 1)
+    lower = positions.astype(np.intp)
+    upper = np.minimum(lower + 1, source_size - 1)
+    return lower, upper, positions - lower
+
+def upsample_mask(mask, size):
+    """
+    Bilinearly upsample a mask, one strip of rows at a time
+    Args:
+        mask: 2-D uint8 array
+        size: (width, height) of the result
+    Returns:
+        2-D uint8 array of shape (height, width)
+    """
+    width, height = size
+    mask = np.asarray(mask, dtype=np.float32)
+    x_low, x_high, x_weight = _sample_positions(mask.shape[1], width)
+    y_low, y_high, y_weight = _sample_positions(mask.shape[0], height)
+
+    # Widen the few source rows first, so the full-size work is one integer blend per pixel
+    rows = mask[:, x_low] * (1 - x_weight) + mask[:, x_high] * x_weight
+    rows = np.rint(rows).astype(np.uint16)
+    # Vertical weights in 1/256 steps, which keeps every product within uint16
+    y_weight = np.rint(y_weight * 256).astype(np.uint16)[:, None]
+
+    result = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, STRIP_ROWS):
+        bottom = min(top + STRIP_ROWS, height)
+        weight = y_weight[top:bottom]
+        strip = rows[y_low[top:bottom]]
+        strip *= 256 - weight
+        upper = rows[y_high[top:bottom]]
+        upper *= weight
+        strip += upper
+        strip += 128
+        strip >>= 8
+        result[top:bottom] = strip
+    return result
+
+def _box_mean(values, radius):
+    """Mean over a (2r+1)x(2r+1) window, with edges extended, via an integral image"""
+    padded = np.pad(values, radius + 1, mode='edge')
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+    size = 2 * radius + 1
+    window = (integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size])
+    return window[:values.shape[0], :values.shape[1]] / (size * size)
+
+def guided_filter(guide, source, radius, eps=1e-3):
+    """
+    Edge-preserving smoothing of source steered by guide (He et al.), so the
+    boundary of a blurry upsampled mask follows edges in the full-resolution image
+    Args:
+        guide: 2-D float array in 0-1, e.g. luminance
+        source: 2-D float array in 0-1, the mask
+        radius: Window radius in pixels
+        eps: Regularization; larger values smooth more
+    """
+    mean_guide = _box_mean(guide, radius)
+    mean_source = _box_mean(source, radius)
+    covariance = _box_mean(guide * source, radius) - mean_guide * mean_source
+    variance = _box_mean(guide * guide, radius) - mean_guide * mean_guide
+    a = covariance / (variance + eps)
+    b = mean_source - a * mean_guide
+    return _box_mean(a, radius) * guide + _box_mean(b, radius)
+
+def refine_edges(alpha, luminance, radius):
+    """
+    Refine the soft boundary of an upsampled mask in place, touching only tiles that contain it
+    Args:
+        alpha: 2-D uint8 mask at full resolution
+        luminance: 2-D uint8 array of the image, same shape
+        radius: Guided filter radius, about the upsampling factor
+    Returns:
+        Number of tiles refined
+    """
+    height, width = alpha.shape
+    refined = 0
+    for top in range(0, height, TILE_SIZE):
+        for left in range(0, width, TILE_SIZE):
+            tile = alpha[top:top + TILE_SIZE, left:left + TILE_SIZE]
+            band = (tile > BAND_LOW) & (tile < BAND_HIGH)
+            if not band.any():
+                continue
+            # Filter with a margin so the tile's border pixels see their whole window
+            y0, x0 = max(0, top - radius), max(0, left - radius)
+            y1, x1 = min(height, top + TILE_SIZE + radius), min(width, left + TILE_SIZE + radius)
+            filtered = guided_filter(luminance[y0:y1, x0:x1].astype(np.float32) / 255,
+                                     alpha[y0:y1, x0:x1].astype(np.float32) / 255, radius)
+            filtered = filtered[top - y0:top - y0 + tile.shape[0], left - x0:left - x0 + tile.shape[1]]
+            # Solid foreground and background stay as they are
+            tile[band] = np.clip(np.rint(filtered[band] * 255), 0, 255)
+            refined += 1
+    return refined
@@ -0,0 +1,177 @@
+"""Process-local metrics in the Prometheus text format, plus per-request timing spans"""
+from contextlib import contextmanager
+import threading
+import time
+
+# Latency buckets in seconds, from cached thumbnails up to the gunicorn timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Upper bounds of the input size label, in bytes
+SIZE_BUCKETS = ((100 * 1024, '100KB'), (1024 * 1024, '1MB'), (10 * 1024 * 1024, '10MB'), (100 * 1024 * 1024, '100MB'))
+
+def size_bucket(size):
+    """Label for an input size in bytes, e.g. '<1MB'"""
+    if not size:
+        return 'none'
+    for limit, label in SIZE_BUCKETS:
+        if size < limit:
+            return f'<{label}'
+    return f'>={SIZE_BUCKETS[-1][1]}'
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(labelnames, values)
+    )
+    return '{' + pairs + '}'
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value:g}']
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def _samples(self, key, value):
+        counts, count, total = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames + ('le',), key + (f'{bound:g}',))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames + ('le',), key + ('+Inf',))
+        lines.append(f'{self.name}_bucket{labels} {count}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total:g}')
+        return lines
+
+class Registry:
+    """Named metrics of this process, rendered together for /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'stage_duration_seconds', 'Time spent in one stage of an operation',
+    ('operation', 'stage')
+)
+
+# Spans of the request being handled on this thread
+_local = threading.local()
+
+def start_trace(operation):
+    """Begin collecting spans for the current thread; returns the span list"""
+    _local.operation = operation
+    _local.spans = []
+    return _local.spans
+
+def end_trace():
+    """Stop collecting spans for the current thread and return them as (stage, seconds)"""
+    spans = getattr(_local, 'spans', None) or []
+    _local.operation = None
+    _local.spans = None
+    return spans
+
+def record(stage, seconds):
+    """Add an already measured stage to the current trace and the stage histogram"""
+    spans = getattr(_local, 'spans', None)
+    if spans is not None:
+        spans.append((stage, seconds))
+    STAGE_SECONDS.observe(seconds, operation=getattr(_local, 'operation', None) or 'none', stage=stage)
+
+@contextmanager
+def span(stage):
+    """Time a block as one stage of the current operation"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
@@ -0,0 +1,155 @@
+"""Ghostscript and qpdf settings for shrinking PDFs, run through a bounded pool of subprocess slots"""
+import subprocess
+import threading
+import signal
+import time
+import os
+
+# Named settings for optimize_pdf. dpi is the resolution color and gray images are downsampled to
+# and quality their JPEG quality (1-100); None keeps images as they are
+PRESETS = {
+    'screen': {'dpi': 72, 'quality': 40},
+    'ebook': {'dpi': 150, 'quality': 60},
+    'printer': {'dpi': 300, 'quality': 80},
+    'lossless': {'dpi': None, 'quality': None},
+}
+
+# qpdf exits with 3 when it succeeded with warnings, common for slightly damaged inputs
+QPDF_OK_CODES = (0, 3)
+
+class ToolBusyError(Exception):
+    """Raised when no external tool slot frees up within the queue timeout"""
+
+class ToolTimeoutError(Exception):
+    """Raised when an external tool runs longer than its timeout and is killed"""
+
+def jpeg_qfactor(quality):
+    """Ghostscript QFactor for a JPEG quality: 1.0 is the standard tables (quality 50), scaled like libjpeg"""
+    quality = max(1, min(100, quality))
+    scale = 5000 / quality if quality < 50 else 200 - 2 * quality
+    return round(max(scale, 1) / 100, 3)
+
+def ghostscript_args(gs_path, input_path, output_path, dpi=None, quality=None, subset_fonts=True):
+    """
+    Command line that rewrites a PDF with Ghostscript's pdfwrite device
+    Args:
+        gs_path: Ghostscript executable
+        input_path: PDF to rewrite
+        output_path: Where the rewritten PDF is written
+        dpi: Downsample color and gray images above this resolution (None keeps them)
+        quality: Re-encode color and gray images as JPEG at this quality (None keeps their encoding)
+        subset_fonts: Embed only the glyphs that are used
+    """
+    args = [
+        gs_path, '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dQUIET', '-sDEVICE=pdfwrite',
+        '-dCompatibilityLevel=1.5', '-dDetectDuplicateImages=true', '-dCompressFonts=true',
+        f'-dSubsetFonts={str(bool(subset_fonts)).lower()}', '-dEmbedAllFonts=true',
+        f'-sOutputFile={output_path}',
+    ]
+    if dpi:
+        # Only images well above the target are resampled; a 10% overshoot is not worth a generation loss
+        for kind in ('Color', 'Gray'):
+            args += [f'-dDownsample{kind}Images=true', f'-d{kind}ImageDownsampleType=/Bicubic',
+                     f'-d{kind}ImageResolution={dpi}', f'-d{kind}ImageDownsampleThreshold=1.5']
+        # Bilevel scans stay sharp enough to read and OCR at twice the resolution
+        args += ['-dDownsampleMonoImages=true', '-dMonoImageDownsampleType=/Subsample',
+                 f'-dMonoImageResolution={max(2 * dpi, 300)}', '-dMonoImageDownsampleThreshold=1.5']
+    else:
+        args += ['-dDownsampleColorImages=false', '-dDownsampleGrayImages=false', '-dDownsampleMonoImages=false']
+
+    if quality:
+        qfactor = jpeg_qfactor(quality)
+        args += ['-dPassThroughJPEGImages=false',
+                 '-dAutoFilterColorImages=false', '-dColorImageFilter=/DCTEncode',
+                 '-dAutoFilterGrayImages=false', '-dGrayImageFilter=/DCTEncode']
+        image_dict = f'<< /QFactor {qfactor} /Blend 1 /HSamples [2 1 1 2] /VSamples [2 1 1 2] >>'
+        params = ' '.join(f'/{name} {image_dict}' for name in
+                          ('ColorImageDict', 'ColorACSImageDict', 'GrayImageDict', 'GrayACSImageDict'))
+        args += ['-c', f'<< {params} >> setdistillerparams', '-f']
+    else:
+        args += ['-dPassThroughJPEGImages=true']
+    args.append(input_path)
+    return args
+
+def qpdf_args(qpdf_path, input_path, output_path):
+    """Command line that packs objects into compressed object streams and recompresses Flate streams"""
+    return [qpdf_path, '--object-streams=generate', '--compress-streams=y', '--recompress-flate',
+            '--compression-level=9', input_path, output_path]
+
+class ExternalToolPool:
+    """Run external tools (Ghostscript, qpdf) with bounded concurrency and timeouts.
+
+    At most ``size`` tool processes run at once across the threads of this
+    process; a caller waits up to ``queue_timeout`` seconds for a slot and then
+    gets ToolBusyError. Each tool runs in its own session, so on timeout the
+    whole process group is killed, including anything the tool started.
+    """
+
+    def __init__(self, size=None, queue_timeout=30, timeout=120):
+        self.size = max(1, size or (os.cpu_count() or 1) // 2)
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+        self._runs = 0
+        self._timeouts = 0
+        self._failures = 0
+        self._busy = 0
+
+    def run(self, args, timeout=None, ok_codes=(0,)):
+        """
+        Run one command in a free slot
+        Args:
+            args: Command line
+            timeout: Seconds the command may run (default: the pool's timeout)
+            ok_codes: Exit codes that count as success
+        Returns:
+            Seconds the command ran
+        """
+        timeout = timeout or self.timeout
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._busy += 1
+                raise ToolBusyError(f"No free {os.path.basename(args[0])} slot after {self.queue_timeout}s, retry later")
+            self._running += 1
+
+        started = time.perf_counter()
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+            try:
+                _, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                with self._lock:
+                    self._timeouts += 1
+                raise ToolTimeoutError(f"{os.path.basename(args[0])} did not finish within {timeout}s")
+            if process.returncode not in ok_codes:
+                with self._lock:
+                    self._failures += 1
+                message = stderr.decode('utf-8', 'replace').strip().splitlines()[-3:]
+                raise Exception(f"{os.path.basename(args[0])} exited with status {process.returncode}: {' '.join(message)}")
+            return time.perf_counter() - started
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._runs += 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'running': self._running,
+                'waiting': self._waiting,
+                'runs': self._runs,
+                'timeouts': self._timeouts,
+                'failures': self._failures,
+                'busy_rejections': self._busy,
+            }
@@ -0,0 +1,446 @@
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (
+    ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject, NumberObject, StreamObject
+)
+from contextlib import contextmanager
+import hashlib
+import bisect
+import mmap
+import io
+import os
+import re
+
+# Objects tied to one document's structure; they are copied per input and never shared
+STRUCTURE_TYPES = ('/Catalog', '/Pages', '/Page', '/Annot', '/Outlines')
+STRUCTURE_KEYS = ('/Parent', '/P')
+
+# How deep references are followed when fingerprinting a resource for sharing
+MAX_FINGERPRINT_DEPTH = 16
+
+# Page attributes a page may inherit from its ancestors in the page tree
+INHERITABLE_KEYS = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+# Page trees nested deeper than this are treated as malformed (or cyclic)
+MAX_PAGE_TREE_DEPTH = 64
+
+@contextmanager
+def open_mapped_pdf(pdf_path):
+    """
+    Open a PDF through a read-only memory map, so only the parts the reader
+    actually parses (xref, the objects it resolves) are paged in
+    Args:
+        pdf_path: Path of the PDF
+    Yields:
+        (PdfReader, mmap) of the file
+    """
+    with open(pdf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        reader = PdfReader(data)
+        if reader.is_encrypted and not reader.decrypt(''):
+            raise ValueError(f"{os.path.basename(pdf_path)} is password protected")
+        yield reader, data
+
+def page_count(reader):
+    """Number of pages from the /Count of the page tree root, without walking the tree"""
+    return int(reader.trailer['/Root']['/Pages']['/Count'])
+
+def iter_page_refs(reader, indices=None):
+    """
+    Walk the page tree, descending only into branches that hold wanted pages
+    Args:
+        reader: PdfReader of the document
+        indices: 0-based page indices to find, or None for every page
+    Yields:
+        (index, reference of the page, {inheritable key: raw value from its ancestors}) in document order
+    """
+    wanted = None if indices is None else sorted(set(indices))
+    if wanted is not None and not wanted:
+        return
+    root = reader.trailer['/Root'].raw_get('/Pages')
+    yield from _walk_pages(root, {}, 0, wanted, 0)
+
+def _walk_pages(ref, inherited, offset, wanted, depth):
+    if depth > MAX_PAGE_TREE_DEPTH:
+        raise ValueError("Page tree is too deep")
+    node = ref.get_object()
+    if node.get('/Type') != '/Pages' and '/Kids' not in node:
+        if wanted is None or offset in wanted:
+            yield offset, ref, inherited
+        return
+
+    inherited = dict(inherited)
+    for key in INHERITABLE_KEYS:
+        if key in node:
+            inherited[key] = node.raw_get(key)
+    for kid in node.raw_get('/Kids').get_object():
+        if wanted is not None and offset > wanted[-1]:
+            return
+        child = kid.get_object()
+        if child.get('/Type') == '/Pages' or '/Kids' in child:
+            count = int(child['/Count'])
+            # Skip whole branches that hold none of the wanted pages without resolving their kids
+            if wanted is None or _any_in_range(wanted, offset, offset + count):
+                yield from _walk_pages(kid, inherited, offset, wanted, depth + 1)
+            offset += count
+        else:
+            if wanted is None or _any_in_range(wanted, offset, offset + 1):
+                yield offset, kid, inherited
+            offset += 1
+
+def page_rotation(page, inherited):
+    """Current /Rotate of a page, including one inherited from the page tree"""
+    rotate = page.raw_get('/Rotate') if '/Rotate' in page else inherited.get('/Rotate', 0)
+    return int(rotate.get_object()) if isinstance(rotate, IndirectObject) else int(rotate)
+
+def _any_in_range(wanted, start, end):
+    index = bisect.bisect_left(wanted, start)
+    return index < len(wanted) and wanted[index] < end
+
+class IncrementalPdfWriter:
+    """Serialize PDF objects as soon as they are produced, keeping only their offsets.
+
+    Output collects in memory until ``drain()`` is called, so callers can pass
+    each piece on (to a file or a response) while the document is still being built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self._offsets = {}
+        self._next_number = 1
+        self._write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self._chunks.append(data)
+        self._position += len(data)
+
+    def reserve(self):
+        """Allocate the number of an object that will be written later"""
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def write_object(self, number, obj):
+        """Write a PyPDF2 object under a reserved number"""
+        data = io.BytesIO()
+        obj.write_to_stream(data, None)
+        self.write_raw(number, data.getvalue())
+
+    def write_raw(self, number, data):
+        """Write an already serialized object body under a reserved number"""
+        self._offsets[number] = self._position
+        self._write(b'%d 0 obj\n' % number + data + b'\nendobj\n')
+
+    def finish(self, root_number):
+        """Write the cross-reference table and trailer; root_number is the catalog object"""
+        xref_offset = self._position
+        self._write(b'xref\n0 %d\n0000000000 65535 f \n' % self._next_number)
+        for number in range(1, self._next_number):
+            if number not in self._offsets:
+                raise ValueError(f"Object {number} was reserved but never written")
+            self._write(b'%010d 00000 n \n' % self._offsets[number])
+        self._write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (self._next_number, root_number, xref_offset))
+
+    def drain(self):
+        """Return everything written since the last drain"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def finish_document(writer, pages_number, kids):
+    """
+    Write a flat page tree, the catalog and the trailer
+    Args:
+        writer: IncrementalPdfWriter holding the pages
+        pages_number: Reserved number of the page tree root, the /Parent of every page
+        kids: Object numbers of the pages, in order
+    """
+    writer.write_object(pages_number, DictionaryObject({
+        NameObject('/Type'): NameObject('/Pages'),
+        NameObject('/Kids'): ArrayObject(IndirectObject(number, 0, None) for number in kids),
+        NameObject('/Count'): NumberObject(len(kids)),
+    }))
+    catalog_number = writer.reserve()
+    writer.write_object(catalog_number, DictionaryObject({
+        NameObject('/Type'): NameObject('/Catalog'),
+        NameObject('/Pages'): IndirectObject(pages_number, 0, None),
+    }))
+    writer.finish(catalog_number)
+
+class StreamingPdfMerger:
+    """Append PDFs one page at a time to an IncrementalPdfWriter.
+
+    Only the input being copied is open, and resources identical to ones
+    already written (embedded fonts, images, ...) are referenced instead of
+    being copied again, so memory stays bounded by the largest input rather
+    than the sum of all of them. Outlines and form-level data of the inputs
+    are not carried over.
+    """
+
+    def __init__(self, writer=None, fingerprints=None):
+        self.writer = writer or IncrementalPdfWriter()
+        self.pages_number = self.writer.reserve()
+        self.shared_objects = 0
+        self._kids = []
+        self._shared = {}  # content fingerprint -> object number, across all inputs
+        self._numbers = {}  # (idnum, generation) -> object number, for the current input
+        # Mergers copying from the same reader may share one table, so each source object is hashed once
+        self._source_fingerprints = fingerprints
+        self._fingerprints = {}
+        self._pending = []
+
+    def append(self, pdf_path):
+        """
+        Copy every page of a PDF into the output
+        Args:
+            pdf_path: Path or binary file object of the PDF
+        Yields:
+            After each page, so the caller can drain the writer
+        """
+        reader = PdfReader(pdf_path)
+        if reader.is_encrypted and not reader.decrypt(''):
+            raise ValueError(f"{getattr(pdf_path, 'name', pdf_path)} is password protected")
+        yield from self.append_pages(reader)
+
+    def append_pages(self, reader, indices=None, rotations=None):
+        """
+        Copy some pages of an open PDF into the output, with only the objects they reference
+        Args:
+            reader: PdfReader of the source document
+            indices: 0-based page indices to copy, in document order; None copies every page
+            rotations: Optional {0-based index: degrees clockwise} added to those pages' rotation
+        Yields:
+            After each page, so the caller can drain the writer
+        """
+        yield from self.append_located(list(iter_page_refs(reader, indices)), rotations)
+
+    def append_located(self, pages, rotations=None):
+        """
+        Copy pages already found with iter_page_refs
+        Args:
+            pages: List of (index, reference, inherited attributes) from one reader
+            rotations: Optional {0-based index: degrees clockwise} added to those pages' rotation
+        Yields:
+            After each page, so the caller can drain the writer
+        """
+        rotations = rotations or {}
+        self._numbers = {}
+        self._fingerprints = {} if self._source_fingerprints is None else self._source_fingerprints
+        # Number every page up front so links and annotations between pages resolve
+        for _, ref, _ in pages:
+            self._numbers[(ref.idnum, ref.generation)] = self.writer.reserve()
+
+        for index, ref, inherited in pages:
+            number = self._numbers[(ref.idnum, ref.generation)]
+            page = ref.get_object()
+            copy = DictionaryObject()
+            for name, value in page.items():
+                if name != '/Parent':
+                    copy[NameObject(name)] = self._copy(value)
+            # The copy leaves its source tree, so it has to carry what it inherited from it
+            for name, value in inherited.items():
+                if name not in copy:
+                    copy[NameObject(name)] = self._copy(value)
+            if rotations.get(index):
+                copy[NameObject('/Rotate')] = NumberObject((page_rotation(page, inherited) + rotations[index]) % 360)
+            copy[NameObject('/Parent')] = IndirectObject(self.pages_number, 0, None)
+            self.writer.write_object(number, copy)
+            self._kids.append(number)
+
+            while self._pending:
+                pending_number, obj = self._pending.pop()
+                self.writer.write_object(pending_number, self._copy(obj))
+            yield number
+
+        # Drop the per-input tables so the reader and its parsed objects can be freed
+        self._numbers = {}
+        self._fingerprints = {}
+
+    def close(self):
+        """Write the page tree, catalog and trailer"""
+        finish_document(self.writer, self.pages_number, self._kids)
+
+    def _copy(self, obj):
+        """Copy a direct object, renumbering the references it contains"""
+        if isinstance(obj, IndirectObject):
+            number = self._number_for(obj)
+            return NullObject() if number is None else IndirectObject(number, 0, None)
+        if isinstance(obj, StreamObject):
+            copy = StreamObject()
+            copy._data = obj._data
+            for name, value in obj.items():
+                if name != '/Length':
+                    copy[NameObject(name)] = self._copy(value)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({NameObject(name): self._copy(value) for name, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(value) for value in obj)
+        return obj
+
+    def _number_for(self, ref):
+        key = (ref.idnum, ref.generation)
+        if key in self._numbers:
+            return self._numbers[key]
+
+        obj = ref.get_object()
+        if isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Pages', '/Page'):
+            # Pages of the source tree are replaced by the merged tree; stray pages are dropped
+            number = self.pages_number if obj.get('/Type') == '/Pages' else None
+            self._numbers[key] = number
+            return number
+
+        fingerprint = self._fingerprint(ref)
+        if fingerprint is not None and fingerprint in self._shared:
+            number = self._shared[fingerprint]
+            self.shared_objects += 1
+        else:
+            number = self.writer.reserve()
+            self._pending.append((number, obj))
+            if fingerprint is not None:
+                self._shared[fingerprint] = number
+        self._numbers[key] = number
+        return number
+
+    def _fingerprint(self, ref, depth=0):
+        """Hash of an object's content with references replaced by their own fingerprints,
+        or None if it (or anything it refers to) belongs to the document structure"""
+        key = (ref.idnum, ref.generation)
+        if key in self._fingerprints:
+            return self._fingerprints[key]
+        self._fingerprints[key] = None  # reference cycles are not shared
+
+        obj = ref.get_object()
+        digest = hashlib.sha256()
+        if depth < MAX_FINGERPRINT_DEPTH and self._hash_into(digest, obj, depth):
+            self._fingerprints[key] = digest.digest()
+        return self._fingerprints[key]
+
+    def _hash_into(self, digest, obj, depth):
+        if isinstance(obj, IndirectObject):
+            fingerprint = self._fingerprint(obj, depth + 1)
+            if fingerprint is None:
+                return False
+            digest.update(b'R' + fingerprint)
+            return True
+        if isinstance(obj, DictionaryObject):
+            if obj.get('/Type') in STRUCTURE_TYPES or any(name in obj for name in STRUCTURE_KEYS):
+                return False
+            digest.update(b'<<')
+            for name in sorted(obj):
+                if name == '/Length' and isinstance(obj, StreamObject):
+                    continue
+                digest.update(name.encode())
+                if not self._hash_into(digest, dict.__getitem__(obj, name), depth):
+                    return False
+            digest.update(b'>>')
+            if isinstance(obj, StreamObject):
+                digest.update(b'stream%d:' % len(obj._data))
+                digest.update(obj._data)
+            return True
+        if isinstance(obj, ArrayObject):
+            digest.update(b'[')
+            for value in obj:
+                if not self._hash_into(digest, value, depth):
+                    return False
+            digest.update(b']')
+            return True
+        data = io.BytesIO()
+        obj.write_to_stream(data, None)
+        digest.update(data.getvalue() + b' ')
+        return True
+
+def write_incremental_update(data, reader, objects, output):
+    """
+    Write a PDF followed by an incremental update that replaces some of its objects.
+    The original bytes are copied as they are; only the replaced objects and a
+    new cross-reference section referring back to the original one are added.
+    Args:
+        data: Bytes (or a memory map) of the original PDF
+        reader: PdfReader of the same PDF
+        objects: {(object number, generation): new PyPDF2 object}
+        output: Binary file object to write to
+    """
+    if '/Encrypt' in reader.trailer:
+        raise ValueError("Encrypted PDFs cannot be updated in place")
+    start = data.rfind(b'startxref')
+    if start < 0:
+        raise ValueError("No startxref in PDF")
+    previous = int(data[start + 9:start + 40].split()[0])
+    # Cross-reference streams (PDF 1.5+) are followed by an update in the same form
+    xref_stream = data[previous:previous + 4] != b'xref'
+    if xref_stream and not re.match(rb'\d+\s+\d+\s+obj', data[previous:previous + 32]):
+        raise ValueError("startxref does not point to a cross-reference section")
+
+    if not objects:
+        output.write(data)
+        return
+
+    output.write(data)
+    position = len(data)
+    if data[-1:] != b'\n':
+        output.write(b'\n')
+        position += 1
+
+    offsets = {}
+    for (number, generation), obj in sorted(objects.items()):
+        body = io.BytesIO()
+        obj.write_to_stream(body, None)
+        chunk = b'%d %d obj\n' % (number, generation) + body.getvalue() + b'\nendobj\n'
+        offsets[number] = (position, generation)
+        output.write(chunk)
+        position += len(chunk)
+
+    # PyPDF2 keeps no /Size for cross-reference streams, so count the numbers in use as well
+    numbers = [number for table in reader.xref.values() for number in table] + list(reader.xref_objStm)
+    size = max([int(reader.trailer.get('/Size', 0))] + [number + 1 for number in numbers])
+    trailer = DictionaryObject({NameObject('/Prev'): NumberObject(previous)})
+    for name in ('/Root', '/Info', '/ID'):
+        if name in reader.trailer:
+            trailer[NameObject(name)] = reader.trailer.raw_get(name)
+
+    if xref_stream:
+        # The xref stream is itself a new object, listed in its own index
+        number = size
+        size += 1
+        offsets[number] = (position, 0)
+        rows = b''.join(b'\x01' + offset.to_bytes(4, 'big') + generation.to_bytes(2, 'big')
+                        for _, (offset, generation) in sorted(offsets.items()))
+        stream = StreamObject()
+        stream._data = rows
+        stream.update(trailer)
+        stream.update({
+            NameObject('/Type'): NameObject('/XRef'),
+            NameObject('/Size'): NumberObject(size),
+            NameObject('/W'): ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)]),
+            NameObject('/Index'): ArrayObject(NumberObject(value) for n in sorted(offsets) for value in (n, 1)),
+        })
+        body = io.BytesIO()
+        stream.write_to_stream(body, None)
+        output.write(b'%d 0 obj\n' % number + body.getvalue() + b'\nendobj\n')
+    else:
+        section = [b'xref\n0 1\n0000000000 65535 f \n']
+        for number, (offset, generation) in sorted(offsets.items()):
+            section.append(b'%d 1\n%010d %05d n \n' % (number, offset, generation))
+        trailer[NameObject('/Size')] = NumberObject(size)
+        body = io.BytesIO()
+        trailer.write_to_stream(body, None)
+        output.write(b''.join(section) + b'trailer\n' + body.getvalue() + b'\n')
+    output.write(b'startxref\n%d\n%%%%EOF\n' % position)
+
+def iter_merged_pdf(pdf_paths):
+    """
+    Merge PDFs with StreamingPdfMerger and yield the output as it is produced
+    Args:
+        pdf_paths: Paths or binary file objects, in output order
+    Yields:
+        Bytes of the merged PDF, one page (with its new resources) at a time
+    """
+    merger = StreamingPdfMerger()
+    for pdf_path in pdf_paths:
+        for _ in merger.append(pdf_path):
+            chunk = merger.writer.drain()
+            if chunk:
+                yield chunk
+    merger.close()
+    yield merger.writer.drain()
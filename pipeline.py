@@ -0,0 +1,129 @@
+from converter import IMAGE_FORMATS
+from metrics import record
+from PIL import ImageOps
+import json
+import time
+
+# Stages accepted by /pipeline and the parameters each one requires
+STAGES = {
+    'crop': ('left', 'top', 'right', 'bottom'),
+    'resize': (),
+    'rotate': ('angle',),
+    'convert': ('format',),
+    'compress': ('quality',),
+    'remove-background': (),
+}
+
+# EXIF orientation tag
+ORIENTATION = 0x0112
+
+def parse_operations(spec):
+    """
+    Parse and validate a pipeline definition
+    Args:
+        spec: JSON list of stages, e.g. [{"op": "crop", "left": 0, ...}, {"op": "resize", "width": 800}]
+    Returns:
+        List of stage dicts
+    """
+    try:
+        operations = json.loads(spec) if isinstance(spec, str) else spec
+    except ValueError:
+        raise ValueError('Operations must be a JSON list')
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('Operations must be a non-empty JSON list')
+
+    for index, stage in enumerate(operations, 1):
+        if not isinstance(stage, dict) or stage.get('op') not in STAGES:
+            raise ValueError(f"Stage {index}: op must be one of {', '.join(STAGES)}")
+        missing = [name for name in STAGES[stage['op']] if stage.get(name) is None]
+        if missing:
+            raise ValueError(f"Stage {index} ({stage['op']}): missing {', '.join(missing)}")
+        if stage['op'] == 'resize' and not (stage.get('width') or stage.get('height')):
+            raise ValueError(f'Stage {index} (resize): width or height must be specified')
+        if stage['op'] == 'convert' and '.' + str(stage['format']).lower() not in IMAGE_FORMATS:
+            raise ValueError(f'Stage {index} (convert): format must be PNG, JPG, JPEG, or WEBP')
+        if stage['op'] == 'compress' and not 1 <= int(stage['quality']) <= 100:
+            raise ValueError(f'Stage {index} (compress): quality must be between 1 and 100')
+    return operations
+
+class ImagePipeline:
+    """Run a list of image operations on one decoded image and encode the result once"""
+
+    def __init__(self, converter, bg_remover=None):
+        self.converter = converter
+        self.bg_remover = bg_remover
+
+    def run(self, input_file, output, operations, format=None):
+        """
+        Decode input_file, apply operations in order and encode into output
+        Args:
+            input_file: Path or binary file object of the source image
+            output: Path or binary file object to encode the result into
+            operations: Stages from parse_operations
+            format: Output format when no convert stage is given (PIL name)
+        Returns:
+            (format, timings) where timings is a list of (stage name, seconds)
+        """
+        timings = []
+        quality = 95
+
+        started = time.perf_counter()
+        img = self.converter.open_image(input_file)
+        format = format or img.format
+        # Stages work on the upright image, so sizes and crop boxes are as the image is displayed
+        orientation = img.getexif().get(ORIENTATION, 1)
+        sideways = orientation in (5, 6, 7, 8)
+        upright_size = img.size[::-1] if sideways else img.size
+        # Resizing first lets large JPEGs decode at a reduced scale
+        target_size = self._resize_size(operations[0], upright_size) if operations[0]['op'] == 'resize' else None
+        self.converter.load_image(img, target_size and (target_size[::-1] if sideways else target_size))
+        if orientation != 1:
+            # Turned upright once, here; exif_transpose drops the tag, so no later stage repeats it
+            img = ImageOps.exif_transpose(img)
+        timings.append(('decode', time.perf_counter() - started))
+        record('decode', timings[-1][1])
+
+        for stage in operations:
+            started = time.perf_counter()
+            op = stage['op']
+            if op == 'crop':
+                box = (int(stage['left']), int(stage['top']), int(stage['right']), int(stage['bottom']))
+                self.converter.check_pixels((max(0, box[2] - box[0]), max(0, box[3] - box[1])))
+                img = img.crop(box)
+            elif op == 'resize':
+                # The first resize targets the size computed from the undecoded (not drafted) image
+                size = target_size if stage is operations[0] else self._resize_size(stage, img.size)
+                img = self.converter.resize(img, *size, maintain_aspect=False)
+            elif op == 'rotate':
+                img = self.converter.rotate(img, int(stage['angle']))
+            elif op == 'convert':
+                format = IMAGE_FORMATS['.' + str(stage['format']).lower()]
+            elif op == 'compress':
+                quality = int(stage['quality'])
+            elif op == 'remove-background':
+                if self.bg_remover is None:
+                    raise ValueError('Background removal is not available')
+                img = self.bg_remover.cut_out(img.convert('RGBA' if img.mode in ('RGBA', 'LA') else 'RGB'))
+            timings.append((op, time.perf_counter() - started))
+            record(op, timings[-1][1])
+
+        started = time.perf_counter()
+        self.converter.encode(img, output, format, quality)
+        timings.append(('encode', time.perf_counter() - started))
+        record('encode', timings[-1][1])
+        return format, timings
+
+    def _resize_size(self, stage, size):
+        """Output size of a resize stage, within the converter's pixel budget"""
+        size = self.converter.resize_dimensions(size, stage.get('width') and int(stage['width']),
+                                                stage.get('height') and int(stage['height']),
+                                                stage.get('maintain_aspect', True))
+        self.converter.check_pixels(size)
+        return size
+
+def server_timing(timings):
+    """Format stage timings as a Server-Timing header value"""
+    return ', '.join(
+        f'{index}-{name};dur={seconds * 1000:.2f};desc="{name}"'
+        for index, (name, seconds) in enumerate(timings)
+    )
@@ -0,0 +1,236 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import hashlib
+import fcntl
+import io
+import logging
+import shutil
+import json
+import time
+import os
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Digests already computed elsewhere (finished chunked uploads), by file identity, so
+# large uploads and their hard-linked copies are not read again just to build a key
+_known_digests = OrderedDict()
+_known_digests_lock = threading.Lock()
+MAX_KNOWN_DIGESTS = 1024
+
+def _identity(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def remember_digest(path, digest):
+    """Record the SHA-256 of a file that will not change, for hash_file to reuse"""
+    key = _identity(os.stat(path))
+    with _known_digests_lock:
+        _known_digests[key] = digest
+        _known_digests.move_to_end(key)
+        while len(_known_digests) > MAX_KNOWN_DIGESTS:
+            _known_digests.popitem(last=False)
+
+def _known_digest(source):
+    # Only real files: asking a SpooledTemporaryFile for its fileno would spill it to disk
+    try:
+        if isinstance(source, (str, os.PathLike)):
+            stat = os.stat(source)
+        elif isinstance(source, io.BufferedReader):
+            stat = os.fstat(source.fileno())
+        else:
+            return None
+    except (OSError, ValueError):
+        return None
+    with _known_digests_lock:
+        return _known_digests.get(_identity(stat))
+
+def hash_file(source):
+    """SHA-256 of a file path or binary file object, read in chunks"""
+    known = _known_digest(source)
+    if known:
+        return known
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        source.seek(0)
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        source.seek(0)
+    return digest.hexdigest()
+
+class ResultCache:
+    """On-disk cache of operation results keyed by input content and parameters.
+
+    Entries are evicted least-recently-used first once ``max_bytes`` is
+    exceeded, and expire ``ttl`` seconds after they were stored. The directory
+    is shared by every web worker: each store re-reads it under a file lock, so
+    ``max_bytes`` bounds the whole cache rather than each worker's share.
+    """
+
+    def __init__(self, cache_dir='cache', max_bytes=1024 * 1024 * 1024, ttl=24 * 60 * 60, enabled=True):
+        # Absolute, since send_file resolves relative paths against the app root rather than the cwd
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (path, size, stored_at), least recently used first
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with self._locked():
+                self._load()
+
+    def _path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock on the cache directory across the processes sharing it"""
+        # Opened each time: a descriptor inherited across gunicorn's fork would share the lock
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _load(self):
+        """Rebuild the index and size from the files on disk, written by any process, oldest access first"""
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp') or name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_atime, name, path, stat.st_size, stat.st_mtime))
+        self._entries.clear()
+        self._bytes = 0
+        for _, key, path, size, stored_at in sorted(found):
+            self._entries[key] = (path, size, stored_at)
+            self._bytes += size
+        self._evict()
+
+    def _remove(self, key):
+        path, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._entries and self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def make_key(self, operation, inputs, params=None):
+        """Key from the SHA-256 of every input (path or file object), the operation name and the normalized parameters"""
+        digest = hashlib.sha256()
+        digest.update(operation.encode())
+        for source in inputs:
+            digest.update(hash_file(source).encode())
+        digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached result for key opened for reading, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Stored by another worker since this one last read the directory
+                path = self._path_for(key)
+                try:
+                    stat = os.stat(path)
+                    entry = (path, stat.st_size, stat.st_mtime)
+                    self._entries[key] = entry
+                    self._bytes += stat.st_size
+                except OSError:
+                    pass
+            if entry and time.time() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            # Opened under the lock, so an eviction can no longer pull the file away before it is sent
+            try:
+                result = open(entry[0], 'rb') if entry else None
+            except FileNotFoundError:
+                self._remove(key)
+                result = None
+            if result is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        try:
+            os.utime(entry[0], (time.time(), entry[2]))
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """Copy a freshly produced result (path or file object) into the cache"""
+        path = self._path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        if isinstance(result, (str, os.PathLike)):
+            shutil.copyfile(result, tmp_path)
+        else:
+            result.seek(0)
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(result, f)
+            result.seek(0)
+        os.replace(tmp_path, path)
+        # Other workers store into the same directory, so its size is re-read before evicting
+        with self._lock, self._locked():
+            self._load()
+            self._evict()
+        return path
+
+    def fetch(self, operation, inputs, params, produce):
+        """
+        Return the result of an operation, running it only on a cache miss
+        Args:
+            operation: Operation name, part of the key
+            inputs: Paths or file objects of the uploaded inputs, hashed into the key
+            params: Dict of parameters that change the output
+            produce: Callable that runs the operation and returns the output path or
+                rewound file object (or None on failure)
+        Returns:
+            Path or file object of the result (an open file on a cache hit), or None if produce failed
+        """
+        if not self.enabled:
+            return produce()
+
+        key = self.make_key(operation, inputs, params)
+        cached = self.get(key)
+        if cached:
+            logging.info(f"Cache hit for {operation}")
+            return cached
+
+        output_path = produce()
+        if output_path:
+            try:
+                self.put(key, output_path)
+            except OSError as e:
+                logging.error(f"Error caching {operation} result: {str(e)}")
+        return output_path
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
@@ -0,0 +1,168 @@
+import threading
+import tempfile
+import logging
+import shutil
+import time
+import os
+
+class StorageManager:
+    """Unique working directories for requests, with bounded total disk usage.
+
+    Every request gets its own directory under ``root`` (so concurrent uploads with
+    the same filename cannot overwrite each other), which is removed once the
+    response has been sent. A background sweeper removes anything older than
+    ``max_age`` seconds and, while the root holds more than ``max_bytes``, the
+    oldest directories that are no longer in use.
+    """
+
+    def __init__(self, root='work', max_age=60 * 60, max_bytes=5 * 1024 * 1024 * 1024, sweep_interval=60):
+        # Absolute, since send_file resolves relative paths against the app root rather than the cwd
+        self.root = os.path.abspath(root)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._active = set()
+        self._bytes = 0
+        self._dirs = 0
+        self._created = 0
+        self._released = 0
+        self._swept = 0
+        self._last_sweep_seconds = 0.0
+        self._sweeper_pid = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def _start_sweeper(self):
+        # Started in the process that serves requests: threads started in a
+        # preloading gunicorn master do not survive the fork into workers
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name='storage-sweeper', daemon=True).start()
+
+    def create(self, prefix='req-'):
+        """Create a new unique directory and mark it as in use"""
+        if self._sweeper_pid != os.getpid():
+            self._start_sweeper()
+        # The pid in the name tells other worker processes sharing root whose directory it is
+        path = tempfile.mkdtemp(prefix=f'{prefix}{os.getpid()}-', dir=self.root)
+        with self._lock:
+            self._active.add(path)
+            self._created += 1
+        return path
+
+    def release(self, path):
+        """Delete a directory once its response is done"""
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self._active.discard(path)
+            self._released += 1
+
+    def _usage(self, path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def sweep(self):
+        """Apply the max-age and max-bytes policy to the directories under root"""
+        started = time.perf_counter()
+        now = time.time()
+        with self._lock:
+            active = set(self._active)
+
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.append((mtime, path, self._usage(path)))
+
+        removed = 0
+        kept = []
+        for mtime, path, size in sorted(entries):
+            # Directories past max_age are leftovers even if marked active (e.g. an aborted stream)
+            if now - mtime > self.max_age:
+                self._remove(path)
+                removed += 1
+            else:
+                kept.append((mtime, path, size))
+
+        total = sum(size for _, _, size in kept)
+        for mtime, path, size in list(kept):
+            if total <= self.max_bytes:
+                break
+            if path in active or self._owned_by_other_process(path):
+                continue
+            self._remove(path)
+            kept.remove((mtime, path, size))
+            total -= size
+            removed += 1
+
+        if total > self.max_bytes:
+            logging.error(f"Storage in {self.root} is {total} bytes, over the {self.max_bytes} byte limit, with every directory in use")
+
+        with self._lock:
+            self._bytes = total
+            self._dirs = len(kept)
+            self._swept += removed
+            self._last_sweep_seconds = time.perf_counter() - started
+        return removed
+
+    def _owned_by_other_process(self, path):
+        """Whether a directory belongs to another live process, whose requests may still use it"""
+        try:
+            pid = int(os.path.basename(path).split('-')[1])
+        except (IndexError, ValueError):
+            return False
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._active.discard(path)
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping {self.root}: {str(e)}")
+
+    def stats(self):
+        """Usage as of the last sweep, plus live request counters"""
+        with self._lock:
+            return {
+                'root': self.root,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_age_seconds': self.max_age,
+                'directories': self._dirs,
+                'active': len(self._active),
+                'created': self._created,
+                'released': self._released,
+                'swept': self._swept,
+                'last_sweep_seconds': round(self._last_sweep_seconds, 4),
+            }
@@ -0,0 +1,267 @@
+from werkzeug.datastructures import FileStorage
+from collections import OrderedDict
+import threading
+import hashlib
+import logging
+import shutil
+import fcntl
+import json
+import time
+import uuid
+import os
+
+CHUNK_SIZE = 64 * 1024
+
+# In-progress hashes kept per process; an upload resumed elsewhere is re-hashed from disk once
+MAX_HASHERS = 256
+
+class UploadNotFoundError(Exception):
+    """Raised for upload ids that do not exist or have expired"""
+
+class UploadStateError(Exception):
+    """Raised for requests that do not fit an upload's state, like a chunk at the wrong offset"""
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+class UploadedFile(FileStorage):
+    """A finished chunked upload presented to routes like a multipart file"""
+
+    def __init__(self, path, filename, name, sha256):
+        super().__init__(stream=open(path, 'rb'), filename=filename, name=name, content_type='application/octet-stream')
+        self.path = path
+        self.sha256 = sha256
+
+    def save(self, dst, buffer_size=16384):
+        # A hard link shares the bytes already on disk; copies are only needed across filesystems
+        if isinstance(dst, (str, os.PathLike)):
+            try:
+                os.link(self.path, dst)
+                return
+            except OSError:
+                pass
+        super().save(dst, buffer_size)
+
+class UploadManager:
+    """Resumable uploads written to disk chunk by chunk.
+
+    Every upload lives in ``uploads_dir/<upload_id>/`` as a ``data`` file and an
+    ``upload.json`` record, so any web worker can take the next chunk. Chunks are
+    appended at the offset the client names, which must be the number of bytes
+    received so far, and are hashed as they are written. Uploads not touched for
+    ``ttl`` seconds are removed.
+    """
+
+    def __init__(self, uploads_dir='uploads', max_bytes=4 * 1024 * 1024 * 1024, ttl=24 * 60 * 60):
+        self.uploads_dir = uploads_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hashers = OrderedDict()
+        self._sweeper_pid = None
+        os.makedirs(uploads_dir, exist_ok=True)
+
+    def _start_sweeper(self):
+        # Threads started in a preloading gunicorn master do not survive the fork into workers
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name='upload-sweeper', daemon=True).start()
+
+    def _dir(self, upload_id):
+        return os.path.join(self.uploads_dir, upload_id)
+
+    def data_path(self, upload_id):
+        return os.path.join(self._dir(upload_id), 'data')
+
+    def _write(self, upload):
+        upload['updated_at'] = time.time()
+        path = os.path.join(self._dir(upload['id']), 'upload.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(upload, f)
+        os.replace(f'{path}.tmp', path)
+
+    def get(self, upload_id):
+        """Return the upload record; raises UploadNotFoundError"""
+        if not upload_id or not upload_id.isalnum():
+            raise UploadNotFoundError(f"Upload {upload_id} not found or expired")
+        try:
+            with open(os.path.join(self._dir(upload_id), 'upload.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadNotFoundError(f"Upload {upload_id} not found or expired")
+
+    def create(self, filename, size=None):
+        """
+        Start an upload
+        Args:
+            filename: Original name, whose extension routes check
+            size: Total bytes, if the client knows it; finalize then insists on it
+        """
+        if size is not None and not 0 < size <= self.max_bytes:
+            raise UploadStateError(f"Size must be between 1 and {self.max_bytes} bytes")
+        if self._sweeper_pid != os.getpid():
+            self._start_sweeper()
+
+        upload = {
+            'id': uuid.uuid4().hex,
+            'filename': filename,
+            'size': size,
+            'offset': 0,
+            'complete': False,
+            'sha256': None,
+            'created_at': time.time(),
+        }
+        os.makedirs(self._dir(upload['id']))
+        open(self.data_path(upload['id']), 'wb').close()
+        self._write(upload)
+        return upload
+
+    def _locked(self, upload_id):
+        """Exclusive lock on an upload across the processes sharing uploads_dir"""
+        self.get(upload_id)
+        try:
+            # A file of its own: upload.json is replaced on every write, which would drop the lock
+            lock_file = open(os.path.join(self._dir(upload_id), 'lock'), 'a')
+        except OSError:
+            raise UploadNotFoundError(f"Upload {upload_id} not found or expired")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _hasher_at(self, upload_id, offset):
+        """SHA-256 state of the first offset bytes, rebuilt from disk when this process does not hold it"""
+        with self._lock:
+            entry = self._hashers.pop(upload_id, None)
+        if entry and entry[0] == offset:
+            return entry[1]
+
+        hasher = hashlib.sha256()
+        with open(self.data_path(upload_id), 'rb') as f:
+            remaining = offset
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE * 16, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        return hasher
+
+    def append(self, upload_id, offset, stream):
+        """
+        Write one chunk read from a stream
+        Args:
+            upload_id: Upload to extend
+            offset: Where the chunk starts; must equal the bytes received so far
+            stream: Binary stream of the chunk, read in small pieces
+        Returns:
+            The updated upload record
+        """
+        lock_file = self._locked(upload_id)
+        try:
+            upload = self.get(upload_id)
+            if upload['complete']:
+                raise UploadStateError("Upload is already finalized", upload['offset'])
+            if offset != upload['offset']:
+                raise UploadStateError(f"Chunk offset {offset} does not match the {upload['offset']} bytes received",
+                                       upload['offset'])
+
+            hasher = self._hasher_at(upload_id, offset)
+            limit = upload['size'] or self.max_bytes
+            written = 0
+            try:
+                with open(self.data_path(upload_id), 'r+b') as f:
+                    # Drop anything past the recorded offset, e.g. from a crash mid-write
+                    f.truncate(offset)
+                    f.seek(offset)
+                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                        if offset + written + len(chunk) > limit:
+                            raise UploadStateError(f"Upload exceeds its {limit} byte limit", offset + written)
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        written += len(chunk)
+            finally:
+                # Keep what arrived before a dropped connection, so the client resumes from there
+                upload['offset'] = offset + written
+                with self._lock:
+                    self._hashers[upload_id] = (upload['offset'], hasher)
+                    while len(self._hashers) > MAX_HASHERS:
+                        self._hashers.popitem(last=False)
+                self._write(upload)
+            return upload
+        finally:
+            lock_file.close()
+
+    def finalize(self, upload_id, sha256=None):
+        """
+        Mark an upload complete and record its SHA-256
+        Args:
+            upload_id: Upload to finish
+            sha256: Hex digest the client computed, checked against the received bytes
+        """
+        lock_file = self._locked(upload_id)
+        try:
+            upload = self.get(upload_id)
+            if upload['complete']:
+                return upload
+            if upload['size'] is not None and upload['offset'] != upload['size']:
+                raise UploadStateError(f"Received {upload['offset']} of {upload['size']} bytes", upload['offset'])
+            if not upload['offset']:
+                raise UploadStateError("Upload is empty", 0)
+
+            digest = self._hasher_at(upload_id, upload['offset']).hexdigest()
+            if sha256 and sha256.lower() != digest:
+                raise UploadStateError(f"SHA-256 mismatch: received bytes hash to {digest}", upload['offset'])
+            upload.update(complete=True, sha256=digest, size=upload['offset'])
+            # Finished uploads are shared by hard links and must not change
+            os.chmod(self.data_path(upload_id), 0o444)
+            self._write(upload)
+            return upload
+        finally:
+            lock_file.close()
+
+    def open(self, upload_id, name='file'):
+        """A finished upload as an UploadedFile for the form field `name`"""
+        upload = self.get(upload_id)
+        if not upload['complete']:
+            raise UploadStateError(f"Upload {upload_id} is not finalized", upload['offset'])
+        # Reading counts as use, so uploads fed to several operations stay around
+        self._write(upload)
+        return UploadedFile(self.data_path(upload_id), upload['filename'], name, upload['sha256'])
+
+    def delete(self, upload_id):
+        self.get(upload_id)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def status(self, upload):
+        """Public view of an upload record"""
+        view = {key: upload.get(key) for key in ('id', 'filename', 'size', 'offset', 'complete', 'sha256', 'created_at')}
+        view['expires_at'] = upload['updated_at'] + self.ttl
+        return view
+
+    def sweep(self):
+        """Delete uploads not touched for ttl seconds"""
+        now = time.time()
+        for upload_id in os.listdir(self.uploads_dir):
+            path = self._dir(upload_id)
+            try:
+                if now - os.path.getmtime(os.path.join(path, 'upload.json')) <= self.ttl:
+                    continue
+            except OSError:
+                # Directories without a record are leftovers from a crash
+                if not os.path.isdir(path) or now - os.path.getmtime(path) <= self.ttl:
+                    continue
+            with self._lock:
+                self._hashers.pop(upload_id, None)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(min(60, self.ttl))
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping uploads: {str(e)}")
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from reportlab.pdfbase.pdfmetrics import standardFonts
+from reportlab.pdfgen import canvas
+import threading
+import io
+
+# Fonts every PDF viewer has, so the watermark needs nothing embedded
+FONTS = standardFonts
+
+def page_geometry(page):
+    """(left, bottom, width, height, rotate) of the visible box of a PyPDF2 page"""
+    box = page.cropbox
+    rotate = int(page.get('/Rotate', 0) or 0) % 360
+    return (round(float(box.left), 2), round(float(box.bottom), 2),
+            round(float(box.width), 2), round(float(box.height), 2), rotate)
+
+def placement(geometry):
+    """
+    Matrix that maps a template drawn upright at the displayed page size onto the page
+    Args:
+        geometry: Tuple from page_geometry
+    Returns:
+        (a, b, c, d, e, f) for a cm operator or Transformation
+    """
+    left, bottom, width, height, rotate = geometry
+    if rotate == 90:
+        return (0, 1, -1, 0, left + width, bottom)
+    if rotate == 180:
+        return (-1, 0, 0, -1, left + width, bottom + height)
+    if rotate == 270:
+        return (0, -1, 1, 0, left, bottom + height)
+    return (1, 0, 0, 1, left, bottom)
+
+class WatermarkTemplates:
+    """LRU cache of rendered watermark pages.
+
+    A template is a one-page PDF with the text centered and rotated on a page of
+    the displayed size, keyed by (text, font, size, opacity, angle, page size), so
+    each distinct page geometry is rendered once and reused across pages and requests.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, text, width, height, font='Helvetica', size=60, opacity=0.3, angle=45):
+        """Return the rendered template PDF as bytes"""
+        key = (text, font, size, opacity, angle, width, height)
+        with self._lock:
+            if key in self._templates:
+                self._templates.move_to_end(key)
+                self._hits += 1
+                return self._templates[key]
+            self._misses += 1
+
+        data = self._render(text, width, height, font, size, opacity, angle)
+        with self._lock:
+            self._templates[key] = data
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+        return data
+
+    def _render(self, text, width, height, font, size, opacity, angle):
+        packet = io.BytesIO()
+        can = canvas.Canvas(packet, pagesize=(width, height))
+        can.setFont(font, size)
+        can.setFillColorRGB(0.5, 0.5, 0.5, alpha=opacity)
+        can.translate(width / 2, height / 2)
+        can.rotate(angle)
+        # Roughly center the text vertically on its baseline
+        can.drawCentredString(0, -size * 0.35, text)
+        can.save()
+        return packet.getvalue()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._templates),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
@@ -0,0 +1,53 @@
+import io
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+
+class _ZipBuffer(io.RawIOBase):
+    """Write-only sink that collects zipfile output until it is drained"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(entries, compress_type=zipfile.ZIP_STORED):
+    """
+    Build a ZIP archive incrementally and yield it in chunks
+    Args:
+        entries: Iterable of (arcname, path) pairs, consumed lazily
+        compress_type: zipfile compression for every entry
+    Yields:
+        Bytes of the archive, so at most one read chunk is held in memory
+    """
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=compress_type) as archive:
+        for arcname, path in entries:
+            with open(path, 'rb') as source, archive.open(arcname, 'w', force_zip64=True) as target:
+                while True:
+                    data = source.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    target.write(data)
+                    chunk = buffer.drain()
+                    if chunk:
+                        yield chunk
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    yield buffer.drain()